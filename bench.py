@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List
+
+# Микробенчмарки горячих мест bot.py. Бот импортируется в пустом временном каталоге
+# (файлы заказов и базы создаются там), сеть не используется.
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("FSM_STORAGE", "memory")
+os.chdir(tempfile.mkdtemp(prefix="bench-"))
+sys.path.insert(0, REPO)
+
+import bot as B  # noqa: E402
+from aiogram.dispatcher.event.bases import UNHANDLED  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.methods import SendMessage  # noqa: E402
+from aiogram.types import Chat, KeyboardButton, Message, PhotoSize, ReplyKeyboardMarkup, User  # noqa: E402
+
+USER = User(id=42, is_bot=False, first_name="bench")
+
+def make_message(text=None, photo=False) -> Message:
+    kw = {"message_id": 1, "date": datetime(2026, 1, 1), "chat": Chat(id=42, type="private"), "from_user": USER}
+    if text is not None:
+        kw["text"] = text
+    if photo:
+        kw["photo"] = [PhotoSize(file_id="p", file_unique_id="p", width=1, height=1)]
+    return Message(**kw)
+
+def timeit(fn: Callable[[], None], rounds: int) -> float:
+    # лучшее из трёх прогонов, секунд на один вызов
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        best = min(best, (time.perf_counter() - started) / rounds)
+    return best
+
+def peak_bytes(fn: Callable[[], None], rounds: int) -> float:
+    # средний пик памяти, занятой во время одного вызова
+    tracemalloc.start()
+    total = 0
+    for _ in range(rounds):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total / rounds
+
+def report(title: str, rows: List[tuple]) -> None:
+    print(f"\n{title}")
+    for name, value in rows:
+        print(f"  {name:<40} {value}")
+
+# ----------------- dispatch -----------------
+
+def dispatch_workload() -> List[tuple]:
+    # каждое состояние визарда x (все тексты кнопок + произвольный текст + фото)
+    texts = sorted(B.dp.message.indexed_texts | {t for buttons in B.STEP_BUTTONS.values() for t in buttons})
+    states = [None] + sorted(B.FLOW_STEPS) + sorted(B.FLOW_CONFIRM)
+    events = [make_message(t) for t in texts] + [make_message("произвольный текст"), make_message(photo=True)]
+    return [(raw_state, event) for raw_state in states for event in events]
+
+async def select(handlers, event, raw_state):
+    # выбор хендлера без его вызова: первый, чьи фильтры прошли
+    kwargs = {"bot": B.bot, "raw_state": raw_state, "event_from_user": USER}
+    for handler in handlers:
+        result, _ = await handler.check(event, **kwargs)
+        if result:
+            return handler
+    return UNHANDLED
+
+def bench_dispatch(rounds: int) -> None:
+    observer = B.dp.message
+    workload = dispatch_workload()
+    loop = asyncio.new_event_loop()
+
+    async def linear():
+        for raw_state, event in workload:
+            await select(observer.handlers, event, raw_state)
+
+    async def indexed():
+        for raw_state, event in workload:
+            await select(observer.plan(raw_state, event.text), event, raw_state)
+
+    async def check():
+        for raw_state, event in workload:
+            a = await select(observer.handlers, event, raw_state)
+            b = await select(observer.plan(raw_state, event.text), event, raw_state)
+            assert a is b, (raw_state, event.text)
+
+    loop.run_until_complete(check())
+    per_linear = timeit(lambda: loop.run_until_complete(linear()), rounds) / len(workload)
+    per_indexed = timeit(lambda: loop.run_until_complete(indexed()), rounds) / len(workload)
+    loop.close()
+    checked = sum(len(observer.plan(s, e.text)) for s, e in workload) / len(workload)
+    report(f"dispatch: {len(workload)} updates, {len(observer.handlers)} message handlers", [
+        ("linear, us/update", round(per_linear * 1e6, 2)),
+        ("indexed, us/update", round(per_indexed * 1e6, 2)),
+        ("handlers checked per update (indexed)", round(checked, 2)),
+    ])
+
+# ----------------- keyboards -----------------
+
+def bench_keyboards(rounds: int) -> None:
+    # одна отправка сообщения с клавиатурой: как было (клавиатура собирается в хендлере
+    # и сериализуется вместе с методом) и из реестра (готовый JSON в CachedMarkupSession)
+    plain, cached = AiohttpSession(), B.CachedMarkupSession()
+    rows = [["A6 (10×15)", "A5 (15×21)"], ["A4 (21×30)", "A3 (30×42)"], ["A7 (7×10)"]]
+    registered = B.make_kb(*rows)
+
+    def built():
+        kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=t) for t in row] for row in rows],
+                                 resize_keyboard=True)
+        plain.build_form_data(B.bot, SendMessage(chat_id=42, text="Размер:", reply_markup=kb))
+
+    def reused():
+        cached.build_form_data(B.bot, SendMessage(chat_id=42, text="Размер:", reply_markup=registered))
+
+    def payload(session, kb):
+        form = session.build_form_data(B.bot, SendMessage(chat_id=42, text="Размер:", reply_markup=kb))
+        return {f[0]["name"]: f[2] for f in form._fields}
+
+    assert payload(plain, registered) == payload(cached, registered)
+    per_built, per_reused = timeit(built, rounds * 100), timeit(reused, rounds * 100)
+    bytes_built, bytes_reused = peak_bytes(built, rounds * 20), peak_bytes(reused, rounds * 20)
+    report(f"keyboards: {len(B.MARKUP_JSON)} registered markups", [
+        ("built per message, us/send", round(per_built * 1e6, 2)),
+        ("registry, us/send", round(per_reused * 1e6, 2)),
+        ("saved, us/send", round((per_built - per_reused) * 1e6, 2)),
+        ("built per message, peak bytes/send", int(bytes_built)),
+        ("registry, peak bytes/send", int(bytes_reused)),
+    ])
+
+# ----------------- draft memory -----------------
+
+def measure_memory(build: Callable[[int], object], count: int) -> float:
+    # байт на объект, оставшихся занятыми после построения count объектов
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = [build(i) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del keep
+    return used / count
+
+def sample_order(i: int) -> dict:
+    # пользователь на шаге комментария в «Печати фото» с тремя файлами
+    return {"service": "Печать фото", "contact": f"89{i:09d}", "size": "A6 (10×15)", "paper": "Глянцевая",
+            "copies": 2, "files": [("photo", f"AgACAgIAAxkBAAI{i:08d}x{n}") for n in range(3)]}
+
+def bench_draft(rounds: int) -> None:
+    sessions = rounds * 100
+    draft = B.OrderDraft.from_dict(sample_order(0))
+    assert B.OrderDraft.load(json.loads(json.dumps(draft.dump()))) == draft
+    # в LRU-кэше SQLiteStorage лежит то, что вернул json.loads из базы
+    old_cached = measure_memory(lambda i: json.loads(json.dumps(sample_order(i), ensure_ascii=False)), sessions)
+    new_cached = measure_memory(
+        lambda i: json.loads(json.dumps({B.DRAFT_KEY: B.OrderDraft.from_dict(sample_order(i)).dump()},
+                                        ensure_ascii=False)), sessions)
+    # рабочее представление в хендлере: dict против OrderDraft
+    old_live = measure_memory(lambda i: dict(sample_order(i)), sessions)
+    new_live = measure_memory(lambda i: B.OrderDraft.from_dict(sample_order(i)), sessions)
+    old_json = len(json.dumps(sample_order(0), ensure_ascii=False).encode())
+    new_json = len(json.dumps({B.DRAFT_KEY: draft.dump()}, ensure_ascii=False).encode())
+    report(f"draft: {sessions} sessions mid-wizard, 3 files each", [
+        ("dict in FSM cache, bytes/session", int(old_cached)),
+        ("compact draft in FSM cache, bytes/session", int(new_cached)),
+        ("dict in handler, bytes/session", int(old_live)),
+        ("OrderDraft in handler, bytes/session", int(new_live)),
+        ("dict JSON row, bytes", old_json),
+        ("compact draft JSON row, bytes", new_json),
+    ])
+
+# ----------------- order index -----------------
+
+def write_orders(path: str, count: int) -> List[str]:
+    # count заказов в формате orders.txt по шаблонам услуг; возвращает телефоны клиентов
+    rnd = random.Random(1)
+    services = list(B.SERVICES.values())
+    phones = [f"89{rnd.randrange(10 ** 9):09d}" for _ in range(max(1, count // 3))]
+    with open(path, "w", encoding="utf-8") as f:
+        for n in range(1, count + 1):
+            service = rnd.choice(services)
+            draft = B.OrderDraft(service=service.name, contact=rnd.choice(phones), size="A6 (10×15)",
+                                 paper="Глянцевая", copies=rnd.randint(1, 20), format="A4", color="Цветная",
+                                 duplex="Односторонняя", pages="все", doc_type="Паспорт РФ", qty=2,
+                                 source="Плёнка", media="Нет", item="Футболка", has_layout="Есть макет",
+                                 task="Ретушь", product_type="Визитки", tirage=100, need_design="Нужен дизайн",
+                                 dont_change="", desc="сделать красиво", comment=rnd.choice(["", "срочно", "к пятнице"]))
+            day = f"2025-{1 + n * 12 // (count + 1):02d}-{1 + n % 28:02d} 12:{n % 60:02d}:00"
+            client = f"@user{n % 5000} (id={100000 + n % 5000})"
+            f.write(service.order_tpl.render(draft, n, day, client) + "\n" + B.ORDER_SEPARATOR + "\n")
+    return phones
+
+def bench_index(rounds: int) -> None:
+    count = rounds * 2000
+    path = os.path.abspath("bench_orders.txt")
+    phones = write_orders(path, count)
+    index = B.OrderIndex(B.OrderLog(path, os.path.abspath("bench_archive")))
+    started = time.perf_counter()
+    index.build()
+    build = time.perf_counter() - started
+    assert len(index.locations) == count
+
+    def latency(fn, args) -> tuple:
+        times = []
+        for arg in args:
+            started = time.perf_counter()
+            fn(arg)
+            times.append(time.perf_counter() - started)
+        times.sort()
+        return round(statistics.median(times) * 1e6, 1), round(times[int(len(times) * 0.99)] * 1e6, 1)
+
+    # та же выборка из SQLite-копии: телефон и день по индексам orders_phone / orders_created
+    store = B.OrderStore(os.path.abspath("bench_orders.sqlite3"))
+    loop = asyncio.new_event_loop()
+    started = time.perf_counter()
+    loop.run_until_complete(store.import_text_once(index.log))
+    store_build = time.perf_counter() - started
+
+    def day_range(day: str) -> tuple:
+        return day, day + " 99"
+
+    rnd = random.Random(2)
+    phone_queries = [rnd.choice(phones) for _ in range(1000)]
+    word_queries = [rnd.choice(["срочно", "печать фото", "фотошоп", "user42", "визитки 89"]) for _ in range(1000)]
+    numbers = [rnd.randint(1, count) for _ in range(1000)]
+    days = [rnd.choice(list(index.by_day)) for _ in range(1000)]
+    rows = [("build, s", round(build, 3)), ("index tokens", len(index.postings)),
+            ("OrderStore import, s", round(store_build, 3))]
+    for name, fn, args in [
+        ("/find phone: OrderIndex.search", index.search, phone_queries),
+        ("phone: OrderStore.by_phone", lambda q: loop.run_until_complete(store.by_phone(q)), phone_queries),
+        ("/find words: OrderIndex.search", index.search, word_queries),
+        ("/order N: OrderIndex.read", index.read, numbers),
+        ("/find phone + read 10 blocks", lambda q: [index.read(n) for n in index.search(q)], phone_queries),
+        ("/today: OrderIndex.by_day", index.by_day.get, days),
+        ("/today + read blocks", lambda d: [index.read(n) for n in index.by_day[d]], days),
+        ("day: OrderStore.by_date", lambda d: loop.run_until_complete(store.by_date(*day_range(d))), days),
+    ]:
+        p50, p99 = latency(fn, args)
+        rows.append((f"{name}, p50/p99 us", f"{p50} / {p99}"))
+    loop.run_until_complete(store.close())
+    loop.close()
+    report(f"order index: {count} orders, {os.path.getsize(path) / 1024 ** 2:.1f} MB", rows)
+    os.remove(path)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(store.path + suffix):
+            os.remove(store.path + suffix)
+
+def bench_segments(rounds: int) -> None:
+    # тот же журнал одним файлом и по месячным сегментам: выборка одного месяца и диапазона номеров
+    count = rounds * 2000
+    path = os.path.abspath("bench_orders.txt")
+    archive = os.path.abspath("bench_archive")
+    write_orders(path, count)
+    whole = B.OrderLog(path, os.path.join(archive, "none"))
+    log = B.OrderLog(os.path.abspath("bench_active.txt"), archive, compress=False)
+    month, out = None, None
+    for block in whole.iter_blocks():
+        day = block.partition("\nДата: ")[2][:7]
+        if day != month:
+            if out is not None:
+                out.close()
+                log.rotate()
+            month, out = day, open(log.active, "w", encoding="utf-8")
+        out.write(block + "\n" + B.ORDER_SEPARATOR + "\n")
+    out.close()
+
+    def timed(fn) -> tuple:
+        started = time.perf_counter()
+        n = sum(1 for _ in fn())
+        return n, round((time.perf_counter() - started) * 1000, 1)
+
+    first, last = count // 2, count // 2 + 100
+    rows = [("segments", log.active_id + 1)]
+    for name, fn in [
+        ("one month, single file", lambda: whole.iter_blocks(since="2025-06-01", until="2025-06-31")),
+        ("one month, segments", lambda: log.iter_blocks(since="2025-06-01", until="2025-06-31")),
+        ("100 orders by number, single file", lambda: whole.iter_blocks(first, last)),
+        ("100 orders by number, segments", lambda: log.iter_blocks(first, last)),
+    ]:
+        n, ms = timed(fn)
+        rows.append((f"{name}: {n} orders, ms", ms))
+    log.compress_closed()
+    index = B.OrderIndex(log)
+    started = time.perf_counter()
+    index.build()
+    rows.append(("index build over .gz segments, s", round(time.perf_counter() - started, 3)))
+    rnd = random.Random(3)
+    numbers = [rnd.randint(1, count) for _ in range(200)]
+    started = time.perf_counter()
+    for n in numbers:
+        assert index.read(n)
+    rows.append(("/order N from .gz segment, ms", round((time.perf_counter() - started) / len(numbers) * 1000, 2)))
+    report(f"journal segments: {count} orders", rows)
+    os.remove(path)
+    os.remove(log.active)
+    shutil.rmtree(archive)
+
+BENCHES: Dict[str, Callable[[int], None]] = {
+    "dispatch": bench_dispatch,
+    "keyboards": bench_keyboards,
+    "draft": bench_draft,
+    "index": bench_index,
+    "segments": bench_segments,
+}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Микробенчмарки bot.py")
+    parser.add_argument("names", nargs="*", help=f"какие бенчмарки запустить: {', '.join(BENCHES)} (по умолчанию все)")
+    parser.add_argument("--rounds", type=int, default=50, help="повторов на замер")
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHES)
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(sorted(unknown))}")
+    for name in args.names or BENCHES:
+        BENCHES[name](args.rounds)
+
+if __name__ == "__main__":
+    main()
@@ -1,105 +1,1844 @@
+import argparse
 import asyncio
+import bisect
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mmap
+import operator
 import os
-from datetime import datetime
-from typing import List, Tuple, Optional
-
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple
+
+import aiofiles
+import aiofiles.os
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.dispatcher.event.bases import UNHANDLED, SkipHandler
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import DataNotDictLikeError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types import FSInputFile, InputMediaDocument, InputMediaPhoto
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import FormData, web
+from magic_filter.operations import ComparatorOperation, FunctionOperation, GetAttributeOperation
+from magic_filter.util import in_op
 
 import os
 
 TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_ID = 1606381134  # твой Telegram ID (админ)
 
-if not TOKEN:
-    raise RuntimeError("BOT_TOKEN is empty. Set BOT_TOKEN env var.")
-
-if not TOKEN:
-    raise RuntimeError("BOT_TOKEN is empty. Set BOT_TOKEN env var.")
-if ADMIN_ID == 0:
-    raise RuntimeError("ADMIN_ID is empty. Set ADMIN_ID env var.")
+RUN_MODE = os.getenv("RUN_MODE", "polling").strip()  # polling | webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip()  # публичный https-адрес, если пусто — setWebhook не вызываем
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+def check_config() -> None:
+    # проверяется при запуске бота, а не при импорте: `python bot.py export` токен не нужен
+    if not TOKEN:
+        raise RuntimeError("BOT_TOKEN is empty. Set BOT_TOKEN env var.")
+    if ADMIN_ID == 0:
+        raise RuntimeError("ADMIN_ID is empty. Set ADMIN_ID env var.")
+    if RUN_MODE not in {"polling", "webhook"}:
+        raise RuntimeError("RUN_MODE must be 'polling' or 'webhook'.")
+    if RUN_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is empty. Set WEBHOOK_SECRET env var for webhook mode.")
 
 ORDERS_FILE = "orders.txt"
 COUNTER_FILE = "order_counter.txt"
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# свой Bot API сервер (локальный telegram-bot-api или заглушка для нагрузочных тестов)
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip()
+
+# id(клавиатуры) -> (клавиатура, готовый JSON для поля reply_markup); заполняется в разделе keyboards
+MARKUP_JSON: Dict[int, Tuple[Any, str]] = {}
+
+class CachedMarkupSession(AiohttpSession):
+    # Клавиатуры из реестра не сериализуются на каждую отправку: в запрос идёт заранее
+    # собранная JSON-строка, остальные поля метода готовятся как обычно.
+
+    def build_form_data(self, bot: Bot, method) -> FormData:
+        cached = MARKUP_JSON.get(id(getattr(method, "reply_markup", None)))
+        if cached is None:
+            return super().build_form_data(bot, method)
+        form = FormData(quote_fields=False)
+        files: Dict[str, Any] = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", cached[1])
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+# без BOT_TOKEN объект бота создаётся с токеном-заглушкой: в сеть он не ходит (main() сначала
+# вызывает check_config), но модуль можно импортировать для выгрузки, бенчмарков и нагрузочного теста
+bot = Bot(
+    token=TOKEN or "0:offline",
+    session=CachedMarkupSession(api=TelegramAPIServer.from_base(BOT_API_URL) if BOT_API_URL else PRODUCTION),
+)
 
 # ----------------- storage utils -----------------
 
-def next_order_number() -> int:
-    if not os.path.exists(COUNTER_FILE):
-        with open(COUNTER_FILE, "w", encoding="utf-8") as f:
-            f.write("1")
-
-    with open(COUNTER_FILE, "r", encoding="utf-8") as f:
-        n = int((f.read().strip() or "1"))
-
-    with open(COUNTER_FILE, "w", encoding="utf-8") as f:
-        f.write(str(n + 1))
-
-    return n
+ORDER_ID_BLOCK = int(os.getenv("ORDER_ID_BLOCK", "100"))
+
+def _fsync_dir(path: str) -> None:
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+@contextmanager
+def atomic_file(path: str, mode: str = "w", **kwargs):
+    # все атомарные записи идут через эту функцию: пишем в path.tmp, fsync, rename, fsync каталога;
+    # при ошибке внутри блока временный файл удаляется, а прежний path остаётся как был
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp)
+        raise
+    _fsync_dir(path)
+
+def _write_file_atomic(path: str, content: str) -> None:
+    with atomic_file(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+class OrderCounter:
+    # В файле лежит первый ещё не зарезервированный номер. Номера выдаются из памяти
+    # блоками по ORDER_ID_BLOCK: перед выдачей блока его верхняя граница пишется на диск,
+    # поэтому после падения нумерация продолжится с границы (с пропуском, но без повторов).
+
+    def __init__(self, path: str, block: int = ORDER_ID_BLOCK):
+        self.path = path
+        self.block = max(1, block)
+        self._next: Optional[int] = None
+        self._limit = 0
+        self._written = 0
+        self._lock = threading.Lock()
+        self._prefetch: Optional[asyncio.Task] = None
+
+    def _load(self) -> int:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return int(f.read().strip() or "1")
+        except FileNotFoundError:
+            return 1
+
+    def _persist(self, limit: int) -> None:
+        # граница на диске только растёт, даже если фоновая запись закончилась позже синхронной
+        with self._lock:
+            if limit > self._written:
+                _write_file_atomic(self.path, str(limit))
+                self._written = limit
+
+    async def _reserve_async(self, limit: int) -> None:
+        await asyncio.to_thread(self._persist, limit)
+        self._limit = max(self._limit, limit)
+
+    def _reserve(self, limit: int) -> asyncio.Task:
+        # одна фоновая запись границы за раз; остальные ждут её же
+        if self._prefetch is None or self._prefetch.done():
+            self._prefetch = asyncio.get_running_loop().create_task(self._reserve_async(limit))
+            self._prefetch.add_done_callback(self._prefetch_done)
+        return self._prefetch
+
+    def _prefetch_done(self, task: asyncio.Task) -> None:
+        # ошибку забираем здесь, даже если задачу никто не ждал; следующий next() на исчерпанном
+        # блоке не пойдёт дальше, пока новая запись границы не закончится успешно
+        if task.cancelled() or task.exception() is None:
+            return
+        logging.error("order counter reservation failed: %r", task.exception())
+        if self._prefetch is task:
+            self._prefetch = None
+
+    def _maybe_prefetch(self) -> None:
+        # следующий блок резервируем, когда текущий израсходован наполовину,
+        # чтобы к его концу граница уже лежала на диске и хендлер не ждал запись
+        if self._limit - self._next > self.block // 2:
+            return
+        self._reserve(self._limit + self.block)
+
+    async def next(self) -> int:
+        if self._next is None:
+            start = await asyncio.to_thread(self._load)
+            if self._next is None:
+                self._next = start
+                self._limit = self._written = start
+        # диск не трогаем в цикле событий: если блок кончился, ждём фоновое резервирование
+        while self._next >= self._limit:
+            await asyncio.shield(self._reserve(max(self._limit, self._next) + self.block))
+        n = self._next
+        self._next += 1
+        self._maybe_prefetch()
+        return n
+
+    def _release(self) -> None:
+        with self._lock:
+            _write_file_atomic(self.path, str(self._next))
+            self._limit = self._written = self._next
+
+    async def close(self) -> None:
+        # при штатной остановке возвращаем неиспользованный остаток блока
+        if self._prefetch is not None:
+            await asyncio.gather(self._prefetch, return_exceptions=True)
+        if self._next is not None:
+            await asyncio.to_thread(self._release)
+
+order_counter = OrderCounter(COUNTER_FILE)
+
+async def next_order_number() -> int:
+    return await order_counter.next()
+
+JOURNAL_FSYNC_INTERVAL = float(os.getenv("JOURNAL_FSYNC_INTERVAL", "1.0"))
+JOURNAL_FSYNC_BYTES = int(os.getenv("JOURNAL_FSYNC_BYTES", str(64 * 1024)))
+ORDER_SEPARATOR = "=" * 70
+
+_fsync = aiofiles.os.wrap(os.fsync)
+
+JOURNAL_SEGMENT_BYTES = int(os.getenv("JOURNAL_SEGMENT_BYTES", str(64 * 1024 ** 2)))  # 0 — не резать по размеру
+JOURNAL_ROTATE_MONTHLY = os.getenv("JOURNAL_ROTATE_MONTHLY", "1") == "1"
+JOURNAL_COMPRESS = os.getenv("JOURNAL_COMPRESS", "0") == "1"  # закрытые сегменты жать в .gz
+ORDERS_ARCHIVE_DIR = os.getenv("ORDERS_ARCHIVE_DIR", "orders_archive")
+GZ_MEMBER_BYTES = 64 * 1024  # сжатый сегмент — цепочка gzip-членов по столько байт исходного текста
+# заголовок блока — только в начале файла или сразу после разделителя: строки «Заказ №»
+# внутри текста клиента заголовком не считаются
+_segment_head_re = re.compile(("(?:^|\n%s\n+)Заказ №(\\d+)\nДата: (\\d{4}-\\d{2}-\\d{2})"
+                               % ORDER_SEPARATOR).encode("utf-8"))
+
+def read_segment_bytes(path: str) -> bytes:
+    # закрытый сегмент целиком (не больше JOURNAL_SEGMENT_BYTES или месяца заказов)
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return f.read()
+
+def segment_info(path: str) -> dict:
+    data = read_segment_bytes(path)
+    heads = [(int(m.group(1)), m.group(2).decode()) for m in _segment_head_re.finditer(data)]
+    nums = [n for n, _ in heads]
+    return {
+        "file": os.path.basename(path),
+        "first": min(nums, default=0),
+        "last": max(nums, default=0),
+        "count": len(heads),
+        "from": min((d for _, d in heads), default=""),
+        "to": max((d for _, d in heads), default=""),
+        "bytes": len(data),
+    }
 
-def append_order(text: str) -> None:
-    with open(ORDERS_FILE, "a", encoding="utf-8") as f:
-        f.write(text + "\n" + "=" * 70 + "\n")
+class OrderLog:
+    # Журнал заказов по сегментам. ORDERS_FILE — текущий сегмент, в него пишет OrderJournal.
+    # Закрытые сегменты лежат в archive_dir как orders-<первый>-<последний>.txt (или .txt.gz),
+    # manifest.json хранит для каждого диапазон номеров и дат. Номер сегмента — его позиция
+    # в манифесте; у текущего номер на единицу больше последнего закрытого. У сжатого сегмента
+    # в манифесте ещё и members — [смещение в тексте, смещение в .gz] начала каждого gzip-члена.
+
+    def __init__(self, active: str, archive_dir: str, compress: bool = JOURNAL_COMPRESS):
+        self.active = active
+        self.archive_dir = archive_dir
+        self.compress = compress
+        self.manifest_path = os.path.join(archive_dir, "manifest.json")
+        self._segments: Optional[List[dict]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def segments(self) -> List[dict]:
+        if self._segments is None:
+            self.recover()
+        return self._segments
+
+    def _save_manifest(self) -> None:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        _write_file_atomic(self.manifest_path, json.dumps(self._segments, ensure_ascii=False, indent=1))
+
+    def recover(self) -> None:
+        # манифест сверяется с каталогом: после сбоя между переименованием и записью манифеста
+        # сегмент может в нём отсутствовать, а после сжатия — называться уже .gz
+        with self._lock:
+            segments = []
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    segments = json.load(f)
+            names = set(os.listdir(self.archive_dir)) if os.path.isdir(self.archive_dir) else set()
+            known = set()
+            for seg in segments:
+                if seg["file"] not in names and seg["file"] + ".gz" in names:
+                    seg["file"] += ".gz"
+                known.add(seg["file"])
+            segments = [seg for seg in segments if seg["file"] in names]
+            for name in sorted(names):
+                if name.startswith("orders-") and name.endswith((".txt", ".txt.gz")) and name not in known:
+                    if name.endswith(".txt") and name + ".gz" in names:
+                        continue
+                    segments.append(segment_info(os.path.join(self.archive_dir, name)))
+            segments.sort(key=lambda seg: (seg["first"], seg["file"]))
+            changed = segments != self._segments
+            self._segments = segments
+            if changed and (segments or os.path.exists(self.manifest_path)):
+                self._save_manifest()
+
+    @property
+    def active_id(self) -> int:
+        return len(self.segments)
+
+    def path(self, segment: int) -> str:
+        segments = self.segments
+        if segment < len(segments):
+            return os.path.join(self.archive_dir, segments[segment]["file"])
+        return self.active
+
+    def paths(self) -> List[Tuple[int, str]]:
+        return [(i, self.path(i)) for i in range(self.active_id + 1)]
+
+    def read(self, segment: int, offset: int, length: int) -> bytes:
+        path = self.path(segment)
+        if not path.endswith(".gz"):
+            with open(path, "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+        segments = self.segments
+        members = segments[segment].get("members") if segment < len(segments) else None
+        start = [0, 0]
+        if members:
+            # распаковка начинается с gzip-члена, в который попадает смещение, а не с начала файла
+            start = members[bisect.bisect_right(members, offset, key=lambda m: m[0]) - 1]
+        with open(path, "rb") as raw:
+            raw.seek(start[1])
+            with gzip.GzipFile(fileobj=raw, mode="rb") as f:
+                f.seek(offset - start[0])
+                return f.read(length)
+
+    def active_month(self) -> Optional[str]:
+        # месяц первого заказа в текущем сегменте ("2026-10")
+        if not os.path.exists(self.active):
+            return None
+        with open(self.active, "rb") as f:
+            m = _segment_head_re.search(f.read(4096))
+        return m.group(2).decode()[:7] if m else None
+
+    def rotate(self) -> Optional[dict]:
+        # закрывает текущий сегмент; вызывается писателем журнала, пока файл не открыт
+        if not os.path.exists(self.active) or os.path.getsize(self.active) == 0:
+            return None
+        info = segment_info(self.active)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = f"orders-{info['first']:06d}-{info['last']:06d}.txt"
+        if os.path.exists(os.path.join(self.archive_dir, name)):
+            name = f"orders-{info['first']:06d}-{info['last']:06d}-{int(time.time())}.txt"
+        info["file"] = name
+        path = os.path.join(self.archive_dir, name)
+        segments = self.segments
+        os.replace(self.active, path)
+        _fsync_dir(path)
+        with self._lock:
+            segments.append(info)
+            self._save_manifest()
+        return info
+
+    def compress_closed(self) -> int:
+        # сжимает закрытые сегменты, которые ещё лежат как .txt; читатели до подмены видят .txt
+        done = 0
+        for seg in list(self.segments):
+            if seg["file"].endswith(".gz"):
+                continue
+            src = os.path.join(self.archive_dir, seg["file"])
+            members: List[List[int]] = []
+            pos = 0
+            with open(src, "rb") as fin, atomic_file(src + ".gz", "wb") as fout:
+                # независимые gzip-члены: чтение заказа распаковывает не больше GZ_MEMBER_BYTES
+                while chunk := fin.read(GZ_MEMBER_BYTES):
+                    members.append([pos, fout.tell()])
+                    fout.write(gzip.compress(chunk, compresslevel=6, mtime=0))
+                    pos += len(chunk)
+            with self._lock:
+                seg["file"] += ".gz"
+                seg["members"] = members
+                self._save_manifest()
+            os.remove(src)
+            done += 1
+        return done
+
+    def iter_blocks(self, first: Optional[int] = None, last: Optional[int] = None,
+                    since: str = "", until: str = ""):
+        # блоки заказов по порядку; читаются только сегменты, чей диапазон номеров/дат
+        # пересекается с запрошенным (since/until — даты "YYYY-MM-DD", until включительно)
+        for seg_id, path in self.paths():
+            if seg_id < len(self.segments):
+                seg = self.segments[seg_id]
+                if first is not None and seg["last"] < first or last is not None and seg["first"] > last:
+                    continue
+                if since and seg["to"] < since or until and seg["from"] > until:
+                    continue
+            elif not os.path.exists(path):
+                continue
+            for block in iter_order_blocks(path):
+                head, _, rest = block.lstrip("\n").partition("\n")
+                num = head[len("Заказ №"):].strip()
+                if first is not None or last is not None:
+                    if not num.isdigit():
+                        continue
+                    if first is not None and int(num) < first or last is not None and int(num) > last:
+                        continue
+                if since or until:
+                    day = rest[6:16] if rest.startswith("Дата: ") else ""
+                    if since and day < since or until and day > until:
+                        continue
+                yield block
+
+order_log = OrderLog(ORDERS_FILE, ORDERS_ARCHIVE_DIR)
+JOURNAL_ROTATE = object()  # метка в очереди журнала: закрыть сегмент перед следующими записями
+
+class OrderJournal:
+    # Заявки складываются в очередь, фоновая задача дописывает их в файл пачками.
+    # fsync делается раз в JOURNAL_FSYNC_INTERVAL секунд, после JOURNAL_FSYNC_BYTES байт
+    # или сразу, если кто-то ждёт подтверждения записи (durable=True).
+    # Когда сегмент дорос до JOURNAL_SEGMENT_BYTES или начался новый месяц, в очередь
+    # ставится метка ротации: писатель дописывает всё до неё, закрывает файл и отдаёт его OrderLog.
+
+    def __init__(self, log: OrderLog, fsync_interval: float = JOURNAL_FSYNC_INTERVAL,
+                 fsync_bytes: int = JOURNAL_FSYNC_BYTES, segment_bytes: int = JOURNAL_SEGMENT_BYTES,
+                 monthly: bool = JOURNAL_ROTATE_MONTHLY):
+        self.log = log
+        self.path = log.active
+        self.fsync_interval = fsync_interval
+        self.fsync_bytes = fsync_bytes
+        self.segment_bytes = segment_bytes
+        self.monthly = monthly
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._compress_task: Optional[asyncio.Task] = None
+        self._end: Optional[int] = None  # размер файла с учётом всего, что стоит в очереди
+        self._segment: Optional[int] = None  # номер сегмента, в который лягут новые записи
+        self._month: Optional[str] = None
+
+    def _ensure_started(self) -> None:
+        # очередь переживает упавшую задачу: новый писатель подхватит то, что в ней осталось
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def append(self, text: str, durable: bool = False) -> Tuple[asyncio.Future, int, int]:
+        # возвращает future записи, номер сегмента и смещение, с которого текст ляжет в файл
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        record = text + "\n" + ORDER_SEPARATOR + "\n"
+        if self._end is None:
+            self._end = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            self._segment = self.log.active_id
+            self._month = self.log.active_month()
+        month = datetime.now().strftime("%Y-%m")
+        if self._end and (self.segment_bytes and self._end >= self.segment_bytes
+                          or self.monthly and self._month is not None and self._month != month):
+            self._queue.put_nowait(JOURNAL_ROTATE)
+            self._segment += 1
+            self._end = 0
+            self._month = None
+        if self._month is None:
+            self._month = month
+        offset = self._end
+        self._end += len(record.encode("utf-8"))
+        self._queue.put_nowait((record, durable, fut))
+        return fut, self._segment, offset
+
+    @staticmethod
+    def _fail(futures, error: BaseException) -> None:
+        for fut in futures:
+            if not fut.done():
+                fut.set_exception(error)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        pending: List[asyncio.Future] = []
+        unsynced = 0
+        last_sync = loop.time()
+        f = None  # файл открывается при первой записи и заново после каждой ротации
+        try:
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0.0, last_sync + self.fsync_interval - loop.time())
+                try:
+                    batch = [await asyncio.wait_for(self._queue.get(), timeout)]
+                except asyncio.TimeoutError:
+                    batch = []
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                stop = None in batch
+                # пачка режется метками ротации: (записи до метки, нужна ли после них ротация)
+                groups: List[Tuple[list, bool]] = [([], False)]
+                for item in batch:
+                    if item is JOURNAL_ROTATE:
+                        groups[-1] = (groups[-1][0], True)
+                        groups.append(([], False))
+                    elif item is not None:
+                        groups[-1][0].append(item)
+                for items, rotate in groups:
+                    force = stop or rotate or any(durable for _, durable, _ in items)
+                    try:
+                        if items:
+                            if f is None:
+                                f = await aiofiles.open(self.path, "a", encoding="utf-8")
+                            chunk = "".join(text for text, _, _ in items)
+                            await f.write(chunk)
+                            unsynced += len(chunk.encode("utf-8"))
+                            pending.extend(fut for _, _, fut in items)
+                        if pending and (force or unsynced >= self.fsync_bytes
+                                        or loop.time() - last_sync >= self.fsync_interval):
+                            await f.flush()
+                            await _fsync(f.fileno())
+                            for fut in pending:
+                                if not fut.done():
+                                    fut.set_result(None)
+                            pending.clear()
+                            unsynced = 0
+                            last_sync = loop.time()
+                    except OSError as e:
+                        logging.exception("order journal write failed")
+                        self._end = None
+                        self._fail(pending, e)
+                        self._fail((fut for _, _, fut in items), e)
+                        pending.clear()
+                        unsynced = 0
+                    if rotate:
+                        if f is not None:
+                            try:
+                                await f.close()
+                            except OSError:
+                                logging.exception("order journal close failed")
+                            f = None
+                        try:
+                            info = await asyncio.to_thread(self.log.rotate)
+                            logging.info("order journal rotated: %s", info)
+                        except OSError:
+                            logging.exception("order journal rotation failed")
+                            self._end = None
+                        if self.log.compress:
+                            self._start_compress()
+                if stop:
+                    return
+        except BaseException as e:
+            # записанное, но не подтверждённое fsync отдаём с ошибкой; то, что ещё в очереди,
+            # допишет следующий писатель (_ensure_started оставляет очередь)
+            self._fail(pending, e if isinstance(e, Exception) else RuntimeError("order journal stopped"))
+            raise
+        finally:
+            if f is not None:
+                await f.close()
+
+    def _start_compress(self) -> None:
+        if self._compress_task is None or self._compress_task.done():
+            self._compress_task = asyncio.create_task(asyncio.to_thread(self.log.compress_closed))
+
+    async def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._queue.put_nowait(None)
+            await self._task
+        if self._compress_task is not None:
+            await asyncio.gather(self._compress_task, return_exceptions=True)
+
+order_journal = OrderJournal(order_log)
+
+async def append_order(text: str, durable: bool = False) -> None:
+    fut, segment, offset = order_journal.append(text, durable=durable)
+    order_index.add(text, segment, offset)
+    if durable:
+        await fut
 
 def user_ref(user: types.User) -> str:
     if user.username:
         return f"@{user.username} (id={user.id})"
     return f"{user.full_name} (id={user.id}, без username)"
 
-# ----------------- keyboards -----------------
+# ----------------- order store -----------------
+
+ORDERS_DB = os.getenv("ORDERS_DB", "orders.sqlite3")
+
+# подписи полей в тексте заявки -> ключи данных заказа
+ORDER_TEXT_FIELDS = {
+    "Дата": "created_at",
+    "Клиент": "client",
+    "Контакт": "contact",
+    "Услуга": "service",
+    "Размер": "size",
+    "Размер принта": "size",
+    "Бумага": "paper",
+    "Копий": "copies",
+    "Формат": "format",
+    "Цвет": "color",
+    "Печать": "duplex",
+    "Страницы": "pages",
+    "Документ": "doc_type",
+    "Количество": "qty",
+    "Источник": "source",
+    "Носитель": "media",
+    "На чём": "item",
+    "Макет": "has_layout",
+    "Задача": "task",
+    "Тип": "product_type",
+    "Тираж": "tirage",
+    "Дизайн": "need_design",
+    "Нельзя менять": "dont_change",
+    "Описание": "desc",
+    "Комментарий": "comment",
+    "Файлов": "files_count",
+}
+ORDER_INT_FIELDS = {"copies", "qty", "tirage", "files_count"}
+
+def parse_order_text(block: str) -> Optional[dict]:
+    order: dict = {}
+    for line in block.splitlines():
+        if line.startswith("Заказ №"):
+            # номер берём только из первой такой строки — заголовка блока
+            num = line[len("Заказ №"):].strip()
+            if num.isdigit() and "order_no" not in order:
+                order["order_no"] = int(num)
+            continue
+        label, sep, value = line.partition(": ")
+        key = ORDER_TEXT_FIELDS.get(label)
+        if not sep or key is None or key in order:
+            continue
+        value = value.strip()
+        if value == "-":
+            value = ""
+        if key in ORDER_INT_FIELDS and value.isdigit():
+            value = int(value)
+        order[key] = value
+    if "order_no" not in order:
+        return None
+    m = re.search(r"id=(\d+)", order.get("client", ""))
+    if m:
+        order["user_id"] = int(m.group(1))
+    return order
+
+def iter_order_blocks(path: str):
+    block: List[str] = []
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.rstrip("\n") == ORDER_SEPARATOR:
+                yield "".join(block)
+                block = []
+            else:
+                block.append(line)
+    if "".join(block).strip():
+        yield "".join(block)
+
+class OrderStore:
+    # Структурированная копия заявок в SQLite (WAL) с индексами по номеру, телефону,
+    # услуге и дате. Запросы к базе выполняются в пуле потоков, соединение одно.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    order_no   INTEGER PRIMARY KEY,
+                    created_at TEXT NOT NULL,
+                    phone      TEXT,
+                    service    TEXT,
+                    user_id    INTEGER,
+                    data       TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS orders_phone ON orders (phone, order_no);
+                CREATE INDEX IF NOT EXISTS orders_service ON orders (service, created_at);
+                CREATE INDEX IF NOT EXISTS orders_created ON orders (created_at);
+            """)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _row(order: dict) -> tuple:
+        phone = normalize_phone(str(order.get("contact") or "")) or order.get("contact") or None
+        return (
+            order["order_no"],
+            order.get("created_at") or now_str(),
+            phone,
+            order.get("service") or None,
+            order.get("user_id"),
+            json.dumps(order, ensure_ascii=False),
+        )
 
-start_kb = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="Создать заказ")]],
-    resize_keyboard=True
-)
+    def _execute(self, sql: str, params: tuple = ()) -> List[dict]:
+        with self._lock:
+            rows = self._db().execute(sql, params).fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def _write(self, db: sqlite3.Connection, orders: List[dict], replace: bool = True) -> int:
+        # без своей транзакции: вызывающий может дописать в неё и другие таблицы (см. Outbox.enqueue)
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        return db.executemany(
+            f"{verb} INTO orders (order_no, created_at, phone, service, user_id, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [self._row(o) for o in orders],
+        ).rowcount
+
+    def _insert(self, orders: List[dict], replace: bool = True) -> int:
+        with self._lock:
+            db = self._db()
+            with db:
+                return self._write(db, orders, replace)
+
+    async def get(self, order_no: int) -> Optional[dict]:
+        rows = await asyncio.to_thread(self._execute, "SELECT data FROM orders WHERE order_no = ?", (order_no,))
+        return rows[0] if rows else None
+
+    async def by_phone(self, phone: str) -> List[dict]:
+        phone = normalize_phone(phone) or phone
+        return await asyncio.to_thread(
+            self._execute, "SELECT data FROM orders WHERE phone = ? ORDER BY order_no", (phone,)
+        )
 
-services_kb = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton(text="Печать фото")],
-        [KeyboardButton(text="Печать документов")],
-        [KeyboardButton(text="Фото на документы")],
-        [KeyboardButton(text="Оцифровка")],
-        [KeyboardButton(text="Термопечать")],
-        [KeyboardButton(text="Реставрация фото")],
-        [KeyboardButton(text="Визитки/буклеты/наклейки")],
-        [KeyboardButton(text="Фотошоп")],
-        [KeyboardButton(text="Другое")],
-    ],
-    resize_keyboard=True
-)
+    async def by_date(self, since: str, until: str) -> List[dict]:
+        # границы — строки вида "2024-05-01" или "2024-05-01 12:00:00", until не включительно
+        return await asyncio.to_thread(
+            self._execute,
+            "SELECT data FROM orders WHERE created_at >= ? AND created_at < ? ORDER BY created_at",
+            (since, until),
+        )
 
-confirm_kb = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="✅ Отправить"), KeyboardButton(text="↩️ Начать заново")]],
-    resize_keyboard=True
-)
+    async def by_service(self, service: str, since: str = "", until: str = "9999") -> List[dict]:
+        return await asyncio.to_thread(
+            self._execute,
+            "SELECT data FROM orders WHERE service = ? AND created_at >= ? AND created_at < ? "
+            "ORDER BY created_at",
+            (service, since, until),
+        )
 
-done_kb = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="ГОТОВО")]],
-    resize_keyboard=True
-)
+    def _recent_keys(self, since: str) -> List[Tuple[int, str, Optional[str], Optional[int]]]:
+        with self._lock:
+            return [tuple(row) for row in self._db().execute(
+                "SELECT order_no, created_at, json_extract(data, '$.draft_id'), json_extract(data, '$.update_id') "
+                "FROM orders WHERE created_at >= ?", (since,))]
+
+    async def recent_keys(self, since: str) -> List[Tuple[int, str, Optional[str], Optional[int]]]:
+        # (номер, дата, draft_id, update_id) заказов начиная с since — для индекса повторов
+        return await asyncio.to_thread(self._recent_keys, since)
+
+    def _import_text(self, log: "OrderLog") -> int:
+        with self._lock:
+            if self._db().execute("SELECT 1 FROM orders LIMIT 1").fetchone():
+                return 0
+        imported = 0
+        batch: List[dict] = []
+        for block in log.iter_blocks():
+            order = parse_order_text(block)
+            if order is None:
+                continue
+            batch.append(order)
+            if len(batch) >= 1000:
+                imported += self._insert(batch, replace=False)
+                batch = []
+        if batch:
+            imported += self._insert(batch, replace=False)
+        return imported
+
+    async def import_text_once(self, log: "OrderLog") -> int:
+        # разовый перенос старого журнала (всех сегментов): выполняется, только пока база пустая
+        return await asyncio.to_thread(self._import_text, log)
+
+    async def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+order_store = OrderStore(ORDERS_DB)
+
+# ----------------- order index -----------------
+
+ORDER_BLOCK_END = ("\n" + ORDER_SEPARATOR + "\n").encode("utf-8")
+INDEX_STOP_WORDS = frozenset({"id", "без", "username"})
+_word_re = re.compile(r"\w+")
+
+def order_tokens(block: str) -> set:
+    # слова из значений полей (без подписей и даты), телефон и его последние 4 цифры
+    tokens = set()
+    for line in block.splitlines():
+        label, sep, value = line.partition(": ")
+        if not sep or label == "Дата":
+            continue
+        tokens.update(_word_re.findall(value.lower()))
+        if label == "Контакт":
+            phone = normalize_phone(value)
+            if phone:
+                tokens.update((phone, phone[-4:]))
+    return tokens - INDEX_STOP_WORDS
+
+def query_tokens(query: str) -> List[str]:
+    phone = normalize_phone(query)
+    if phone:
+        return [phone]
+    return [t for t in _word_re.findall(query.lower()) if t not in INDEX_STOP_WORDS]
+
+def sorted_contains(lst: List[int], value: int) -> bool:
+    i = bisect.bisect_left(lst, value)
+    return i < len(lst) and lst[i] == value
+
+class OrderIndex:
+    # Индекс по журналу заказов в памяти: номер заказа -> (сегмент, смещение, длина) блока,
+    # день -> номера заказов, слово/телефон -> номера заказов. При старте строится одним
+    # проходом по сегментам (текущий — через mmap), дальше пополняется из append_order.
+
+    def __init__(self, log: OrderLog):
+        self.log = log
+        self.locations: Dict[int, Tuple[int, int, int]] = {}
+        self.by_day: Dict[str, List[int]] = {}
+        self.postings: Dict[str, List[int]] = {}
+
+    def _add(self, block: str, segment: int, offset: int, length: int) -> None:
+        head, _, rest = block.partition("\n")
+        num = head[len("Заказ №"):].strip() if head.startswith("Заказ №") else ""
+        if not num.isdigit():
+            return
+        order_no = int(num)
+        self.locations[order_no] = (segment, offset, length)
+        if rest.startswith("Дата: "):
+            self.by_day.setdefault(rest[6:16], []).append(order_no)
+        postings = self.postings
+        for token in order_tokens(rest):
+            lst = postings.get(token)
+            if lst is None:
+                postings[token] = [order_no]
+            elif lst[-1] < order_no:
+                lst.append(order_no)
+            elif not sorted_contains(lst, order_no):
+                bisect.insort(lst, order_no)  # заказы дописываются почти по порядку номеров
+
+    def add(self, text: str, segment: int, offset: int) -> None:
+        self._add(text, segment, offset, len(text.encode("utf-8")))
+
+    def _scan(self, data, segment: int) -> None:
+        pos, size = 0, len(data)
+        while pos < size:
+            end = data.find(ORDER_BLOCK_END, pos)
+            if end < 0:
+                end = size
+            self._add(data[pos:end].decode("utf-8", "replace").lstrip("\n"), segment, pos, end - pos)
+            pos = end + len(ORDER_BLOCK_END)
+
+    def build(self) -> int:
+        self.locations, self.by_day, self.postings = {}, {}, {}
+        for segment, path in self.log.paths():
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                continue
+            if path.endswith(".gz"):
+                self._scan(read_segment_bytes(path), segment)
+                continue
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self._scan(mm, segment)
+        return len(self.locations)
+
+    def search(self, query: str, limit: int = 10) -> List[int]:
+        # номера заказов, где есть все слова запроса, от новых к старым; списки отсортированы,
+        # поэтому идём с конца самого короткого и проверяем остальные бинарным поиском
+        lists = [self.postings.get(t) for t in query_tokens(query)]
+        if not lists or any(not lst for lst in lists):
+            return []
+        lists.sort(key=len)
+        found: List[int] = []
+        for order_no in reversed(lists[0]):
+            if all(sorted_contains(lst, order_no) for lst in lists[1:]):
+                found.append(order_no)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def today(self) -> List[int]:
+        return self.by_day.get(datetime.now().strftime("%Y-%m-%d"), [])
+
+    def read(self, order_no: int) -> Optional[str]:
+        loc = self.locations.get(order_no)
+        if loc is None:
+            return None
+        try:
+            block = self.log.read(*loc).decode("utf-8", "replace").lstrip("\n")
+        except FileNotFoundError:  # сегмент как раз пережимается в .gz
+            block = self.log.read(*loc).decode("utf-8", "replace").lstrip("\n")
+        # запись могла ещё не дойти до файла или файл подменили — тогда не отвечаем мусором
+        return block if block.startswith(f"Заказ №{order_no}\n") else None
+
+order_index = OrderIndex(order_log)
+
+# ----------------- stats -----------------
+
+STATS_FILE = "stats.json"
+STATS_SAVE_DELAY = float(os.getenv("STATS_SAVE_DELAY", "30"))
+STATS_KEEP_HOURS = 14 * 24
+STATS_KEEP_DAYS = 400
+STATS_UNIT_FIELDS = ("copies", "qty", "tirage")  # что считается «штуками» для услуги
+
+def stats_keys(created_at: str) -> Tuple[str, str, str]:
+    # "2026-10-18 07:32:59" -> час "2026-10-18 07", день "2026-10-18", неделя "2026-W42"
+    day = created_at[:10]
+    year, week, _ = datetime.strptime(day, "%Y-%m-%d").isocalendar()
+    return created_at[:13], day, f"{year}-W{week:02d}"
+
+class OrderStats:
+    # Счётчики по часам, дням и ISO-неделям: заказы, файлы, копии (поле copies) и по каждой
+    # услуге [заказов, штук]. Каждый заказ обновляет три корзины; снимок пишется в STATS_FILE
+    # не чаще раза в STATS_SAVE_DELAY, после рестарта догоняются заказы новее снимка.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.buckets: Dict[str, Dict[str, dict]] = {"hour": {}, "day": {}, "week": {}}
+        self.last_order_no = 0
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+
+    def add(self, order: Mapping[str, Any]) -> None:
+        created_at = order.get("created_at") or now_str()
+        service = order.get("service") or "-"
+        units = next((v for k in STATS_UNIT_FIELDS if isinstance(v := order.get(k), int)), 1)
+        copies = order.get("copies") if isinstance(order.get("copies"), int) else 0
+        files = order.get("files_count") or 0
+        for kind, key in zip(("hour", "day", "week"), stats_keys(created_at)):
+            b = self.buckets[kind].get(key)
+            if b is None:
+                b = self.buckets[kind][key] = {"orders": 0, "files": 0, "copies": 0, "svc": {}}
+            b["orders"] += 1
+            b["files"] += files
+            b["copies"] += copies
+            svc = b["svc"].setdefault(service, [0, 0])
+            svc[0] += 1
+            svc[1] += units
+        self.last_order_no = max(self.last_order_no, order.get("order_no") or 0)
+        self._schedule_save()
+
+    def _schedule_save(self) -> None:
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._save_handle = loop.call_later(STATS_SAVE_DELAY, lambda: asyncio.ensure_future(self.save()))
+
+    def _prune(self) -> None:
+        now = datetime.now()
+        hour_min = (now - timedelta(hours=STATS_KEEP_HOURS)).strftime("%Y-%m-%d %H")
+        day_min = (now - timedelta(days=STATS_KEEP_DAYS)).strftime("%Y-%m-%d")
+        for kind, oldest in (("hour", hour_min), ("day", day_min)):
+            bucket = self.buckets[kind]
+            for key in [k for k in bucket if k < oldest]:
+                del bucket[key]
+
+    def _snapshot(self) -> str:
+        self._prune()
+        return json.dumps({"v": 1, "last_order_no": self.last_order_no, **self.buckets},
+                          ensure_ascii=False, separators=(",", ":"))
+
+    async def save(self) -> None:
+        self._save_handle = None
+        try:
+            await asyncio.to_thread(_write_file_atomic, self.path, self._snapshot())
+        except OSError:
+            logging.exception("stats snapshot failed")
+
+    def load(self, log: "OrderLog") -> int:
+        # снимок + заказы журнала, которых в снимке нет; без снимка — полный пересчёт один раз.
+        # Журнал читается потоком: старые сегменты вне диапазона номеров не открываются
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+            self.last_order_no = snap.get("last_order_no", 0)
+            self.buckets = {kind: snap.get(kind, {}) for kind in ("hour", "day", "week")}
+        added = 0
+        for block in log.iter_blocks(first=self.last_order_no + 1):
+            order = parse_order_text(block)
+            if order is not None:
+                self.add(order)
+                added += 1
+        return added
+
+    def merged(self, kind: str, keys: List[str]) -> dict:
+        total = {"orders": 0, "files": 0, "copies": 0, "svc": {}}
+        for key in keys:
+            b = self.buckets[kind].get(key)
+            if b is None:
+                continue
+            for field_name in ("orders", "files", "copies"):
+                total[field_name] += b[field_name]
+            for name, (orders, units) in b["svc"].items():
+                svc = total["svc"].setdefault(name, [0, 0])
+                svc[0] += orders
+                svc[1] += units
+        return total
+
+    def peak_hours(self, days: int = 7, top: int = 3) -> List[Tuple[int, int]]:
+        # (час суток, заказов) за последние days дней, по убыванию
+        since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H")
+        by_hour = [0] * 24
+        for key, b in self.buckets["hour"].items():
+            if key >= since:
+                by_hour[int(key[11:13])] += b["orders"]
+        ranked = sorted(((h, n) for h, n in enumerate(by_hour) if n), key=lambda x: -x[1])
+        return ranked[:top]
+
+    async def close(self) -> None:
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+        await self.save()
+
+order_stats = OrderStats(STATS_FILE)
+
+# ----------------- FSM storage -----------------
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # sqlite | memory
+FSM_DB = os.getenv("FSM_DB", "fsm.sqlite3")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_SESSION_TTL = float(os.getenv("FSM_SESSION_TTL", str(3 * 24 * 3600)))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+
+@dataclass
+class FSMRecord:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    touched: float = 0.0
+
+class SQLiteStorage(BaseStorage):
+    # Состояния визардов переживают перезапуск. Чтение идёт из LRU-кэша в памяти
+    # (в базу только при промахе), изменения копятся и пишутся одной транзакцией
+    # раз в FSM_FLUSH_INTERVAL. Сессии, не трогавшиеся дольше FSM_SESSION_TTL, удаляются.
+
+    def __init__(self, path: str, cache_size: int = FSM_CACHE_SIZE,
+                 ttl: float = FSM_SESSION_TTL, flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.path = path
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True,
+                                             with_destiny=True)
+        self._cache: "OrderedDict[str, FSMRecord]" = OrderedDict()
+        self._dirty: Dict[str, FSMRecord] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_sweep = time.time()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key     TEXT PRIMARY KEY,
+                    state   TEXT,
+                    data    TEXT NOT NULL,
+                    touched REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS fsm_touched ON fsm (touched)")
+            self._conn = conn
+        return self._conn
+
+    def _load(self, k: str) -> FSMRecord:
+        with self._lock:
+            row = self._db().execute("SELECT state, data, touched FROM fsm WHERE key = ?", (k,)).fetchone()
+        if row is None or row[2] < time.time() - self.ttl:
+            return FSMRecord(touched=time.time())
+        return FSMRecord(state=row[0], data=json.loads(row[1]), touched=row[2])
+
+    async def _record(self, key: StorageKey) -> Tuple[str, FSMRecord]:
+        k = self.key_builder.build(key)
+        rec = self._cache.get(k)
+        if rec is not None:
+            self._cache.move_to_end(k)
+            return k, rec
+        rec = self._dirty.get(k)
+        if rec is None:
+            rec = await asyncio.to_thread(self._load, k)
+            # пока читали, запись могла появиться из параллельного апдейта
+            rec = self._cache.get(k) or self._dirty.get(k) or rec
+        self._cache[k] = rec
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)  # грязные записи остаются в _dirty до сброса
+        return k, rec
+
+    def _touch(self, k: str, rec: FSMRecord) -> None:
+        rec.touched = time.time()
+        self._dirty[k] = rec
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, rec = await self._record(key)
+        rec.state = state.state if isinstance(state, State) else state
+        self._touch(k, rec)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, rec = await self._record(key)
+        return rec.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        k, rec = await self._record(key)
+        rec.data = data.copy()
+        self._touch(k, rec)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, rec = await self._record(key)
+        return rec.data.copy()
+
+    async def set_record(self, key: StorageKey, state: StateType, data: Mapping[str, Any]) -> None:
+        # state и data одним вызовом — для StateTransaction.commit()
+        k, rec = await self._record(key)
+        rec.state = state.state if isinstance(state, State) else state
+        rec.data = dict(data)
+        self._touch(k, rec)
+
+    def _write(self, upserts: List[tuple], deletes: List[tuple], expire_before: Optional[float]) -> None:
+        with self._lock:
+            db = self._db()
+            with db:
+                if upserts:
+                    db.executemany("INSERT OR REPLACE INTO fsm (key, state, data, touched) VALUES (?, ?, ?, ?)",
+                                   upserts)
+                if deletes:
+                    db.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+                if expire_before is not None:
+                    db.execute("DELETE FROM fsm WHERE touched < ?", (expire_before,))
+
+    def _expire_cache(self, now: float) -> Optional[float]:
+        if now - self._last_sweep < min(self.ttl, 600.0):
+            return None
+        self._last_sweep = now
+        expire_before = now - self.ttl
+        # в OrderedDict записи идут от давно использованных к свежим
+        while self._cache:
+            k, rec = next(iter(self._cache.items()))
+            if rec.touched >= expire_before:
+                break
+            del self._cache[k]
+        return expire_before
+
+    async def flush(self) -> None:
+        dirty, self._dirty = self._dirty, {}
+        upserts, deletes = [], []
+        for k, rec in dirty.items():
+            if rec.state is None and not rec.data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, rec.state, json.dumps(rec.data, ensure_ascii=False), rec.touched))
+        expire_before = self._expire_cache(time.time())
+        if upserts or deletes or expire_before is not None:
+            try:
+                await asyncio.to_thread(self._write, upserts, deletes, expire_before)
+            except sqlite3.Error:
+                logging.exception("FSM storage flush failed")
+                for k, rec in dirty.items():
+                    self._dirty.setdefault(k, rec)
+
+    async def _flush_loop(self) -> None:
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(FSM_DB)
+
+# ----------------- update lanes -----------------
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))  # апдейтов разных чатов одновременно
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "0.5"))  # сек тишины, после которых альбом считается полным
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        # запрос дороже ёмкости ждёт полной корзины и уводит её в минус — следующие подождут
+        need = min(tokens, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= need:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((need - self.tokens) / self.rate)
+
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "3"))  # апдейтов в секунду от одного чата, сверх — ждут в его очереди
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "20"))
+GLOBAL_RATE = float(os.getenv("GLOBAL_RATE", "300"))  # апдейтов в секунду на весь бот
+GLOBAL_BURST = int(os.getenv("GLOBAL_BURST", "600"))
+LANE_DEPTH = int(os.getenv("LANE_DEPTH", "30"))  # апдейтов одного чата в очереди; лишние отбрасываются
+LANE_FILES_DEPTH = int(os.getenv("LANE_FILES_DEPTH", "300"))  # то же для фото/файлов на шаге загрузки файлов
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", "2000"))  # апдейтов в очереди всего
+CONFIRM_REPEAT_WINDOW = float(os.getenv("CONFIRM_REPEAT_WINDOW", "5"))
+CONFIRM_STALE = float(os.getenv("CONFIRM_STALE", "60"))  # подтверждение «в работе» дольше — считаем зависшим
+FLOOD_NOTICE_INTERVAL = 30.0
+FLOOD_TRACKED = 10_000  # сколько чатов держать в памяти, прежде чем чистить простаивающие
+FLOOD_PRUNE_INTERVAL = 60.0  # и как часто чистить их в любом случае
+CONFIRM_TEXT = "✅ Отправить"
+SHED_NOTICES = {  # что сказать клиенту, чей апдейт отброшен; не чаще раза в FLOOD_NOTICE_INTERVAL
+    "lane_full": "Слишком много сообщений подряд, часть пропущена. Подождите немного и продолжите.",
+    "saturated": "Бот сейчас перегружен, сообщение не обработано. Подождите немного и повторите.",
+}
+
+class UpdateThrottle:
+    # Решает до очереди чата, пускать ли апдейт:
+    # - повторное «✅ Отправить» в той же FSM-сессии (пока первое в работе или сразу после) — отбрасываем;
+    # - очередь чата длиннее LANE_DEPTH — отбрасываем (флудит только сам себе); фото и файлы
+    #   на шаге загрузки файлов — это заказ, а не флуд: им очередь до LANE_FILES_DEPTH;
+    # - общая очередь апдейтов переполнена — отбрасываем всё, кроме подтверждений заказа.
+    #   Очередь outbox сюда не входит: если чат админа недоступен, клиенты всё равно оформляют
+    #   заказы, а уведомления копятся в таблице outbox до его возвращения.
+    # Скорость чата и бота ограничивается корзинами токенов уже в очереди чата: лишние апдейты
+    # ждут, а не теряются, и ждёт только тот, кто шлёт слишком часто.
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._buckets: Dict[int, TokenBucket] = {}
+        # StorageKey FSM-сессии -> когда началось подтверждение, которое ещё в работе, и когда
+        # закончилось оформившее заказ; по ключу FSM, а не по чату: в группе у каждого участника
+        # свой черновик и своё «Отправить»
+        self._confirming: Dict[Any, float] = {}
+        self._confirms: Dict[Any, float] = {}
+        self._noticed: Dict[int, float] = {}
+        self._pruned = time.monotonic()
+
+    def saturated(self, backlog: int) -> bool:
+        return backlog >= UPDATE_BACKLOG
+
+    def admit(self, key: int, session: Any, text: Optional[str], lane_depth: int, backlog: int,
+              depth_limit: int = LANE_DEPTH) -> Optional[str]:
+        # причина отказа или None; session — ключ FSM-сессии, нужен только для подтверждений
+        now = time.monotonic()
+        if now - self._pruned >= FLOOD_PRUNE_INTERVAL:
+            self._prune()
+        if key == ADMIN_ID:
+            return None
+        if text == CONFIRM_TEXT and session is not None:
+            started = self._confirming.get(session)
+            if started is not None and now - started < CONFIRM_STALE:
+                return "confirm_repeat"
+            done = self._confirms.get(session)
+            if done is not None and now - done < CONFIRM_REPEAT_WINDOW:
+                return "confirm_repeat"
+            self._confirming[session] = now
+            return None
+        if lane_depth >= depth_limit:
+            return "lane_full"
+        if self.saturated(backlog):
+            return "saturated"
+        return None
+
+    def confirmed(self, session: Any) -> None:
+        # заказ по этой сессии оформлен: повторные нажатия в ближайшие секунды — дубли
+        self._confirming.pop(session, None)
+        self._confirms[session] = time.monotonic()
+
+    def confirm_done(self, session: Any) -> None:
+        # подтверждение, не оформившее заказ (не тот шаг, ошибка), повторять можно сразу
+        self._confirming.pop(session, None)
+
+    async def wait(self, key: int) -> None:
+        if key == ADMIN_ID:
+            return
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= FLOOD_TRACKED:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(FLOOD_RATE, FLOOD_BURST)
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+
+    def _prune(self) -> None:
+        now = self._pruned = time.monotonic()
+        for key, bucket in list(self._buckets.items()):
+            bucket._refill()
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[key]
+        for key, started in list(self._confirming.items()):
+            if now - started >= CONFIRM_STALE:
+                del self._confirming[key]
+        for key, done in list(self._confirms.items()):
+            if now - done >= CONFIRM_REPEAT_WINDOW:
+                del self._confirms[key]
+        for key, at in list(self._noticed.items()):
+            if now - at >= FLOOD_NOTICE_INTERVAL:
+                del self._noticed[key]
+
+    def should_notice(self, key: int) -> bool:
+        now = time.monotonic()
+        if now - self._noticed.get(key, float("-inf")) < FLOOD_NOTICE_INTERVAL:
+            return False
+        self._noticed[key] = now
+        return True
+
+def update_lane_key(update: types.Update) -> Optional[int]:
+    try:
+        event = update.event
+    except LookupError:  # апдейт неизвестного типа
+        return None
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else None
+
+@dataclass(slots=True)
+class Album:
+    messages: List[types.Message]
+    last: float  # когда пришла последняя часть (loop.time())
+
+class OrderedDispatcher(Dispatcher):
+    # Апдейты одного чата обрабатываются строго по очереди: FSM читает состояние только после
+    # того, как предыдущий апдейт его записал. Разные чаты идут параллельно, но не больше
+    # UPDATE_CONCURRENCY сразу. Очередь стоит перед всеми middleware, поэтому и polling,
+    # и вебхук проходят через неё. Альбом собирается до очереди: части альбома не ждут в ней,
+    # а дописываются к первой, и та идёт в хендлер со списком album.
+
+    def __init__(self, *args, concurrency: int = UPDATE_CONCURRENCY, album_window: float = ALBUM_WINDOW,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.album_window = album_window
+        self._slots = asyncio.Semaphore(concurrency)
+        self._lanes: Dict[int, List[Any]] = {}  # ключ -> [Lock, апдейтов в очереди и в работе]
+        self._queued = 0  # сумма счётчиков всех очередей; меняется вместе с ними
+        self._albums: Dict[Tuple[int, str], Album] = {}
+        self.throttle = UpdateThrottle()
+
+    @property
+    def lanes(self) -> int:
+        return len(self._lanes)
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def session_key(self, bot: Bot, update: types.Update) -> Optional[StorageKey]:
+        # тот же ключ, под которым FSMContextMiddleware найдёт состояние этого апдейта
+        ctx = UserContextMiddleware.resolve_event_context(update)
+        context = self.fsm.resolve_context(bot=bot, chat_id=ctx.chat_id, user_id=ctx.user_id,
+                                           thread_id=ctx.thread_id,
+                                           business_connection_id=ctx.business_connection_id)
+        return context.key if context is not None else None
+
+    async def _collecting_files(self, bot: Bot, update: types.Update) -> bool:
+        # клиент на шаге «пришлите файлы»; читается только при переполненной очереди чата
+        session = self.session_key(bot, update)
+        if session is None:
+            return False
+        step = FLOW_STEPS.get(await self.fsm.storage.get_state(session))
+        return step is not None and step.kind == "files"
+
+    async def _collect_album(self, key: Tuple[int, str], album: Album) -> List[types.Message]:
+        loop = asyncio.get_running_loop()
+        try:
+            while (delay := album.last + self.album_window - loop.time()) > 0:
+                await asyncio.sleep(delay)
+        finally:
+            del self._albums[key]
+        return sorted(album.messages, key=lambda m: m.message_id)
+
+    async def feed_update(self, bot: Bot, update: types.Update, **kwargs: Any) -> Any:
+        key = update_lane_key(update)
+        if key is None:
+            return await super().feed_update(bot, update, **kwargs)
+        album = None
+        message = update.message
+        if message is not None and message.media_group_id is not None:
+            album_key = (key, message.media_group_id)
+            album = self._albums.get(album_key)
+            if album is not None:
+                album.messages.append(message)
+                album.last = asyncio.get_running_loop().time()
+                return None
+        lane = self._lanes.get(key)
+        text = message.text if message is not None else None
+        session = self.session_key(bot, update) if text == CONFIRM_TEXT else None
+        depth = lane[1] if lane else 0
+        depth_limit = LANE_DEPTH
+        if (depth >= LANE_DEPTH and message is not None and (message.photo or message.document)
+                and await self._collecting_files(bot, update)):
+            depth_limit = LANE_FILES_DEPTH  # файлы ждут в очереди чата по его корзине токенов
+        reason = self.throttle.admit(key, session, text, depth, self.queued, depth_limit)
+        if reason is not None:
+            metrics.inc("bot_updates_shed_total", (("reason", reason),))
+            notice = SHED_NOTICES.get(reason)
+            if notice is not None and self.throttle.should_notice(key):
+                with suppress(Exception):
+                    await bot.send_message(key, notice)
+            return None
+        if message is not None and message.media_group_id is not None:
+            album = self._albums[album_key] = Album([message], asyncio.get_running_loop().time())
+        if lane is None:
+            lane = self._lanes[key] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        self._queued += 1
+        try:
+            async with lane[0]:
+                if album is not None:
+                    kwargs["album"] = await self._collect_album(album_key, album)
+                await self.throttle.wait(key)
+                async with self._slots:
+                    return await super().feed_update(bot, update, **kwargs)
+        finally:
+            lane[1] -= 1
+            self._queued -= 1
+            if not lane[1]:
+                del self._lanes[key]
+            if session is not None:
+                self.throttle.confirm_done(session)
+
+dp = OrderedDispatcher(storage=make_fsm_storage())
+
+class StateTransaction(FSMContext):
+    # Контекст на время одного апдейта: данные читаются из хранилища один раз (лениво),
+    # все изменения state/data копятся в памяти и записываются в commit(). Если хендлер
+    # упал, commit не вызывается — в хранилище остаётся состояние до апдейта.
+
+    def __init__(self, context: FSMContext, raw_state: Optional[str]):
+        super().__init__(storage=context.storage, key=context.key)
+        self._state = raw_state
+        self._data: Optional[Dict[str, Any]] = None
+        self._state_dirty = False
+        self._data_dirty = False
+        self.direct_ops = 0
+        self.storage_ops = 0
+
+    async def _loaded(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+            self.storage_ops += 1
+        return self._data
+
+    async def set_state(self, state: StateType = None) -> None:
+        self.direct_ops += 1
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_state(self) -> Optional[str]:
+        self.direct_ops += 1
+        return self._state
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        self.direct_ops += 1
+        self._data = dict(data)
+        self._data_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        self.direct_ops += 1
+        return (await self._loaded()).copy()
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        self.direct_ops += 1
+        return (await self._loaded()).get(key, default)
+
+    async def update_data(self, data: Optional[Mapping[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        self.direct_ops += 2  # get_data + set_data
+        if data:
+            kwargs.update(data)
+        current = await self._loaded()
+        current.update(kwargs)
+        self._data_dirty = True
+        return current.copy()
+
+    async def clear(self) -> None:
+        self.direct_ops += 2  # set_state + set_data
+        self._state = None
+        self._data = {}
+        self._state_dirty = self._data_dirty = True
+
+    async def commit(self) -> None:
+        set_record = getattr(self.storage, "set_record", None)
+        if self._state_dirty and self._data_dirty and set_record is not None:
+            await set_record(key=self.key, state=self._state, data=self._data)
+            self.storage_ops += 1
+            self._state_dirty = self._data_dirty = False
+        if self._state_dirty:
+            await self.storage.set_state(key=self.key, state=self._state)
+            self.storage_ops += 1
+            self._state_dirty = False
+        if self._data_dirty:
+            await self.storage.set_data(key=self.key, data=self._data)
+            self.storage_ops += 1
+            self._data_dirty = False
+
+class StateTransactionMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+        txn = StateTransaction(context, data.get("raw_state"))
+        data["state"] = txn
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            metrics.inc("bot_fsm_rollbacks_total")
+            raise
+        else:
+            await txn.commit()
+        finally:
+            # счётчики экономии: во сколько обращений к хранилищу обошлись бы вызовы хендлеров
+            # напрямую и сколько их реально было; +1 в обоих — чтение raw_state в FSMContextMiddleware
+            metrics.inc("bot_fsm_updates_total")
+            metrics.inc("bot_fsm_direct_ops_total", value=txn.direct_ops + 1)
+            metrics.inc("bot_fsm_storage_ops_total", value=txn.storage_ops + 1)
+        return result
+
+# ----------------- text dispatch -----------------
+
+def _filter_texts(handler: HandlerObject) -> Optional[FrozenSet[str]]:
+    # F.text == "..." или F.text.in_({...}) -> множество текстов, иначе None
+    for flt in handler.filters or ():
+        ops = getattr(flt.magic, "_operations", ()) if flt.magic is not None else ()
+        if len(ops) != 2 or not isinstance(ops[0], GetAttributeOperation) or ops[0].name != "text":
+            continue
+        op = ops[1]
+        if isinstance(op, ComparatorOperation) and op.comparator is operator.eq and isinstance(op.right, str):
+            return frozenset([op.right])
+        if (isinstance(op, FunctionOperation) and op.function is in_op and len(op.args) == 1
+                and isinstance(op.args[0], (dict, set, frozenset))):
+            return frozenset(t for t in op.args[0] if isinstance(t, str))
+    return None
 
-skip_kb = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="ПРОПУСТИТЬ")]],
-    resize_keyboard=True
-)
+def _filter_states(handler: HandlerObject) -> Optional[FrozenSet[Optional[str]]]:
+    # фильтр состояния (State или StateFilter) -> множество raw_state, иначе None
+    for flt in handler.filters or ():
+        cb = flt.callback
+        states = cb.states if isinstance(cb, StateFilter) else (cb,) if isinstance(cb, State) else None
+        if states is None:
+            continue
+        raw = set()
+        for st in states:
+            st = st.state if isinstance(st, State) else st
+            if st == "*":
+                return None
+            raw.add(st)
+        return frozenset(raw)
+    return None
 
-done_or_skip_kb = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="ГОТОВО"), KeyboardButton(text="ПРОПУСТИТЬ")]],
-    resize_keyboard=True
-)
+class TextIndexObserver(TelegramEventObserver):
+    # Хендлеры с фильтром точного текста (кнопки меню) разложены по ключу (состояние, текст),
+    # поэтому апдейт проверяется только против тех хендлеров, которые вообще могут сработать:
+    # подходящих по ключу и хендлеров с произвольными фильтрами, в исходном порядке регистрации.
+    # Сами фильтры по-прежнему проверяются, индекс лишь отсекает заведомые промахи.
+    # Контейнер в F.text.in_(...) не должен меняться после регистрации.
+
+    def __init__(self, router, event_name: str):
+        super().__init__(router=router, event_name=event_name)
+        self._keys: List[Tuple[Optional[FrozenSet[Optional[str]]], Optional[FrozenSet[str]]]] = []
+        self._texts: FrozenSet[str] = frozenset()
+        self._plans: Dict[Tuple[Optional[str], Optional[str]], List[HandlerObject]] = {}
+
+    def register(self, callback, *filters, flags=None, **kwargs):
+        result = super().register(callback, *filters, flags=flags, **kwargs)
+        handler = self.handlers[-1]
+        texts = _filter_texts(handler)
+        self._keys.append((_filter_states(handler), texts))
+        if texts:
+            self._texts |= texts
+        self._plans.clear()
+        return result
+
+    @property
+    def indexed_texts(self) -> FrozenSet[str]:
+        return self._texts
+
+    def plan(self, raw_state: Optional[str], text: Optional[str]) -> List[HandlerObject]:
+        # текст вне индекса ни одному текстовому хендлеру не подходит -> общий ключ (state, None)
+        if text not in self._texts:
+            text = None
+        plan = self._plans.get((raw_state, text))
+        if plan is None:
+            plan = [h for h, (states, texts) in zip(self.handlers, self._keys)
+                    if (states is None or raw_state in states) and (texts is None or text in texts)]
+            self._plans[(raw_state, text)] = plan
+        return plan
+
+    async def trigger(self, event, **kwargs):
+        for handler in self.plan(kwargs.get("raw_state"), getattr(event, "text", None)):
+            kwargs["handler"] = handler
+            result, data = await handler.check(event, **kwargs)
+            if result:
+                kwargs.update(data)
+                try:
+                    wrapped_inner = self.outer_middleware.wrap_middlewares(
+                        self._resolve_middlewares(),
+                        handler.call,
+                    )
+                    return await wrapped_inner(event, kwargs)
+                except SkipHandler:
+                    continue
+        return UNHANDLED
+
+dp.message = dp.observers["message"] = TextIndexObserver(router=dp, event_name="message")
+
+# ----------------- metrics -----------------
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — HTTP-эндпоинт выключен, /perf работает всегда
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        # верхняя граница корзины, в которую попадает квантиль
+        rank = q * self.count
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if c and acc >= rank:
+                return METRICS_BUCKETS[i] if i < len(METRICS_BUCKETS) else float("inf")
+        return 0.0
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def prom_labels(labels: Labels, le: Optional[str] = None) -> str:
+    parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels]
+    if le is not None:
+        parts.append('le="%s"' % le)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metrics:
+    # Гистограммы и счётчики в памяти процесса; на запись — bisect и пара словарных операций.
+    # Текстовый формат Prometheus собирается только по запросу.
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.in_flight = 0
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {"bot_updates_in_flight": lambda: self.in_flight}
+        self.help: Dict[str, str] = {}
+
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        family = self.histograms.setdefault(name, {})
+        hist = family.get(labels)
+        if hist is None:
+            hist = family[labels] = Histogram()
+        hist.observe(value)
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        family = self.counters.setdefault(name, {})
+        family[labels] = family.get(labels, 0) + value
+
+    def gauge(self, name: str, read: Callable[[], float], help_text: str = "") -> None:
+        self.gauges[name] = read
+        if help_text:
+            self.help[name] = help_text
+
+    def total(self, name: str) -> float:
+        return sum(self.counters.get(name, {}).values())
+
+    def rows(self, name: str) -> List[Tuple[str, Histogram]]:
+        # (значение единственной метки, гистограмма) — для /perf
+        return [(labels[0][1] if labels else "", hist) for labels, hist in self.histograms.get(name, {}).items()]
+
+    def render(self) -> str:
+        out: List[str] = []
+        for name, family in sorted(self.histograms.items()):
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} histogram")
+            for labels, hist in sorted(family.items()):
+                acc = 0
+                for bound, c in zip(METRICS_BUCKETS + (float("inf"),), hist.counts):
+                    acc += c
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    out.append(f"{name}_bucket{prom_labels(labels, le)} {acc}")
+                out.append(f"{name}_sum{prom_labels(labels)} {hist.sum:.6f}")
+                out.append(f"{name}_count{prom_labels(labels)} {acc}")
+        for name, family in sorted(self.counters.items()):
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} counter")
+            for labels, value in sorted(family.items()):
+                out.append(f"{name}{prom_labels(labels)} {value:g}")
+        for name, read in sorted(self.gauges.items()):
+            try:
+                value = float(read())
+            except Exception:
+                continue
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {value:g}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.help.update({
+    "bot_update_seconds": "Полная обработка апдейта, включая FSM и middleware",
+    "bot_handler_seconds": "Время хендлера",
+    "bot_state_seconds": "Время хендлера по FSM-состоянию на входе",
+    "bot_api_seconds": "Запросы к Bot API по методам",
+    "bot_outbox_delivery_seconds": "От заявки до доставки уведомления админу, с повторами",
+    "bot_fsm_updates_total": "Апдейты, прошедшие через транзакцию FSM",
+    "bot_fsm_direct_ops_total": "Обращения хендлеров к FSM (столько запросов было бы без транзакции)",
+    "bot_fsm_storage_ops_total": "Реальные запросы к хранилищу FSM",
+    "bot_fsm_rollbacks_total": "Транзакции FSM, отменённые из-за ошибки хендлера",
+})
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        labels = (("type", event.event_type),)
+        metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_update_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            metrics.in_flight -= 1
+            metrics.observe("bot_update_seconds", labels, time.perf_counter() - started)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # внутренний middleware: к этому моменту известны выбранный хендлер и состояние
+    async def __call__(self, handler, event, data):
+        name = (("handler", data["handler"].callback.__name__),)
+        state = (("state", data.get("raw_state") or "-"),)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except SkipHandler:
+            raise
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", name + (("error", type(e).__name__),))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_handler_seconds", name, elapsed)
+            metrics.observe("bot_state_seconds", state, elapsed)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        labels = (("method", method.__api_method__),)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", labels, time.perf_counter() - started)
+
+# метрики апдейта снаружи транзакции FSM: в bot_update_seconds входит и запись состояния
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.update.outer_middleware(StateTransactionMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+
+# ----------------- keyboards -----------------
+# Все клавиатуры строятся один раз при импорте через make_kb и попадают в реестр вместе
+# с сериализованным reply_markup (его использует CachedMarkupSession).
 
-done_or_skip_files_kb = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text="ГОТОВО"), KeyboardButton(text="ПРОПУСТИТЬ ФАЙЛЫ")]],
-    resize_keyboard=True
+_KB_BY_ROWS: Dict[Tuple[Tuple[str, ...], ...], ReplyKeyboardMarkup] = {}
+
+def register_markup(markup):
+    MARKUP_JSON[id(markup)] = (markup, bot.session.prepare_value(markup.model_dump(warnings=False), bot=bot, files={}))
+    return markup
+
+def make_kb(*rows: List[str]) -> ReplyKeyboardMarkup:
+    key = tuple(tuple(row) for row in rows)
+    kb = _KB_BY_ROWS.get(key)
+    if kb is None:
+        kb = _KB_BY_ROWS[key] = register_markup(ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text=t) for t in row] for row in rows],
+            resize_keyboard=True
+        ))
+    return kb
+
+start_kb = make_kb(["Создать заказ"])
+
+services_kb = make_kb(
+    ["Печать фото"],
+    ["Печать документов"],
+    ["Фото на документы"],
+    ["Оцифровка"],
+    ["Термопечать"],
+    ["Реставрация фото"],
+    ["Визитки/буклеты/наклейки"],
+    ["Фотошоп"],
+    ["Другое"],
 )
 
+confirm_kb = make_kb(["✅ Отправить", "↩️ Начать заново"])
+done_kb = make_kb(["ГОТОВО"])
+skip_kb = make_kb(["ПРОПУСТИТЬ"])
+done_or_skip_kb = make_kb(["ГОТОВО", "ПРОПУСТИТЬ"])
+done_or_skip_files_kb = make_kb(["ГОТОВО", "ПРОПУСТИТЬ ФАЙЛЫ"])
+remove_kb = register_markup(ReplyKeyboardRemove())
+
 # ----------------- validation -----------------
 
 def normalize_phone(s: str) -> Optional[str]:
@@ -112,40 +1851,676 @@ def is_positive_int(s: str) -> bool:
     s = (s or "").strip()
     return s.isdigit() and int(s) > 0
 
-# ----------------- generic helpers -----------------
+# ----------------- order draft -----------------
+# Черновик заказа в FSM хранится одним компактным списком под ключом DRAFT_KEY:
+# значения полей по позициям DRAFT_FIELDS (хвост из None отрезается), последним — плоский
+# список файлов [вид, file_id, вид, file_id, …], где вид — номер в FILE_KINDS. В хендлерах он разворачивается
+# в OrderDraft со __slots__; get()/[] у него как у dict, поэтому шаблоны и проверки шагов
+# работают с ним так же, как раньше с data.
 
 FileItem = Tuple[str, str]  # ("photo"|"document", file_id)
 
-async def add_file_to_state(message: types.Message, state: FSMContext):
+FILE_KINDS = ("photo", "document")
+FILE_KIND_CODES = {kind: code for code, kind in enumerate(FILE_KINDS)}
+
+DRAFT_KEY = "draft"
+DRAFT_FIELDS = (
+    "service", "contact", "size", "paper", "copies", "format", "color", "duplex", "pages",
+    "doc_type", "qty", "source", "media", "item", "has_layout", "task", "product_type",
+    "tirage", "need_design", "dont_change", "desc", "comment",
+)
+
+@dataclass(slots=True, frozen=True)
+class FileRef:
+    kind: int
+    file_id: str
+
+    def item(self) -> FileItem:
+        return FILE_KINDS[self.kind], self.file_id
+
+@dataclass(slots=True)
+class OrderDraft:
+    service: Optional[str] = None
+    contact: Optional[str] = None
+    size: Optional[str] = None
+    paper: Optional[str] = None
+    copies: Optional[int] = None
+    format: Optional[str] = None
+    color: Optional[str] = None
+    duplex: Optional[str] = None
+    pages: Optional[str] = None
+    doc_type: Optional[str] = None
+    qty: Optional[int] = None
+    source: Optional[str] = None
+    media: Optional[str] = None
+    item: Optional[str] = None
+    has_layout: Optional[str] = None
+    task: Optional[str] = None
+    product_type: Optional[str] = None
+    tirage: Optional[int] = None
+    need_design: Optional[str] = None
+    dont_change: Optional[str] = None
+    desc: Optional[str] = None
+    comment: Optional[str] = None
+    files: List[FileRef] = field(default_factory=list)
+    draft_id: str = ""  # ключ идемпотентности оформления, новый на каждый выбор услуги
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None) if key in DRAFT_SLOTS else None
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        if key not in DRAFT_SLOTS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def add_file(self, kind: str, file_id: str) -> None:
+        self.files.append(FileRef(FILE_KIND_CODES[kind], file_id))
+
+    def file_items(self) -> List[FileItem]:
+        return [f.item() for f in self.files]
+
+    def to_dict(self) -> Dict[str, Any]:
+        # плоский dict для журнала/базы заказов
+        out = {k: v for k in DRAFT_FIELDS if (v := getattr(self, k)) is not None}
+        out["files"] = self.file_items()
+        return out
+
+    def dump(self) -> list:
+        values = [getattr(self, k) for k in DRAFT_FIELDS]
+        while values and values[-1] is None:
+            values.pop()
+        values.append([x for f in self.files for x in (f.kind, f.file_id)])
+        if self.draft_id:
+            values.append(self.draft_id)
+        return values
+
+    @classmethod
+    def load(cls, raw: list) -> "OrderDraft":
+        draft_id = ""
+        if raw and isinstance(raw[-1], str):  # в старых черновиках последним идёт список файлов
+            *raw, draft_id = raw
+        *values, files = raw
+        draft = cls(*values, draft_id=draft_id)
+        draft.files = [FileRef(kind, file_id) for kind, file_id in zip(files[::2], files[1::2])]
+        return draft
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> "OrderDraft":
+        # данные в старом формате (dict с полями), оставшиеся в FSM с прошлой версии
+        draft = cls(**{k: data[k] for k in DRAFT_FIELDS if k in data})
+        for kind, file_id in data.get("files") or []:
+            draft.add_file(kind, file_id)
+        return draft
+
+DRAFT_SLOTS = frozenset(DRAFT_FIELDS) | {"files"}
+
+async def load_draft(state: FSMContext) -> OrderDraft:
     data = await state.get_data()
-    files: List[FileItem] = data.get("files", [])
-    if message.photo:
-        files.append(("photo", message.photo[-1].file_id))
-    elif message.document:
-        files.append(("document", message.document.file_id))
-    await state.update_data(files=files)
-
-async def send_files_to_admin(files: List[FileItem]):
+    raw = data.get(DRAFT_KEY)
+    return OrderDraft.load(raw) if raw is not None else OrderDraft.from_dict(data)
+
+async def save_draft(state: FSMContext, draft: OrderDraft) -> None:
+    await state.set_data({DRAFT_KEY: draft.dump()})
+
+# ----------------- generic helpers -----------------
+
+async def add_files_to_state(messages: List[types.Message], state: FSMContext) -> int:
+    # все файлы (например, целый альбом) добавляются одной записью; возвращает общее число файлов
+    draft = await load_draft(state)
+    for message in messages:
+        if message.photo:
+            draft.add_file("photo", message.photo[-1].file_id)
+        elif message.document:
+            draft.add_file("document", message.document.file_id)
+    await save_draft(state, draft)
+    return len(draft.files)
+
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "5"))
+SEND_BACKOFF = 1.0  # первая пауза после сетевой ошибки или 5xx, дальше вдвое больше
+SEND_MAX_BACKOFF = 30.0
+CHAT_RATE = float(os.getenv("CHAT_RATE", "1"))  # запросов в секунду в один чат
+CHAT_BURST = int(os.getenv("CHAT_BURST", "5"))
+MEDIA_GROUP_SIZE = 10
+
+_chat_buckets: Dict[int, TokenBucket] = {}
+
+def chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+    return bucket
+
+async def send_with_retry(chat_id: int, send, cost: int = 1):
+    # send — функция без аргументов, создающая корутину запроса (её можно вызвать повторно);
+    # cost — сколько сообщений появится в чате (у альбома — по одному на файл)
+    delay = SEND_BACKOFF
+    for attempt in range(SEND_RETRIES + 1):
+        await chat_bucket(chat_id).acquire(cost)
+        try:
+            return await send()
+        except TelegramRetryAfter as e:
+            if attempt == SEND_RETRIES:
+                raise
+            logging.warning("flood control in chat %s, retry after %ss", chat_id, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if attempt == SEND_RETRIES:
+                raise
+            logging.warning("send to chat %s failed (%r), retry in %.0fs", chat_id, e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SEND_MAX_BACKOFF)
+
+def media_batches(files: List[FileItem]) -> List[Tuple[str, List[str]]]:
+    # фото и документы нельзя смешивать в одном альбоме: режем подряд идущие файлы одного вида
+    # по MEDIA_GROUP_SIZE, так что админ видит файлы в том порядке, в каком их прислал клиент
+    batches: List[Tuple[str, List[str]]] = []
     for kind, fid in files:
-        if kind == "photo":
-            await bot.send_photo(ADMIN_ID, fid)
+        kind = "photo" if kind == "photo" else "document"
+        if batches and batches[-1][0] == kind and len(batches[-1][1]) < MEDIA_GROUP_SIZE:
+            batches[-1][1].append(fid)
         else:
-            await bot.send_document(ADMIN_ID, fid)
+            batches.append((kind, [fid]))
+    return batches
 
-async def ask_contact(message: types.Message, state: FSMContext, next_state: State):
-    await state.set_state(next_state)
-    await message.answer(
-        "Контакт для связи (номер телефона на 8…). Пример: 89123456789",
-        reply_markup=ReplyKeyboardRemove()
-    )
-
-async def ask_comment(message: types.Message, state: FSMContext, next_state: State):
-    await state.set_state(next_state)
-    await message.answer("Комментарий (или ПРОПУСТИТЬ):", reply_markup=skip_kb)
+async def send_media_batch(chat_id: int, kind: str, ids: List[str], caption: Optional[str] = None):
+    # caption — подпись к первому файлу альбома
+    if len(ids) == 1:
+        if kind == "photo":
+            return await send_with_retry(chat_id, lambda: bot.send_photo(chat_id, ids[0], caption=caption))
+        return await send_with_retry(chat_id, lambda: bot.send_document(chat_id, ids[0], caption=caption))
+    media_cls = InputMediaPhoto if kind == "photo" else InputMediaDocument
+    media = [media_cls(media=fid, caption=caption if i == 0 else None) for i, fid in enumerate(ids)]
+    return await send_with_retry(chat_id, lambda: bot.send_media_group(chat_id, media=media), cost=len(ids))
 
 def now_str() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+# ----------------- admin outbox -----------------
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_MAX_BACKOFF = 300.0
+
+class Outbox:
+    # Уведомления админу о новых заявках. Сначала запись попадает в таблицу outbox,
+    # потом её доставляют воркеры; при ошибке — повтор с экспоненциальной паузой,
+    # после OUTBOX_MAX_ATTEMPTS попыток запись помечается как dead и больше не трогается.
+    # stage: 0 — ничего не отправлено, 1 — текст ушёл, 1 + k — ушли первые k альбомов с файлами;
+    # повтор продолжает с того места, где остановилась прошлая попытка.
+    # Таблица лежит в базе OrderStore и пишется через то же соединение, поэтому строка
+    # заказа и строка уведомления о нём появляются в одной транзакции.
+    # В один чат заявка уходит целиком под замком этого чата: воркеры не перемешивают
+    # текст одной заявки с альбомами другой, параллельны только доставки в разные чаты.
+
+    def __init__(self, store: OrderStore, workers: int = OUTBOX_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._ready = False
+        self._lock = store._lock
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._retrying = 0
+        self.delivered = 0
+        self.failed_attempts = 0
+        self.dead = 0
+
+    def _db(self) -> sqlite3.Connection:
+        conn = self.store._db()
+        if not self._ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_no INTEGER,
+                    chat_id  INTEGER NOT NULL,
+                    text     TEXT NOT NULL,
+                    files    TEXT NOT NULL,
+                    created  REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    stage    INTEGER NOT NULL DEFAULT 0,
+                    status   TEXT NOT NULL DEFAULT 'pending',
+                    error    TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id)")
+            self._ready = True
+        return conn
+
+    def _sql(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            db = self._db()
+            with db:
+                return db.execute(sql, params)
+
+    def _pending(self) -> List[dict]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT id, order_no, chat_id, text, files, created, attempts, stage "
+                "FROM outbox WHERE status = 'pending' ORDER BY id"
+            ).fetchall()
+        keys = ("id", "order_no", "chat_id", "text", "files", "created", "attempts", "stage")
+        items = [dict(zip(keys, row)) for row in rows]
+        for item in items:
+            item["files"] = json.loads(item["files"])
+        return items
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def start(self) -> None:
+        self._ensure_workers()
+        for item in await asyncio.to_thread(self._pending):
+            self._queue.put_nowait(item)
+
+    def _insert(self, item: dict, order: Optional[dict]) -> int:
+        with self._lock:
+            db = self._db()
+            with db:
+                if order is not None:
+                    self.store._write(db, [order])
+                return db.execute(
+                    "INSERT INTO outbox (order_no, chat_id, text, files, created) VALUES (?, ?, ?, ?, ?)",
+                    (item["order_no"], item["chat_id"], item["text"], json.dumps(item["files"]), item["created"]),
+                ).lastrowid
+
+    async def enqueue(self, order_no: int, chat_id: int, text: str, files: List[FileItem],
+                      order: Optional[dict] = None) -> None:
+        # order — строка для OrderStore, пишется в той же транзакции, что и уведомление
+        item = {"order_no": order_no, "chat_id": chat_id, "text": text, "files": list(files),
+                "created": time.time(), "attempts": 0, "stage": 0}
+        item["id"] = await asyncio.to_thread(self._insert, item, order)
+        self._ensure_workers()
+        self._queue.put_nowait(item)
+
+    async def _advance(self, item: dict) -> None:
+        item["stage"] += 1
+        await asyncio.to_thread(self._sql, "UPDATE outbox SET stage = ? WHERE id = ?", (item["stage"], item["id"]))
+
+    async def _deliver(self, item: dict) -> None:
+        chat_id = item["chat_id"]
+        if item["stage"] == 0:
+            await send_with_retry(chat_id, lambda: bot.send_message(chat_id, item["text"]))
+            await self._advance(item)
+        # альбомы по одному и по порядку, без параллельной отправки: иначе Telegram может
+        # переставить их местами, а stage перестанет означать «первые k ушли».
+        # Подпись с номером — на случай, если повтор дошлёт хвост после чужой заявки
+        for kind, ids in media_batches(item["files"])[item["stage"] - 1:]:
+            await send_media_batch(chat_id, kind, ids, caption=f"Заказ №{item['order_no']}")
+            await self._advance(item)
+
+    def _requeue(self, item: dict) -> None:
+        self._retrying -= 1
+        self._queue.put_nowait(item)
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self._queue.get()
+            lock = self._chat_locks.setdefault(item["chat_id"], asyncio.Lock())
+            try:
+                async with lock:
+                    await self._deliver(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                item["attempts"] += 1
+                self.failed_attempts += 1
+                status = "dead" if item["attempts"] >= OUTBOX_MAX_ATTEMPTS else "pending"
+                await asyncio.to_thread(
+                    self._sql, "UPDATE outbox SET attempts = ?, status = ?, error = ? WHERE id = ?",
+                    (item["attempts"], status, repr(e), item["id"]),
+                )
+                if status == "dead":
+                    self.dead += 1
+                    logging.error("outbox: order %s not delivered after %d attempts: %r",
+                                  item["order_no"], item["attempts"], e)
+                    continue
+                delay = min(OUTBOX_MAX_BACKOFF, 2.0 ** item["attempts"])
+                logging.warning("outbox: order %s delivery failed (%r), retry in %.0fs", item["order_no"], e, delay)
+                self._retrying += 1
+                asyncio.get_running_loop().call_later(delay, self._requeue, item)
+                continue
+            await asyncio.to_thread(self._sql, "UPDATE outbox SET status = 'done' WHERE id = ?", (item["id"],))
+            self.delivered += 1
+            # от записи в outbox до последнего альбома, с учётом повторов
+            metrics.observe("bot_outbox_delivery_seconds", (), time.time() - item["created"])
+
+    @property
+    def queue_depth(self) -> int:
+        return (self._queue.qsize() if self._queue else 0) + self._retrying
+
+    def latency(self) -> Optional[Histogram]:
+        return metrics.histograms.get("bot_outbox_delivery_seconds", {}).get(())
+
+    def metrics(self) -> Dict[str, Any]:
+        lat = self.latency()
+
+        def pct(p: float) -> float:
+            return lat.quantile(p) if lat is not None else 0.0
+
+        return {
+            "queue_depth": self.queue_depth,
+            "delivered": self.delivered,
+            "failed_attempts": self.failed_attempts,
+            "dead": self.dead,
+            "latency_p50": pct(0.5),
+            "latency_p99": pct(0.99),
+        }
+
+    async def close(self) -> None:
+        # недоставленное остаётся в таблице и будет отправлено после перезапуска;
+        # соединение закрывает order_store
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+outbox = Outbox(order_store)
+
+# ----------------- media cache -----------------
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "").strip()  # пусто — файлы не скачиваются
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.getenv("MEDIA_DOWNLOAD_CONCURRENCY", "4"))
+MEDIA_DOWNLOAD_TIMEOUT = int(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "300"))
+MEDIA_MAX_ATTEMPTS = 3
+MEDIA_CHUNK = 256 * 1024
+
+async def tg_file_chunks(file_path: str):
+    # содержимое файла Telegram кусками по MEDIA_CHUNK, целиком в память не читается
+    api = bot.session.api
+    if api.is_local:
+        async with aiofiles.open(api.wrap_local_file.to_local(file_path), "rb") as f:
+            while chunk := await f.read(MEDIA_CHUNK):
+                yield chunk
+        return
+    async for chunk in bot.session.stream_content(url=api.file_url(bot.token, file_path),
+                                                  timeout=MEDIA_DOWNLOAD_TIMEOUT, chunk_size=MEDIA_CHUNK):
+        yield chunk
+
+class MediaCache:
+    # Файлы заказов скачиваются через Bot API в локальный кэш, где лежат под своим SHA-256
+    # (MEDIA_CACHE_DIR/ab/abcdef….jpg), так что одинаковые файлы хранятся один раз. Файл пишется
+    # на диск кусками по мере скачивания. Повторно присланный файл (тот же file_unique_id)
+    # не скачивается вовсе. Таблица order_media связывает номер заказа с файлами; при
+    # превышении MEDIA_CACHE_MAX_BYTES удаляются давно не использованные файлы.
+
+    def __init__(self, root: str, max_bytes: int = MEDIA_CACHE_MAX_BYTES,
+                 concurrency: int = MEDIA_DOWNLOAD_CONCURRENCY):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+        self._total: Optional[int] = None
+        self.downloaded = 0
+        self.reused = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS media (
+                    sha256    TEXT PRIMARY KEY,
+                    size      INTEGER NOT NULL,
+                    ext       TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS media_last_used ON media (last_used);
+                CREATE TABLE IF NOT EXISTS media_ids (
+                    file_unique_id TEXT PRIMARY KEY,
+                    sha256         TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS order_media (
+                    order_no INTEGER NOT NULL,
+                    seq      INTEGER NOT NULL,
+                    kind     TEXT NOT NULL,
+                    file_id  TEXT NOT NULL,
+                    sha256   TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error    TEXT,
+                    PRIMARY KEY (order_no, seq)
+                );
+                CREATE INDEX IF NOT EXISTS order_media_pending ON order_media (sha256) WHERE sha256 IS NULL;
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _sql(self, sql: str, params: tuple = (), many: bool = False) -> List[tuple]:
+        with self._lock:
+            db = self._db()
+            with db:
+                cur = db.executemany(sql, params) if many else db.execute(sql, params)
+                return cur.fetchall()
+
+    def blob_path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256 + ext)
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        rows = await asyncio.to_thread(
+            self._sql, "SELECT order_no, seq, file_id FROM order_media WHERE sha256 IS NULL AND attempts < ?",
+            (MEDIA_MAX_ATTEMPTS,),
+        )
+        for order_no, seq, file_id in rows:
+            self._spawn(order_no, seq, file_id)
+
+    async def submit(self, order_no: int, files: List[FileItem]) -> None:
+        # записываем, какие файлы нужны заказу, и скачиваем их в фоне
+        if not self.enabled or not files:
+            return
+        rows = [(order_no, seq, kind, file_id) for seq, (kind, file_id) in enumerate(files)]
+        await asyncio.to_thread(
+            self._sql, "INSERT OR IGNORE INTO order_media (order_no, seq, kind, file_id) VALUES (?, ?, ?, ?)",
+            rows, True,
+        )
+        for order_no, seq, _, file_id in rows:
+            self._spawn(order_no, seq, file_id)
+
+    def _spawn(self, order_no: int, seq: int, file_id: str) -> None:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        task = asyncio.create_task(self._fetch(order_no, seq, file_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, order_no: int, seq: int, file_id: str) -> None:
+        async with self._sem:
+            try:
+                sha256 = await self.ingest(file_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("media cache: order %s file %s not downloaded: %r", order_no, seq, e)
+                await asyncio.to_thread(
+                    self._sql, "UPDATE order_media SET attempts = attempts + 1, error = ? "
+                    "WHERE order_no = ? AND seq = ?", (repr(e), order_no, seq),
+                )
+                return
+        await asyncio.to_thread(
+            self._sql, "UPDATE order_media SET sha256 = ?, error = NULL WHERE order_no = ? AND seq = ?",
+            (sha256, order_no, seq),
+        )
+
+    def _known(self, file_unique_id: str) -> Optional[Tuple[str, str]]:
+        rows = self._sql(
+            "SELECT m.sha256, m.ext FROM media_ids i JOIN media m ON m.sha256 = i.sha256 "
+            "WHERE i.file_unique_id = ?", (file_unique_id,),
+        )
+        if rows and os.path.exists(self.blob_path(*rows[0])):
+            self._sql("UPDATE media SET last_used = ? WHERE sha256 = ?", (time.time(), rows[0][0]))
+            return rows[0]
+        return None
+
+    async def ingest(self, file_id: str) -> str:
+        # скачивает файл (если его ещё нет в кэше) и возвращает его SHA-256
+        tg_file = await bot.get_file(file_id)
+        known = await asyncio.to_thread(self._known, tg_file.file_unique_id)
+        if known is not None:
+            self.reused += 1
+            return known[0]
+
+        ext = os.path.splitext(tg_file.file_path or "")[1].lower()[:10]
+        tmp = os.path.join(self.root, "tmp", uuid.uuid4().hex + ".part")
+        digest, size = hashlib.sha256(), 0
+        try:
+            async with aiofiles.open(tmp, "wb") as out:
+                async for chunk in tg_file_chunks(tg_file.file_path):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await out.write(chunk)
+            sha256 = digest.hexdigest()
+            await asyncio.to_thread(self._store, tmp, sha256, size, ext, tg_file.file_unique_id)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.downloaded += 1
+        return sha256
+
+    def _store(self, tmp: str, sha256: str, size: int, ext: str, file_unique_id: str) -> None:
+        rows = self._sql("SELECT ext FROM media WHERE sha256 = ?", (sha256,))
+        ext = rows[0][0] if rows else ext
+        path = self.blob_path(sha256, ext)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+        with self._lock:
+            db = self._db()
+            with db:
+                added = db.execute(
+                    "INSERT OR IGNORE INTO media (sha256, size, ext, last_used) VALUES (?, ?, ?, ?)",
+                    (sha256, size, ext, time.time()),
+                ).rowcount
+                if not added:
+                    db.execute("UPDATE media SET last_used = ? WHERE sha256 = ?", (time.time(), sha256))
+                db.execute("INSERT OR REPLACE INTO media_ids (file_unique_id, sha256) VALUES (?, ?)",
+                           (file_unique_id, sha256))
+            if self._total is None:
+                self._total = db.execute("SELECT COALESCE(SUM(size), 0) FROM media").fetchone()[0]
+            elif added:
+                self._total += size
+        if self._total > self.max_bytes:
+            self._evict(keep=sha256)
+
+    def _evict(self, keep: str) -> None:
+        # удаляем давно не использованные файлы, пока кэш не влезет в лимит
+        with self._lock:
+            db = self._db()
+            for sha256, size, ext in db.execute("SELECT sha256, size, ext FROM media ORDER BY last_used").fetchall():
+                if self._total <= self.max_bytes:
+                    break
+                if sha256 == keep:
+                    continue
+                try:
+                    os.remove(self.blob_path(sha256, ext))
+                except FileNotFoundError:
+                    pass
+                with db:
+                    db.execute("DELETE FROM media WHERE sha256 = ?", (sha256,))
+                    db.execute("DELETE FROM media_ids WHERE sha256 = ?", (sha256,))
+                self._total -= size
+
+    def _order_files(self, order_no: int) -> List[dict]:
+        rows = self._sql(
+            "SELECT o.seq, o.kind, o.file_id, o.sha256, m.ext, m.size, o.error FROM order_media o "
+            "LEFT JOIN media m ON m.sha256 = o.sha256 WHERE o.order_no = ? ORDER BY o.seq", (order_no,),
+        )
+        out, used = [], []
+        for seq, kind, file_id, sha256, ext, size, error in rows:
+            path = self.blob_path(sha256, ext) if sha256 and ext is not None else None
+            if path is not None and not os.path.exists(path):
+                path = None
+            if path is not None:
+                used.append((time.time(), sha256))
+            out.append({"seq": seq, "kind": kind, "file_id": file_id, "path": path, "size": size, "error": error})
+        if used:
+            self._sql("UPDATE media SET last_used = ? WHERE sha256 = ?", used, True)
+        return out
+
+    async def order_files(self, order_no: int) -> List[dict]:
+        # файлы заказа по порядку; path = None, если файла нет в кэше (не скачан или вытеснен)
+        if not self.enabled:
+            return []
+        return await asyncio.to_thread(self._order_files, order_no)
+
+    async def close(self) -> None:
+        # недокачанное останется в order_media и будет скачано после перезапуска
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+media_cache = MediaCache(MEDIA_CACHE_DIR)
+
+# ----------------- order archives -----------------
+
+ZIP_DIR = os.getenv("ZIP_DIR", "archives")
+ZIP_MAX_UPLOAD = int(os.getenv("ZIP_MAX_UPLOAD", str(50 * 1024 ** 2)))  # лимит Bot API на отправку файла
+
+def _zip_copy(zf: zipfile.ZipFile, name: str, path: str) -> None:
+    with open(path, "rb") as src, zf.open(zipfile.ZipInfo(name, time.localtime()[:6]), "w", force_zip64=True) as dst:
+        shutil.copyfileobj(src, dst, MEDIA_CHUNK)
+
+async def order_zip_files(order_no: int) -> List[dict]:
+    # список файлов заказа: из кэша (с локальными путями) или, если кэша нет, из базы заказов
+    files = await media_cache.order_files(order_no)
+    if files:
+        return files
+    order = await order_store.get(order_no)
+    return [{"seq": seq, "kind": kind, "file_id": file_id, "path": None}
+            for seq, (kind, file_id) in enumerate((order or {}).get("files") or [])]
+
+async def build_order_zip(order_no: int, files: List[dict]) -> Tuple[str, int]:
+    # ZIP без сжатия (фото и PDF всё равно не жмутся) собирается прямо на диске: файлы из кэша
+    # копируются кусками, остальные докачиваются из Bot API кусками, память не зависит от размера
+    os.makedirs(ZIP_DIR, exist_ok=True)
+    path = os.path.join(ZIP_DIR, f"order_{order_no}.zip")
+    tmp = path + ".part"
+    zf = await asyncio.to_thread(zipfile.ZipFile, tmp, "w", zipfile.ZIP_STORED, True)
+    try:
+        for f in files:
+            name = f"{f['seq'] + 1:03d}_{f['kind']}"
+            if f["path"] is not None:
+                await asyncio.to_thread(_zip_copy, zf, name + os.path.splitext(f["path"])[1], f["path"])
+                continue
+            tg_file = await bot.get_file(f["file_id"])
+            info = zipfile.ZipInfo(name + os.path.splitext(tg_file.file_path or "")[1].lower(), time.localtime()[:6])
+            dst = await asyncio.to_thread(zf.open, info, "w", force_zip64=True)
+            try:
+                async for chunk in tg_file_chunks(tg_file.file_path):
+                    await asyncio.to_thread(dst.write, chunk)
+            finally:
+                await asyncio.to_thread(dst.close)
+        await asyncio.to_thread(zf.close)
+    except BaseException:
+        await asyncio.to_thread(zf.close)
+        os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+    return path, os.path.getsize(path)
+
 # ----------------- states -----------------
 
 class PhotoPrint(StatesGroup):
@@ -249,1032 +2624,945 @@ async def restart(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("Выберите услугу:", reply_markup=services_kb)
 
-# ----------------- 1) Печать фото -----------------
-
-@dp.message(F.text == "Печать фото")
-async def photo_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Печать фото", files=[])
-    await ask_contact(message, state, PhotoPrint.contact)
-
-@dp.message(PhotoPrint.contact)
-async def photo_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
-        return
-    await state.update_data(contact=phone)
-    await state.set_state(PhotoPrint.size)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="A7 (7×10)"), KeyboardButton(text="A6 (10×15)")],
-            [KeyboardButton(text="A5 (15×21)"), KeyboardButton(text="A4 (21×30)")],
-            [KeyboardButton(text="A3 (30×42)")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Выберите размер:", reply_markup=kb)
-
-@dp.message(PhotoPrint.size)
-async def photo_size(message: types.Message, state: FSMContext):
-    allowed = {"A7 (7×10)", "A6 (10×15)", "A5 (15×21)", "A4 (21×30)", "A3 (30×42)"}
-    if (message.text or "") not in allowed:
-        await message.answer("Выберите размер кнопкой.")
-        return
-    await state.update_data(size=message.text)
-    await state.set_state(PhotoPrint.paper)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Глянцевая"), KeyboardButton(text="Матовая")]],
-        resize_keyboard=True
-    )
-    await message.answer("Тип бумаги:", reply_markup=kb)
-
-@dp.message(PhotoPrint.paper)
-async def photo_paper(message: types.Message, state: FSMContext):
-    if (message.text or "").lower() not in {"глянцевая", "матовая"}:
-        await message.answer("Выберите: Глянцевая или Матовая.")
-        return
-    await state.update_data(paper=message.text)
-    await state.set_state(PhotoPrint.copies)
-    await message.answer("Количество копий (числом):", reply_markup=ReplyKeyboardRemove())
-
-@dp.message(PhotoPrint.copies)
-async def photo_copies(message: types.Message, state: FSMContext):
-    if not is_positive_int(message.text or ""):
-        await message.answer("Введите количество копий числом (например 2).")
-        return
-    await state.update_data(copies=int(message.text.strip()))
-    await state.set_state(PhotoPrint.files)
-    await message.answer("Пришлите фото (можно несколько). Когда закончите нажмите ГОТОВО.", reply_markup=done_kb)
-
-@dp.message(PhotoPrint.files, F.photo | F.document)
-async def photo_files_add(message: types.Message, state: FSMContext):
-    await add_file_to_state(message, state)
-    await message.answer("Принято. Ещё файлы или ГОТОВО.")
-
-@dp.message(PhotoPrint.files, F.text == "ГОТОВО")
-async def photo_files_done(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    if len(data.get("files", [])) == 0:
-        await message.answer("Для печати фото нужны файлы. Пришлите хотя бы одно фото.")
-        return
-    await ask_comment(message, state, PhotoPrint.comment)
-
-@dp.message(PhotoPrint.comment, F.text == "ПРОПУСТИТЬ")
-async def photo_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await photo_confirm(message, state)
-
-@dp.message(PhotoPrint.comment)
-async def photo_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await photo_confirm(message, state)
-
-async def photo_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Размер: {data['size']}\n"
-        f"Бумага: {data['paper']}\n"
-        f"Копий: {data['copies']}\n"
-        f"Файлов: {len(data.get('files', []))}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(PhotoPrint.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- 2) Печать документов -----------------
-
-@dp.message(F.text == "Печать документов")
-async def docs_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Печать документов", files=[])
-    await ask_contact(message, state, DocPrint.contact)
-
-@dp.message(DocPrint.contact)
-async def docs_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
-        return
-    await state.update_data(contact=phone)
-    await state.set_state(DocPrint.format)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="A4"), KeyboardButton(text="A3")]],
-        resize_keyboard=True
-    )
-    await message.answer("Формат бумаги:", reply_markup=kb)
+# ----------------- summaries -----------------
+# Сводка заказа описывается списком полей услуги; по нему один раз собираются строки формата
+# для экрана подтверждения и для заявки админу, так что поля больше не дублируются.
 
-@dp.message(DocPrint.format)
-async def docs_format(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"A4", "A3"}:
-        await message.answer("Выберите: A4 или A3.")
-        return
-    await state.update_data(format=message.text)
-    await state.set_state(DocPrint.copies)
-    await message.answer("Количество копий (числом):", reply_markup=ReplyKeyboardRemove())
-
-@dp.message(DocPrint.copies)
-async def docs_copies(message: types.Message, state: FSMContext):
-    if not is_positive_int(message.text or ""):
-        await message.answer("Введите количество копий числом (например 2).")
-        return
-    await state.update_data(copies=int(message.text.strip()))
-    await state.set_state(DocPrint.color)
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "1024"))
 
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Ч/Б"), KeyboardButton(text="Цветная")]],
-        resize_keyboard=True
-    )
-    await message.answer("Цветность:", reply_markup=kb)
+@dataclass(frozen=True)
+class Field:
+    label: str
+    key: str
+    admin_label: Optional[str] = None  # подпись в заявке, если отличается от экрана подтверждения
+    blank_dash: bool = False  # пустое значение (ПРОПУСТИТЬ) тоже показывается как «-»
 
-@dp.message(DocPrint.color)
-async def docs_color(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Ч/Б", "Цветная"}:
-        await message.answer("Выберите: Ч/Б или Цветная.")
-        return
-    await state.update_data(color=message.text)
-    await state.set_state(DocPrint.duplex)
+FILES_COUNT = None  # вместо ключа: число приложенных файлов
 
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Односторонняя"), KeyboardButton(text="Двусторонняя")]],
-        resize_keyboard=True
-    )
-    await message.answer("Печать:", reply_markup=kb)
+def _fmt(text: str) -> str:
+    return text.replace("{", "{{").replace("}", "}}")
 
-@dp.message(DocPrint.duplex)
-async def docs_duplex(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Односторонняя", "Двусторонняя"}:
-        await message.answer("Выберите: Односторонняя или Двусторонняя.")
-        return
-    await state.update_data(duplex=message.text)
-    await state.set_state(DocPrint.pages)
-    await message.answer("Страницы: 'все' или диапазон (например 1-3,7):", reply_markup=ReplyKeyboardRemove())
-
-@dp.message(DocPrint.pages)
-async def docs_pages(message: types.Message, state: FSMContext):
-    pages = (message.text or "").strip()
-    if not pages:
-        await message.answer("Введите 'все' или диапазон (например 1-3,7).")
-        return
-    await state.update_data(pages=pages)
-    await state.set_state(DocPrint.files)
-    await message.answer("Пришлите документы. Когда закончите нажмите ГОТОВО.", reply_markup=done_kb)
+class SummaryTemplate:
+    # Строка формата с подписями и список значений, которые в неё подставляются;
+    # значения заодно служат отпечатком данных для кэша. head — уже строка формата
+    # (в заявке в ней номер, дата и клиент).
 
-@dp.message(DocPrint.files, F.photo | F.document)
-async def docs_files_add(message: types.Message, state: FSMContext):
-    await add_file_to_state(message, state)
-    await message.answer("Принято. Ещё файлы или ГОТОВО.")
+    __slots__ = ("fmt", "values_spec")
 
-@dp.message(DocPrint.files, F.text == "ГОТОВО")
-async def docs_files_done(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    if len(data.get("files", [])) == 0:
-        await message.answer("Для печати документов нужны файлы. Пришлите хотя бы один документ.")
-        return
-    await ask_comment(message, state, DocPrint.comment)
-
-@dp.message(DocPrint.comment, F.text == "ПРОПУСТИТЬ")
-async def docs_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await docs_confirm(message, state)
-
-@dp.message(DocPrint.comment)
-async def docs_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await docs_confirm(message, state)
-
-async def docs_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Формат: {data['format']}\n"
-        f"Копий: {data['copies']}\n"
-        f"Цвет: {data['color']}\n"
-        f"Печать: {data['duplex']}\n"
-        f"Страницы: {data['pages']}\n"
-        f"Файлов: {len(data.get('files', []))}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(DocPrint.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
+    def __init__(self, head: str, fields: List[Field], tail: str = "", admin: bool = False):
+        self.fmt = head + "".join(
+            _fmt((f.admin_label if admin and f.admin_label else f.label) + ": ") + "{}\n" for f in fields
+        ) + _fmt(tail)
+        self.values_spec = tuple((f.key, f.blank_dash) for f in fields)
 
-# ----------------- 3) Фото на документы (без файлов) -----------------
-
-@dp.message(F.text == "Фото на документы")
-async def idphoto_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Фото на документы", files=[])
-    await ask_contact(message, state, IDPhoto.contact)
-
-@dp.message(IDPhoto.contact)
-async def idphoto_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
-        return
-    await state.update_data(contact=phone)
-    await state.set_state(IDPhoto.doc_type)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Паспорт РФ"), KeyboardButton(text="Загранпаспорт")],
-            [KeyboardButton(text="Удостоверение")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Тип документа:", reply_markup=kb)
-
-@dp.message(IDPhoto.doc_type)
-async def idphoto_doctype(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Паспорт РФ", "Загранпаспорт", "Удостоверение"}:
-        await message.answer("Выберите тип документа кнопкой.")
-        return
-    await state.update_data(doc_type=message.text)
-    await state.set_state(IDPhoto.qty)
-    await message.answer("Количество (числом):", reply_markup=ReplyKeyboardRemove())
-
-@dp.message(IDPhoto.qty)
-async def idphoto_qty(message: types.Message, state: FSMContext):
-    if not is_positive_int(message.text or ""):
-        await message.answer("Введите количество числом (например 2).")
-        return
-    await state.update_data(qty=int(message.text.strip()))
-    await state.set_state(IDPhoto.color)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Цветная"), KeyboardButton(text="Ч/Б")]],
-        resize_keyboard=True
-    )
-    await message.answer("Цвет:", reply_markup=kb)
-
-@dp.message(IDPhoto.color)
-async def idphoto_color(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Цветная", "Ч/Б"}:
-        await message.answer("Выберите: Цветная или Ч/Б.")
-        return
-    await state.update_data(color=message.text)
-    await ask_comment(message, state, IDPhoto.comment)
-
-@dp.message(IDPhoto.comment, F.text == "ПРОПУСТИТЬ")
-async def idphoto_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await idphoto_confirm(message, state)
-
-@dp.message(IDPhoto.comment)
-async def idphoto_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await idphoto_confirm(message, state)
-
-async def idphoto_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Документ: {data['doc_type']}\n"
-        f"Количество: {data['qty']}\n"
-        f"Цвет: {data['color']}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(IDPhoto.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- 4) Оцифровка (без файлов) -----------------
-
-@dp.message(F.text == "Оцифровка")
-async def digi_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Оцифровка", files=[])
-    await ask_contact(message, state, Digitization.contact)
-
-@dp.message(Digitization.contact)
-async def digi_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
-        return
-    await state.update_data(contact=phone)
-    await state.set_state(Digitization.source)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Плёнка"), KeyboardButton(text="Видеокассета")],
-            [KeyboardButton(text="Аудиокассета")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Откуда оцифровывать?", reply_markup=kb)
+    def values(self, data: dict) -> tuple:
+        return tuple(
+            len(data.get("files", [])) if key is FILES_COUNT
+            else (data.get(key) or "-") if blank_dash else data.get(key, "-")
+            for key, blank_dash in self.values_spec
+        )
 
-@dp.message(Digitization.source)
-async def digi_source(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Плёнка", "Видеокассета", "Аудиокассета"}:
-        await message.answer("Выберите вариант кнопкой.")
-        return
-    await state.update_data(source=message.text)
-    await state.set_state(Digitization.qty)
-    await message.answer("Количество (штук) (числом):", reply_markup=ReplyKeyboardRemove())
-
-@dp.message(Digitization.qty)
-async def digi_qty(message: types.Message, state: FSMContext):
-    if not is_positive_int(message.text or ""):
-        await message.answer("Введите количество числом (например 1).")
+    def render(self, data: dict, *head_values) -> str:
+        return self.fmt.format(*head_values, *self.values(data))
+
+def confirm_template(fields: List[Field], has_files: bool, note: str) -> SummaryTemplate:
+    lines = [Field("Услуга", "service"), Field("Контакт", "contact"), *fields]
+    if has_files:
+        lines.append(Field("Файлов", FILES_COUNT))
+    lines.append(Field("Комментарий", "comment", blank_dash=True))
+    tail = "\n" + note + "\n" if note else ""
+    return SummaryTemplate("Проверьте заказ:\n", lines, tail + "\nВсё верно?")
+
+def order_template(fields: List[Field]) -> SummaryTemplate:
+    lines = [Field("Контакт", "contact"), Field("Услуга", "service"), *fields,
+             Field("Комментарий", "comment", blank_dash=True), Field("Файлов", FILES_COUNT)]
+    return SummaryTemplate("Заказ №{}\nДата: {}\nКлиент: {}\n", lines, admin=True)
+
+_summary_cache: "OrderedDict[tuple, str]" = OrderedDict()
+
+def render_cached(name: str, template: SummaryTemplate, data: dict) -> str:
+    key = (name, template.values(data))
+    try:
+        text = _summary_cache[key]
+        _summary_cache.move_to_end(key)
+        return text
+    except KeyError:
+        pass
+    except TypeError:  # нехешируемое значение — просто рендерим
+        return template.render(data)
+    text = _summary_cache[key] = template.fmt.format(*key[1])
+    if len(_summary_cache) > SUMMARY_CACHE_SIZE:
+        _summary_cache.popitem(last=False)
+    return text
+
+# ----------------- order flow engine -----------------
+# Каждая услуга описана списком шагов; один общий хендлер находит шаг по текущему
+# состоянию (словарь FLOW_STEPS) и выполняет его по типу:
+#   phone  — телефон на 8…;  choice — только кнопки;  int — целое > 0;
+#   text   — свободный ввод (с кнопкой «Свой …» и/или кнопкой пропуска);
+#   files  — приём фото/документов до ГОТОВО (или кнопки пропуска).
+
+DONE = "ГОТОВО"
+SKIP = "ПРОПУСТИТЬ"
+SKIP_FILES = "ПРОПУСТИТЬ ФАЙЛЫ"
+
+@dataclass
+class Step:
+    state: State
+    kind: str
+    prompt: Any  # текст вопроса или функция data -> (текст, клавиатура)
+    keyboard: Any = None
+    key: Optional[str] = None
+    choices: FrozenSet[str] = frozenset()
+    lower: bool = False
+    error: str = ""
+    custom: Optional[Tuple[str, str]] = None  # кнопка «Свой …» и вопрос для ручного ввода
+    skip: Optional[str] = None
+    required: bool = False
+    next: Any = None  # State или функция data -> State (State сам callable, поэтому проверяем isinstance)
+    ack: str = "Ещё файлы или ГОТОВО."  # подсказка после «Принято.»
+    check_done: Optional[Callable[[dict], Optional[str]]] = None  # текст отказа или None
+    check_skip: Optional[Callable[[dict], Optional[str]]] = None
+
+    def buttons(self) -> FrozenSet[str]:
+        texts = {b.text for row in getattr(self.keyboard, "keyboard", None) or [] for b in row}
+        return frozenset(texts | set(self.choices))
+
+@dataclass
+class Service:
+    name: str
+    group: type
+    steps: List[Step]
+    fields: List[Field]
+    note: str = ""  # примечание в конце экрана подтверждения
+    confirm_tpl: SummaryTemplate = field(init=False)
+    order_tpl: SummaryTemplate = field(init=False)
+
+    def __post_init__(self):
+        has_files = any(step.kind == "files" for step in self.steps)
+        self.confirm_tpl = confirm_template(self.fields, has_files, self.note)
+        self.order_tpl = order_template(self.fields)
+
+def contact_step(group, next_state: State) -> Step:
+    return Step(group.contact, "phone",
+                "Контакт для связи (номер телефона на 8…). Пример: 89123456789", remove_kb,
+                key="contact", error="Нужен номер на 8… (11 цифр). Пример: 89123456789", next=next_state)
+
+def comment_step(group) -> Step:
+    return Step(group.comment, "text", "Комментарий (или ПРОПУСТИТЬ):", skip_kb,
+                key="comment", skip=SKIP, next=group.confirm)
+
+def choice_step(state: State, key: str, prompt: str, rows: List[List[str]], error: str,
+                next_state: Any, lower: bool = False) -> Step:
+    choices = frozenset(t.lower() if lower else t for row in rows for t in row)
+    return Step(state, "choice", prompt, make_kb(*rows), key=key, choices=choices, lower=lower,
+                error=error, next=next_state)
+
+def int_step(state: State, key: str, prompt: str, error: str, next_state: State) -> Step:
+    return Step(state, "int", prompt, remove_kb, key=key, error=error, next=next_state)
+
+def custom_step(state: State, key: str, prompt: str, rows: List[List[str]], custom: Tuple[str, str],
+                next_state: State) -> Step:
+    return Step(state, "text", prompt, make_kb(*rows), key=key, custom=custom, next=next_state)
+
+def files_count(data: dict) -> int:
+    return len(data.get("files", []))
+
+def layout_files_prompt(data: dict):
+    if data.get("has_layout") == "Есть макет":
+        return "Пришлите макет(ы). Когда закончите нажмите ГОТОВО.", done_kb
+    return "Если есть материалы/логотипы, прикрепите файлы. Иначе нажмите ПРОПУСТИТЬ ФАЙЛЫ.", done_or_skip_files_kb
+
+SERVICE_LIST = [
+    # 1) Печать фото
+    Service("Печать фото", PhotoPrint, [
+        contact_step(PhotoPrint, PhotoPrint.size),
+        choice_step(PhotoPrint.size, "size", "Выберите размер:",
+                    [["A7 (7×10)", "A6 (10×15)"], ["A5 (15×21)", "A4 (21×30)"], ["A3 (30×42)"]],
+                    "Выберите размер кнопкой.", PhotoPrint.paper),
+        choice_step(PhotoPrint.paper, "paper", "Тип бумаги:", [["Глянцевая", "Матовая"]],
+                    "Выберите: Глянцевая или Матовая.", PhotoPrint.copies, lower=True),
+        int_step(PhotoPrint.copies, "copies", "Количество копий (числом):",
+                 "Введите количество копий числом (например 2).", PhotoPrint.files),
+        Step(PhotoPrint.files, "files", "Пришлите фото (можно несколько). Когда закончите нажмите ГОТОВО.", done_kb,
+             next=PhotoPrint.comment,
+             check_done=lambda d: None if files_count(d) else
+             "Для печати фото нужны файлы. Пришлите хотя бы одно фото."),
+        comment_step(PhotoPrint),
+    ], [Field("Размер", "size"), Field("Бумага", "paper"), Field("Копий", "copies")]),
+    # 2) Печать документов
+    Service("Печать документов", DocPrint, [
+        contact_step(DocPrint, DocPrint.format),
+        choice_step(DocPrint.format, "format", "Формат бумаги:", [["A4", "A3"]],
+                    "Выберите: A4 или A3.", DocPrint.copies),
+        int_step(DocPrint.copies, "copies", "Количество копий (числом):",
+                 "Введите количество копий числом (например 2).", DocPrint.color),
+        choice_step(DocPrint.color, "color", "Цветность:", [["Ч/Б", "Цветная"]],
+                    "Выберите: Ч/Б или Цветная.", DocPrint.duplex),
+        choice_step(DocPrint.duplex, "duplex", "Печать:", [["Односторонняя", "Двусторонняя"]],
+                    "Выберите: Односторонняя или Двусторонняя.", DocPrint.pages),
+        Step(DocPrint.pages, "text", "Страницы: 'все' или диапазон (например 1-3,7):", remove_kb,
+             key="pages", required=True, error="Введите 'все' или диапазон (например 1-3,7).", next=DocPrint.files),
+        Step(DocPrint.files, "files", "Пришлите документы. Когда закончите нажмите ГОТОВО.", done_kb,
+             next=DocPrint.comment,
+             check_done=lambda d: None if files_count(d) else
+             "Для печати документов нужны файлы. Пришлите хотя бы один документ."),
+        comment_step(DocPrint),
+    ], [Field("Формат", "format"), Field("Копий", "copies"), Field("Цвет", "color"),
+        Field("Печать", "duplex"), Field("Страницы", "pages")]),
+    # 3) Фото на документы (без файлов)
+    Service("Фото на документы", IDPhoto, [
+        contact_step(IDPhoto, IDPhoto.doc_type),
+        choice_step(IDPhoto.doc_type, "doc_type", "Тип документа:",
+                    [["Паспорт РФ", "Загранпаспорт"], ["Удостоверение"]],
+                    "Выберите тип документа кнопкой.", IDPhoto.qty),
+        int_step(IDPhoto.qty, "qty", "Количество (числом):",
+                 "Введите количество числом (например 2).", IDPhoto.color),
+        choice_step(IDPhoto.color, "color", "Цвет:", [["Цветная", "Ч/Б"]],
+                    "Выберите: Цветная или Ч/Б.", IDPhoto.comment),
+        comment_step(IDPhoto),
+    ], [Field("Документ", "doc_type"), Field("Количество", "qty"), Field("Цвет", "color")]),
+    # 4) Оцифровка (без файлов)
+    Service("Оцифровка", Digitization, [
+        contact_step(Digitization, Digitization.source),
+        choice_step(Digitization.source, "source", "Откуда оцифровывать?",
+                    [["Плёнка", "Видеокассета"], ["Аудиокассета"]],
+                    "Выберите вариант кнопкой.", Digitization.qty),
+        int_step(Digitization.qty, "qty", "Количество (штук) (числом):",
+                 "Введите количество числом (например 1).", Digitization.media_confirm),
+        choice_step(Digitization.media_confirm, "media",
+                    "Результат отдаём только на съёмный носитель клиента. Принесёте?",
+                    [["Да, принесу носитель", "Нет"]], "Выберите кнопку: Да или Нет.", Digitization.comment),
+        comment_step(Digitization),
+    ], [Field("Источник", "source"), Field("Количество", "qty"), Field("Носитель", "media")]),
+    # 5) Термопечать
+    Service("Термопечать", ThermoPrint, [
+        contact_step(ThermoPrint, ThermoPrint.item),
+        custom_step(ThermoPrint.item, "item", "На чём печать?",
+                    [["Футболка", "Кофта/Худи"], ["Кружка", "Свой вариант"]],
+                    ("Свой вариант", "Введите свой вариант (например: кепка):"), ThermoPrint.size),
+        custom_step(ThermoPrint.size, "size", "Размер принта:",
+                    [["Маленький", "Средний"], ["Большой", "Свой размер"]],
+                    ("Свой размер", "Введите свой размер/описание (например: 20×25 см):"), ThermoPrint.has_layout),
+        choice_step(ThermoPrint.has_layout, "has_layout", "Макет есть?", [["Есть макет", "Нет макета"]],
+                    "Выберите: Есть макет / Нет макета.",
+                    lambda d: ThermoPrint.files if d["has_layout"] == "Есть макет" else ThermoPrint.comment),
+        # макет логичнее требовать хотя бы один файл, но оставим мягко
+        Step(ThermoPrint.files, "files", "Пришлите макет(ы). Когда закончите нажмите ГОТОВО.", done_kb,
+             next=ThermoPrint.comment,
+             check_done=lambda d: None if files_count(d) else
+             "Если макет есть, лучше приложить файл. Пришлите или нажмите /cancel и начните заново."),
+        comment_step(ThermoPrint),
+    ], [Field("На чём", "item"), Field("Размер", "size", admin_label="Размер принта"),
+        Field("Макет", "has_layout")]),
+    # 6) Реставрация фото (файлы опционально)
+    Service("Реставрация фото", Restoration, [
+        contact_step(Restoration, Restoration.task),
+        custom_step(Restoration.task, "task", "Что нужно сделать?",
+                    [["Убрать царапины/трещины", "Восстановить порванное"],
+                     ["Улучшить качество/резкость", "Раскрасить Ч/Б"],
+                     ["Убрать лишние объекты", "Свой вариант"]],
+                    ("Свой вариант", "Опишите, что нужно сделать:"), Restoration.files),
+        Step(Restoration.files, "files", "Прикрепите фото (если есть). Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.",
+             done_or_skip_files_kb, skip=SKIP_FILES, next=Restoration.comment,
+             ack="Ещё файлы или ГОТОВО / ПРОПУСТИТЬ ФАЙЛЫ."),
+        comment_step(Restoration),
+    ], [Field("Задача", "task")]),
+    # 7) Визитки/буклеты/наклейки
+    Service("Визитки/буклеты/наклейки", PrintProducts, [
+        contact_step(PrintProducts, PrintProducts.product_type),
+        choice_step(PrintProducts.product_type, "product_type", "Что печатаем?", [["Визитки", "Буклеты", "Наклейки"]],
+                    "Выберите кнопку: Визитки / Буклеты / Наклейки.", PrintProducts.tirage),
+        int_step(PrintProducts.tirage, "tirage", "Тираж (количество) (числом):",
+                 "Введите тираж числом (например 100).", PrintProducts.format),
+        custom_step(PrintProducts.format, "format", "Размер/формат:", [["Стандартный", "Свой формат"]],
+                    ("Свой формат", "Введите свой формат (например 90×50 мм):"), PrintProducts.color),
+        choice_step(PrintProducts.color, "color", "Цветность:", [["Ч/Б", "Цветная"]],
+                    "Выберите: Ч/Б или Цветная.", PrintProducts.has_layout),
+        choice_step(PrintProducts.has_layout, "has_layout", "Макет есть?", [["Есть макет", "Нет макета"]],
+                    "Выберите: Есть макет / Нет макета.",
+                    lambda d: PrintProducts.files if d["has_layout"] == "Есть макет" else PrintProducts.need_design),
+        # если дизайн нужен, файлов нет; если не нужен, всё равно можно приложить
+        choice_step(PrintProducts.need_design, "need_design", "Нужно разработать дизайн?",
+                    [["Нужен дизайн", "Дизайн не нужен"]],
+                    "Выберите кнопку: Нужен дизайн / Дизайн не нужен.", PrintProducts.files),
+        Step(PrintProducts.files, "files", layout_files_prompt, skip=SKIP_FILES, next=PrintProducts.comment,
+             ack="Ещё файлы или ГОТОВО / ПРОПУСТИТЬ ФАЙЛЫ.",
+             check_done=lambda d: "Для печати по макету нужен файл. Пришлите макет."
+             if d.get("has_layout") == "Есть макет" and not files_count(d) else None,
+             check_skip=lambda d: "Если макет есть, пришлите файл. Иначе выберите «Нет макета» и идём дальше."
+             if d.get("has_layout") == "Есть макет" else None),
+        comment_step(PrintProducts),
+    ], [Field("Тип", "product_type"), Field("Тираж", "tirage"), Field("Формат", "format"),
+        Field("Цвет", "color"), Field("Макет", "has_layout"), Field("Дизайн", "need_design")]),
+    # 8) Фотошоп (файлы обязательны)
+    Service("Фотошоп", Photoshop, [
+        contact_step(Photoshop, Photoshop.task),
+        custom_step(Photoshop.task, "task", "Задача:",
+                    [["Ретушь", "Замена фона"], ["Удаление объектов", "Коллаж"],
+                     ["Восстановление", "Подготовка к печати"], ["Другое"]],
+                    ("Другое", "Опишите задачу своими словами:"), Photoshop.dont_change),
+        Step(Photoshop.dont_change, "text", "Что точно нельзя менять? (или ПРОПУСТИТЬ)", skip_kb,
+             key="dont_change", skip=SKIP, next=Photoshop.files),
+        Step(Photoshop.files, "files", "Пришлите исходники (файлы обязательны). Когда закончите нажмите ГОТОВО.",
+             done_kb, next=Photoshop.comment,
+             check_done=lambda d: None if files_count(d) else
+             "Для фотошопа нужны исходники. Пришлите хотя бы один файл."),
+        comment_step(Photoshop),
+    ], [Field("Задача", "task"), Field("Нельзя менять", "dont_change", blank_dash=True)],
+        note="Примечание: подделку документов не делаем."),
+    # 9) Другое (описание + файлы опционально)
+    Service("Другое", Other, [
+        contact_step(Other, Other.desc),
+        Step(Other.desc, "text", "Опишите, что нужно сделать:", remove_kb, key="desc", next=Other.files),
+        Step(Other.files, "files", "Если нужно, прикрепите файлы. Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.",
+             done_or_skip_files_kb, skip=SKIP_FILES, next=Other.comment,
+             ack="Ещё файлы или ГОТОВО / ПРОПУСТИТЬ ФАЙЛЫ."),
+        comment_step(Other),
+    ], [Field("Описание", "desc")]),
+]
+
+SERVICES: Dict[str, Service] = {s.name: s for s in SERVICE_LIST}
+FLOW_STEPS: Dict[str, Step] = {step.state.state: step for s in SERVICE_LIST for step in s.steps}
+FLOW_CONFIRM: Dict[str, Service] = {s.group.confirm.state: s for s in SERVICE_LIST}
+ORDER_TEMPLATE = order_template([])  # на случай заявки без известной услуги
+STEP_BUTTONS: Dict[str, FrozenSet[str]] = {k: step.buttons() for k, step in FLOW_STEPS.items()}
+
+async def enter_step(message: types.Message, state: FSMContext, target: State, data: OrderDraft):
+    service = FLOW_CONFIRM.get(target.state)
+    if service is not None:
+        await state.set_state(target)
+        await message.answer(render_cached(service.name, service.confirm_tpl, data), reply_markup=confirm_kb)
         return
-    await state.update_data(qty=int(message.text.strip()))
-    await state.set_state(Digitization.media_confirm)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Да, принесу носитель"), KeyboardButton(text="Нет")]],
-        resize_keyboard=True
-    )
-    await message.answer("Результат отдаём только на съёмный носитель клиента. Принесёте?", reply_markup=kb)
-
-@dp.message(Digitization.media_confirm)
-async def digi_media(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Да, принесу носитель", "Нет"}:
-        await message.answer("Выберите кнопку: Да или Нет.")
+    step = FLOW_STEPS[target.state]
+    await state.set_state(target)
+    if callable(step.prompt):
+        text, kb = step.prompt(data)
+    else:
+        text, kb = step.prompt, step.keyboard
+    await message.answer(text, reply_markup=kb)
+
+async def save_and_next(message: types.Message, state: FSMContext, step: Step, value: Any):
+    draft = await load_draft(state)
+    draft.set(step.key, value)
+    await save_draft(state, draft)
+    target = step.next if isinstance(step.next, State) else step.next(draft)
+    await enter_step(message, state, target, draft)
+
+def in_order_flow(message: types.Message, raw_state: Optional[str] = None) -> bool:
+    return raw_state in FLOW_STEPS
+
+@dp.message(in_order_flow)
+async def flow_step(message: types.Message, state: FSMContext, raw_state: str,
+                    album: Optional[List[types.Message]] = None):
+    step = FLOW_STEPS[raw_state]
+    text = message.text or ""
+    # кнопка другой услуги из меню начинает оформление заново, если это не ответ на текущий шаг
+    if text in SERVICES and text not in STEP_BUTTONS[raw_state]:
+        raise SkipHandler()
+
+    if step.kind == "files":
+        if message.photo or message.document:
+            total = await add_files_to_state(album or [message], state)
+            if album is None:
+                await message.answer("Принято. " + step.ack)
+            else:
+                await message.answer(f"Принято файлов: {len(album)} (всего {total}). " + step.ack)
+            return
+        if text == DONE:
+            check = step.check_done
+        elif step.skip is not None and text == step.skip:
+            check = step.check_skip
+        else:
+            raise SkipHandler()
+        draft = await load_draft(state)
+        error = check(draft) if check else None
+        if error:
+            await message.answer(error)
+            return
+        await enter_step(message, state, step.next, draft)
         return
-    await state.update_data(media=message.text)
-    await ask_comment(message, state, Digitization.comment)
 
-@dp.message(Digitization.comment, F.text == "ПРОПУСТИТЬ")
-async def digi_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await digi_confirm(message, state)
-
-@dp.message(Digitization.comment)
-async def digi_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await digi_confirm(message, state)
-
-async def digi_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Источник: {data['source']}\n"
-        f"Количество: {data['qty']}\n"
-        f"Носитель: {data.get('media','-')}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(Digitization.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- 5) Термопечать -----------------
+    if step.kind == "phone":
+        phone = normalize_phone(text)
+        if not phone:
+            await message.answer(step.error)
+            return
+        await save_and_next(message, state, step, phone)
+    elif step.kind == "choice":
+        if (text.lower() if step.lower else text) not in step.choices:
+            await message.answer(step.error)
+            return
+        await save_and_next(message, state, step, message.text)
+    elif step.kind == "int":
+        if not is_positive_int(text):
+            await message.answer(step.error)
+            return
+        await save_and_next(message, state, step, int(text.strip()))
+    else:
+        txt = text.strip()
+        if step.custom is not None and txt == step.custom[0]:
+            await message.answer(step.custom[1], reply_markup=remove_kb)
+            return
+        if step.skip is not None and message.text == step.skip:
+            txt = ""
+        elif step.required and not txt:
+            await message.answer(step.error)
+            return
+        await save_and_next(message, state, step, txt)
+
+@dp.message(F.text.in_(SERVICES))
+async def service_start(message: types.Message, state: FSMContext):
+    service = SERVICES[message.text]
+    draft = OrderDraft(service=service.name, draft_id=uuid.uuid4().hex[:16])
+    await state.set_data({DRAFT_KEY: draft.dump()})
+    await enter_step(message, state, service.group.contact, draft)
 
-@dp.message(F.text == "Термопечать")
-async def thermo_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Термопечать", files=[])
-    await ask_contact(message, state, ThermoPrint.contact)
-
-@dp.message(ThermoPrint.contact)
-async def thermo_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
-        return
-    await state.update_data(contact=phone)
-    await state.set_state(ThermoPrint.item)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Футболка"), KeyboardButton(text="Кофта/Худи")],
-            [KeyboardButton(text="Кружка"), KeyboardButton(text="Свой вариант")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("На чём печать?", reply_markup=kb)
+# ----------------- Finalize common -----------------
 
-@dp.message(ThermoPrint.item)
-async def thermo_item(message: types.Message, state: FSMContext):
-    txt = (message.text or "").strip()
-    if txt == "Свой вариант":
-        await message.answer("Введите свой вариант (например: кепка):", reply_markup=ReplyKeyboardRemove())
+FINALIZE_DEDUP_SIZE = int(os.getenv("FINALIZE_DEDUP_SIZE", "50000"))
+FINALIZE_DEDUP_TTL = float(os.getenv("FINALIZE_DEDUP_TTL", str(48 * 3600)))
+
+class FinalizeIndex:
+    # Уже оформленные заказы по ключам идемпотентности: ("draft", draft_id) и ("update", update_id).
+    # OrderedDict в порядке добавления: просроченные и лишние записи снимаются с головы,
+    # поиск и вставка — O(1). После рестарта заполняется из базы заказов за FINALIZE_DEDUP_TTL.
+
+    def __init__(self, size: int = FINALIZE_DEDUP_SIZE, ttl: float = FINALIZE_DEDUP_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._items: "OrderedDict[Tuple[str, Any], Tuple[int, float]]" = OrderedDict()
+        # заказы, уже записанные в журнал, но не в базу: повтор берёт тот же номер и время
+        self._held: Dict[Tuple[str, Any], Tuple[int, str]] = {}
+
+    @staticmethod
+    def keys(draft_id: Optional[str], update_id: Optional[int]) -> List[Tuple[str, Any]]:
+        keys = []
+        if draft_id:
+            keys.append(("draft", draft_id))
+        if update_id is not None:
+            keys.append(("update", update_id))
+        return keys
+
+    def get(self, draft_id: Optional[str], update_id: Optional[int] = None) -> Optional[int]:
+        now = time.time()
+        for key in self.keys(draft_id, update_id):
+            item = self._items.get(key)
+            if item is not None and item[1] > now:
+                return item[0]
+        return None
+
+    def put(self, order_no: int, draft_id: Optional[str], update_id: Optional[int],
+            at: Optional[float] = None) -> None:
+        expires = (time.time() if at is None else at) + self.ttl
+        for key in self.keys(draft_id, update_id):
+            self._items[key] = (order_no, expires)
+            self._items.move_to_end(key)
+        now = time.time()
+        while self._items and (len(self._items) > self.size or next(iter(self._items.values()))[1] <= now):
+            self._items.popitem(last=False)
+
+    def discard(self, draft_id: Optional[str], update_id: Optional[int]) -> None:
+        for key in self.keys(draft_id, update_id):
+            self._items.pop(key, None)
+
+    def hold(self, order_no: int, created_at: str, draft_id: Optional[str], update_id: Optional[int]) -> None:
+        for key in self.keys(draft_id, update_id):
+            self._held[key] = (order_no, created_at)
+
+    def held(self, draft_id: Optional[str], update_id: Optional[int]) -> Optional[Tuple[int, str]]:
+        for key in self.keys(draft_id, update_id):
+            if key in self._held:
+                return self._held[key]
+        return None
+
+    def release(self, draft_id: Optional[str], update_id: Optional[int]) -> None:
+        for key in self.keys(draft_id, update_id):
+            self._held.pop(key, None)
+
+    async def load(self, store: "OrderStore") -> int:
+        since = datetime.fromtimestamp(time.time() - self.ttl).strftime("%Y-%m-%d %H:%M:%S")
+        rows = await store.recent_keys(since)
+        for order_no, created_at, draft_id, update_id in sorted(rows, key=lambda r: r[1]):
+            if draft_id or update_id is not None:
+                at = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").timestamp()
+                self.put(order_no, draft_id, update_id, at=at)
+        return len(self._items)
+
+finalize_index = FinalizeIndex()
+
+async def answer_already_placed(message: types.Message, state: FSMContext, draft_id: str, order_no: int):
+    metrics.inc("bot_finalize_repeats_total")
+    await message.answer(f"✅ Эта заявка уже принята. Номер заказа: {order_no}\nОжидайте, мы свяжемся с вами.",
+                         reply_markup=start_kb)
+    await keep_only_draft_id(state, draft_id)
+
+async def keep_only_draft_id(state: FSMContext, draft_id: str):
+    # сценарий закончен, но id черновика остаётся: повторное «Отправить» найдёт заказ по нему
+    await state.set_state(None)
+    await state.set_data({DRAFT_KEY: OrderDraft(draft_id=draft_id).dump()} if draft_id else {})
+
+async def finalize_order(message: types.Message, state: FSMContext, update_id: Optional[int] = None):
+    draft = await load_draft(state)
+    placed = finalize_index.get(draft.draft_id, update_id)
+    if placed is not None:
+        await answer_already_placed(message, state, draft.draft_id, placed)
         return
-    if txt not in {"Футболка", "Кофта/Худи", "Кружка"}:
-        # если пользователь вводом написал своё
-        await state.update_data(item=txt)
+    held = finalize_index.held(draft.draft_id, update_id)
+    if held is not None:
+        # прошлая попытка записала заказ в журнал, но не в базу: тот же номер, без второго блока
+        order_no, created_at = held
     else:
-        await state.update_data(item=txt)
-
-    await state.set_state(ThermoPrint.size)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Маленький"), KeyboardButton(text="Средний")],
-            [KeyboardButton(text="Большой"), KeyboardButton(text="Свой размер")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Размер принта:", reply_markup=kb)
-
-@dp.message(ThermoPrint.size)
-async def thermo_size(message: types.Message, state: FSMContext):
-    txt = (message.text or "").strip()
-    if txt == "Свой размер":
-        await message.answer("Введите свой размер/описание (например: 20×25 см):", reply_markup=ReplyKeyboardRemove())
-        return
-    await state.update_data(size=txt)
-    await state.set_state(ThermoPrint.has_layout)
+        order_no, created_at = await next_order_number(), now_str()
+    finalize_index.put(order_no, draft.draft_id, update_id)
+    client = user_ref(message.from_user)
+
+    service = SERVICES.get(draft.service)
+    template = service.order_tpl if service is not None else ORDER_TEMPLATE
+    text = template.render(draft, order_no, created_at, client)
+    files = draft.file_items()
+
+    try:
+        if held is None:
+            await append_order(text, durable=True)
+    except BaseException:
+        # заказ никуда не записан — повтор оформит его заново, а не ответит «уже принята»
+        finalize_index.discard(draft.draft_id, update_id)
+        raise
+    order = {
+        **draft.to_dict(),
+        "order_no": order_no,
+        "created_at": created_at,
+        "client": client,
+        "user_id": message.from_user.id,
+        "files_count": len(files),
+        "draft_id": draft.draft_id or None,
+        "update_id": update_id,
+    }
+    try:
+        await outbox.enqueue(order_no, ADMIN_ID, "📥 НОВАЯ ЗАЯВКА\n\n" + text, files, order=order)
+    except BaseException:
+        # блок уже в журнале: повтор досохранит этот же заказ в базу и outbox
+        finalize_index.discard(draft.draft_id, update_id)
+        finalize_index.hold(order_no, created_at, draft.draft_id, update_id)
+        raise
+    finalize_index.release(draft.draft_id, update_id)
+    order_stats.add(order)
+    await media_cache.submit(order_no, files)
+    dp.throttle.confirmed(state.key)
 
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Есть макет"), KeyboardButton(text="Нет макета")]],
-        resize_keyboard=True
+    await message.answer(
+        f"✅ Заявка принята. Номер заказа: {order_no}\nОжидайте, мы свяжемся с вами.",
+        reply_markup=start_kb
     )
-    await message.answer("Макет есть?", reply_markup=kb)
+    await keep_only_draft_id(state, draft.draft_id)
 
-@dp.message(ThermoPrint.has_layout)
-async def thermo_has_layout(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Есть макет", "Нет макета"}:
-        await message.answer("Выберите: Есть макет / Нет макета.")
+@dp.message(F.text == "✅ Отправить")
+async def confirm_send(message: types.Message, state: FSMContext, event_update: types.Update):
+    cur = await state.get_state()
+    if cur in FLOW_CONFIRM:
+        await finalize_order(message, state, event_update.update_id)
         return
-    await state.update_data(has_layout=message.text)
-    if message.text == "Есть макет":
-        await state.set_state(ThermoPrint.files)
-        await message.answer("Пришлите макет(ы). Когда закончите нажмите ГОТОВО.", reply_markup=done_kb)
+    draft_id = (await load_draft(state)).draft_id
+    placed = finalize_index.get(draft_id, event_update.update_id)
+    if placed is not None:
+        await answer_already_placed(message, state, draft_id, placed)
     else:
-        await ask_comment(message, state, ThermoPrint.comment)
+        await message.answer("Сначала оформим заказ. Нажмите «Создать заказ».", reply_markup=start_kb)
 
-@dp.message(ThermoPrint.files, F.photo | F.document)
-async def thermo_files_add(message: types.Message, state: FSMContext):
-    await add_file_to_state(message, state)
-    await message.answer("Принято. Ещё файлы или ГОТОВО.")
+# ----------------- export -----------------
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_BASE_COLUMNS = ["order_no", "created_at", "service", "client", "user_id", "contact"]
+EXPORT_TAIL_COLUMNS = ["files_count", "comment"]
+
+def export_columns(service: Optional[Service] = None) -> List[str]:
+    # общие колонки + поля услуги (или всех услуг, если фильтра нет), в порядке анкеты
+    columns = list(EXPORT_BASE_COLUMNS)
+    for s in [service] if service else SERVICE_LIST:
+        for f in s.fields:
+            if f.key not in columns:
+                columns.append(f.key)
+    return columns + EXPORT_TAIL_COLUMNS
+
+def find_service(name: str) -> Optional[Service]:
+    name = name.strip().lower()
+    for s in SERVICE_LIST:
+        if s.name.lower() == name:
+            return s
+    found = [s for s in SERVICE_LIST if s.name.lower().startswith(name)]
+    return found[0] if len(found) == 1 else None
+
+def date_bounds(value: str) -> Optional[Tuple[str, str]]:
+    # "2025", "2025-06" или "2025-06-15" -> (since, until) включительно, как в OrderLog.iter_blocks
+    if re.fullmatch(r"\d{4}", value):
+        return value + "-01-01", value + "-12-31"
+    if re.fullmatch(r"\d{4}-\d{2}", value):
+        return value + "-01", value + "-31"
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", value):
+        return value, value
+    return None
 
-@dp.message(ThermoPrint.files, F.text == "ГОТОВО")
-async def thermo_files_done(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    # макет логичнее требовать хотя бы один файл, но оставим мягко:
-    if len(data.get("files", [])) == 0:
-        await message.answer("Если макет есть, лучше приложить файл. Пришлите или нажмите /cancel и начните заново.")
+def export_orders(log: OrderLog, since: str = "", until: str = "", service: Optional[Service] = None):
+    # блоки журнала -> заказы; читаются только нужные сегменты, в памяти один заказ за раз
+    for block in log.iter_blocks(since=since, until=until):
+        order = parse_order_text(block)
+        if order is None or service is not None and order.get("service") != service.name:
+            continue
+        yield order
+
+def csv_lines(orders, columns: List[str]):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";")  # Excel с русской локалью ждёт ";"
+    writer.writerow(columns)
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    for order in orders:
+        writer.writerow(["" if order.get(c) is None else order.get(c) for c in columns])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def jsonl_lines(orders, columns: List[str]):
+    for order in orders:
+        yield json.dumps({c: order.get(c) for c in columns if c in order}, ensure_ascii=False) + "\n"
+
+def write_export(path: str, fmt: str, orders, columns: List[str]) -> int:
+    # пишет во временный файл и переименовывает; возвращает число заказов
+    lines = csv_lines(orders, columns) if fmt == "csv" else jsonl_lines(orders, columns)
+    count = -1 if fmt == "csv" else 0  # у CSV первая строка — заголовок
+    with atomic_file(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as f:
+        for line in lines:
+            f.write(line)
+            count += 1
+    return max(count, 0)
+
+def export_file(fmt: str, since: str, until: str, service: Optional[Service], out_dir: str = EXPORT_DIR) -> Tuple[str, int]:
+    os.makedirs(out_dir, exist_ok=True)
+    name = "orders"
+    if since or until:
+        name += f"_{since or 'start'}_{until or 'now'}"
+    if service is not None:
+        name += f"_{SERVICE_LIST.index(service) + 1}"
+    path = os.path.join(out_dir, f"{name}.{fmt}")
+    count = write_export(path, fmt, export_orders(order_log, since, until, service), export_columns(service))
+    return path, count
+
+def parse_export_args(args: str) -> Tuple[str, str, str, Optional[Service], Optional[str]]:
+    # "/export [csv|jsonl] [период [период]] [услуга]" -> (fmt, since, until, service, ошибка)
+    fmt, dates, rest = "csv", [], []
+    for word in args.split():
+        if word.lower() in EXPORT_FORMATS and not dates and not rest:
+            fmt = word.lower()
+        elif date_bounds(word) and not rest and len(dates) < 2:
+            dates.append(date_bounds(word))
+        else:
+            rest.append(word)
+    since = dates[0][0] if dates else ""
+    until = dates[-1][1] if dates else ""
+    service = None
+    if rest:
+        service = find_service(" ".join(rest))
+        if service is None:
+            names = ", ".join(s.name for s in SERVICE_LIST)
+            return fmt, since, until, None, f"Не нашёл услугу «{' '.join(rest)}». Услуги: {names}."
+    return fmt, since, until, service, None
+
+def export_cli(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="bot.py export", description="Выгрузка заказов из журнала в CSV/JSONL")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--since", default="", help="2025, 2025-06 или 2025-06-15")
+    parser.add_argument("--until", default="", help="включительно, в том же виде")
+    parser.add_argument("--service", default="", help="название услуги или его начало")
+    parser.add_argument("--out-dir", default=EXPORT_DIR)
+    args = parser.parse_args(argv)
+    since = date_bounds(args.since) if args.since else ("", "")
+    until = date_bounds(args.until) if args.until else ("", "")
+    if since is None or until is None:
+        parser.error("даты — в виде 2025, 2025-06 или 2025-06-15")
+    service = find_service(args.service) if args.service else None
+    if args.service and service is None:
+        parser.error(f"не знаю услугу: {args.service}")
+    order_log.recover()
+    path, count = export_file(args.format, since[0], until[1], service, args.out_dir)
+    print(f"{count} orders -> {path}")
+
+# ----------------- admin commands -----------------
+
+is_admin = F.from_user.id == ADMIN_ID
+
+async def answer_lines(message: types.Message, lines: List[str], limit: int = 4000):
+    # длинный ответ режем на сообщения по границам строк (лимит Telegram — 4096 символов)
+    chunk: List[str] = []
+    size = 0
+    for line in lines:
+        if chunk and size + len(line) + 1 > limit:
+            await message.answer("\n".join(chunk))
+            chunk, size = [], 0
+        chunk.append(line[:limit])
+        size += len(line) + 1
+    if chunk:
+        await message.answer("\n".join(chunk))
+
+def order_no_arg(command: CommandObject) -> Optional[int]:
+    arg = (command.args or "").strip().lstrip("№#")
+    return int(arg) if arg.isdigit() else None
+
+@dp.message(Command("files"), is_admin)
+async def cmd_files(message: types.Message, command: CommandObject):
+    order_no = order_no_arg(command)
+    if order_no is None:
+        await message.answer("Использование: /files <номер заказа>")
         return
-    await ask_comment(message, state, ThermoPrint.comment)
-
-@dp.message(ThermoPrint.comment, F.text == "ПРОПУСТИТЬ")
-async def thermo_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await thermo_confirm(message, state)
-
-@dp.message(ThermoPrint.comment)
-async def thermo_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await thermo_confirm(message, state)
-
-async def thermo_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"На чём: {data.get('item','-')}\n"
-        f"Размер: {data.get('size','-')}\n"
-        f"Макет: {data.get('has_layout','-')}\n"
-        f"Файлов: {len(data.get('files', []))}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(ThermoPrint.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- 6) Реставрация фото (файлы опционально) -----------------
-
-@dp.message(F.text == "Реставрация фото")
-async def rest_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Реставрация фото", files=[])
-    await ask_contact(message, state, Restoration.contact)
-
-@dp.message(Restoration.contact)
-async def rest_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
+    if not media_cache.enabled:
+        await message.answer("Локальный кэш файлов выключен (MEDIA_CACHE_DIR не задан).")
         return
-    await state.update_data(contact=phone)
-    await state.set_state(Restoration.task)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Убрать царапины/трещины"), KeyboardButton(text="Восстановить порванное")],
-            [KeyboardButton(text="Улучшить качество/резкость"), KeyboardButton(text="Раскрасить Ч/Б")],
-            [KeyboardButton(text="Убрать лишние объекты"), KeyboardButton(text="Свой вариант")],
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Что нужно сделать?", reply_markup=kb)
-
-@dp.message(Restoration.task)
-async def rest_task(message: types.Message, state: FSMContext):
-    txt = (message.text or "").strip()
-    if txt == "Свой вариант":
-        await message.answer("Опишите, что нужно сделать:", reply_markup=ReplyKeyboardRemove())
+    files = await media_cache.order_files(order_no)
+    if not files:
+        await message.answer(f"У заказа №{order_no} нет файлов в кэше.")
         return
-    await state.update_data(task=txt)
-    await state.set_state(Restoration.files)
-    await message.answer("Прикрепите фото (если есть). Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.", reply_markup=done_or_skip_files_kb)
-
-@dp.message(Restoration.files, F.photo | F.document)
-async def rest_files_add(message: types.Message, state: FSMContext):
-    await add_file_to_state(message, state)
-    await message.answer("Принято. Ещё файлы или ГОТОВО / ПРОПУСТИТЬ ФАЙЛЫ.")
-
-@dp.message(Restoration.files, F.text == "ПРОПУСТИТЬ ФАЙЛЫ")
-async def rest_files_skip(message: types.Message, state: FSMContext):
-    await ask_comment(message, state, Restoration.comment)
-
-@dp.message(Restoration.files, F.text == "ГОТОВО")
-async def rest_files_done(message: types.Message, state: FSMContext):
-    await ask_comment(message, state, Restoration.comment)
-
-@dp.message(Restoration.comment, F.text == "ПРОПУСТИТЬ")
-async def rest_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await rest_confirm(message, state)
-
-@dp.message(Restoration.comment)
-async def rest_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await rest_confirm(message, state)
-
-async def rest_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Задача: {data.get('task','-')}\n"
-        f"Файлов: {len(data.get('files', []))}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(Restoration.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- 7) Визитки/буклеты/наклейки -----------------
-
-@dp.message(F.text == "Визитки/буклеты/наклейки")
-async def prod_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Визитки/буклеты/наклейки", files=[])
-    await ask_contact(message, state, PrintProducts.contact)
-
-@dp.message(PrintProducts.contact)
-async def prod_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
+    lines = [f"Файлы заказа №{order_no}:"]
+    for f in files:
+        where = f["path"] or ("ошибка: " + f["error"] if f["error"] else "ещё не скачан")
+        lines.append(f"{f['seq'] + 1}. {f['kind']}: {where}")
+    await answer_lines(message, lines)
+
+def order_summary(order: dict) -> str:
+    return (f"№{order['order_no']} · {order.get('created_at', '')[:16]} · {order.get('service') or '-'} · "
+            f"{order.get('contact') or '-'} · {order.get('client') or '-'}")
+
+def order_line(order_no: int, block: Optional[str]) -> str:
+    order = parse_order_text(block) if block else None
+    return order_summary(order) if order is not None else f"№{order_no}"
+
+@dp.message(Command("find"), is_admin)
+async def cmd_find(message: types.Message, command: CommandObject):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Использование: /find <телефон, @username, имя или слово из заказа>")
         return
-    await state.update_data(contact=phone)
-    await state.set_state(PrintProducts.product_type)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Визитки"), KeyboardButton(text="Буклеты"), KeyboardButton(text="Наклейки")]],
-        resize_keyboard=True
-    )
-    await message.answer("Что печатаем?", reply_markup=kb)
-
-@dp.message(PrintProducts.product_type)
-async def prod_type(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Визитки", "Буклеты", "Наклейки"}:
-        await message.answer("Выберите кнопку: Визитки / Буклеты / Наклейки.")
+    found = order_index.search(query)
+    if not found:
+        await message.answer("Ничего не найдено.")
         return
-    await state.update_data(product_type=message.text)
-    await state.set_state(PrintProducts.tirage)
-    await message.answer("Тираж (количество) (числом):", reply_markup=ReplyKeyboardRemove())
-
-@dp.message(PrintProducts.tirage)
-async def prod_tirage(message: types.Message, state: FSMContext):
-    if not is_positive_int(message.text or ""):
-        await message.answer("Введите тираж числом (например 100).")
+    await answer_lines(message, [f"Найдено (последние {len(found)}):"] +
+                       [order_line(n, order_index.read(n)) for n in found])
+
+@dp.message(Command("order"), is_admin)
+async def cmd_order(message: types.Message, command: CommandObject):
+    order_no = order_no_arg(command)
+    if order_no is None:
+        await message.answer("Использование: /order <номер заказа>")
         return
-    await state.update_data(tirage=int(message.text.strip()))
-    await state.set_state(PrintProducts.format)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Стандартный"), KeyboardButton(text="Свой формат")]],
-        resize_keyboard=True
-    )
-    await message.answer("Размер/формат:", reply_markup=kb)
-
-@dp.message(PrintProducts.format)
-async def prod_format(message: types.Message, state: FSMContext):
-    txt = (message.text or "").strip()
-    if txt == "Свой формат":
-        await message.answer("Введите свой формат (например 90×50 мм):", reply_markup=ReplyKeyboardRemove())
+    block = order_index.read(order_no)
+    await message.answer(block if block else f"Заказ №{order_no} не найден.")
+
+@dp.message(Command("today"), is_admin)
+async def cmd_today(message: types.Message, command: CommandObject):
+    name = (command.args or "").strip()
+    if not name:
+        # все заказы дня — из индекса журнала в памяти
+        found = order_index.today()
+        if not found:
+            await message.answer("Сегодня заказов нет.")
+            return
+        await answer_lines(message, [f"Заказы за сегодня: {len(found)}"] +
+                           [order_line(n, order_index.read(n)) for n in found])
         return
-    await state.update_data(format=txt)
-    await state.set_state(PrintProducts.color)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Ч/Б"), KeyboardButton(text="Цветная")]],
-        resize_keyboard=True
-    )
-    await message.answer("Цветность:", reply_markup=kb)
-
-@dp.message(PrintProducts.color)
-async def prod_color(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Ч/Б", "Цветная"}:
-        await message.answer("Выберите: Ч/Б или Цветная.")
+    service = find_service(name)
+    if service is None:
+        await message.answer(f"Не нашёл услугу «{name}». Услуги: {', '.join(s.name for s in SERVICE_LIST)}.")
         return
-    await state.update_data(color=message.text)
-    await state.set_state(PrintProducts.has_layout)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Есть макет"), KeyboardButton(text="Нет макета")]],
-        resize_keyboard=True
-    )
-    await message.answer("Макет есть?", reply_markup=kb)
-
-@dp.message(PrintProducts.has_layout)
-async def prod_has_layout(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Есть макет", "Нет макета"}:
-        await message.answer("Выберите: Есть макет / Нет макета.")
+    now = datetime.now()
+    since, until = now.strftime("%Y-%m-%d"), (now + timedelta(days=1)).strftime("%Y-%m-%d")
+    orders = await order_store.by_service(service.name, since, until)
+    if not orders:
+        await message.answer(f"Сегодня заказов «{service.name}» нет.")
         return
-    await state.update_data(has_layout=message.text)
-    if message.text == "Есть макет":
-        await state.set_state(PrintProducts.files)
-        await message.answer("Пришлите макет(ы). Когда закончите нажмите ГОТОВО.", reply_markup=done_kb)
-    else:
-        await state.set_state(PrintProducts.need_design)
-        kb = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="Нужен дизайн"), KeyboardButton(text="Дизайн не нужен")]],
-            resize_keyboard=True
-        )
-        await message.answer("Нужно разработать дизайн?", reply_markup=kb)
-
-@dp.message(PrintProducts.need_design)
-async def prod_need_design(message: types.Message, state: FSMContext):
-    if (message.text or "") not in {"Нужен дизайн", "Дизайн не нужен"}:
-        await message.answer("Выберите кнопку: Нужен дизайн / Дизайн не нужен.")
+    await answer_lines(message, [f"Заказы «{service.name}» за сегодня: {len(orders)}"] +
+                       [order_summary(o) for o in orders])
+
+def stats_lines(title: str, total: dict) -> List[str]:
+    lines = [f"{title}: заказов {total['orders']}, файлов {total['files']}, копий {total['copies']}"]
+    for name, (orders, units) in sorted(total["svc"].items(), key=lambda x: -x[1][0]):
+        lines.append(f"  {name}: {orders} (шт.: {units})")
+    return lines
+
+@dp.message(Command("stats"), is_admin)
+async def cmd_stats(message: types.Message):
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    last7 = [(now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
+    last30 = [(now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(30)]
+    week = stats_keys(now_str())[2]
+    lines = (stats_lines("Сегодня", order_stats.merged("day", [today])) +
+             stats_lines(f"Неделя {week}", order_stats.merged("week", [week])) +
+             stats_lines("7 дней", order_stats.merged("day", last7)) +
+             stats_lines("30 дней", order_stats.merged("day", last30)))
+    peaks = order_stats.peak_hours()
+    if peaks:
+        lines.append("Пиковые часы (7 дней): " + ", ".join(f"{h:02d}:00 — {n}" for h, n in peaks))
+    await answer_lines(message, lines)
+
+@dp.message(Command("zip"), is_admin)
+async def cmd_zip(message: types.Message, command: CommandObject):
+    order_no = order_no_arg(command)
+    if order_no is None:
+        await message.answer("Использование: /zip <номер заказа>")
         return
-    await state.update_data(need_design=message.text)
-    # если дизайн нужен, файлов нет; если не нужен, всё равно можно приложить
-    await state.set_state(PrintProducts.files)
-    await message.answer("Если есть материалы/логотипы, прикрепите файлы. Иначе нажмите ПРОПУСТИТЬ ФАЙЛЫ.", reply_markup=done_or_skip_files_kb)
-
-@dp.message(PrintProducts.files, F.photo | F.document)
-async def prod_files_add(message: types.Message, state: FSMContext):
-    await add_file_to_state(message, state)
-    await message.answer("Принято. Ещё файлы или ГОТОВО / ПРОПУСТИТЬ ФАЙЛЫ.")
-
-@dp.message(PrintProducts.files, F.text == "ПРОПУСТИТЬ ФАЙЛЫ")
-async def prod_files_skip(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    if data.get("has_layout") == "Есть макет":
-        await message.answer("Если макет есть, пришлите файл. Иначе выберите «Нет макета» и идём дальше.")
+    files = await order_zip_files(order_no)
+    if not files:
+        await message.answer(f"У заказа №{order_no} нет файлов.")
         return
-    await ask_comment(message, state, PrintProducts.comment)
-
-@dp.message(PrintProducts.files, F.text == "ГОТОВО")
-async def prod_files_done(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    if data.get("has_layout") == "Есть макет" and len(data.get("files", [])) == 0:
-        await message.answer("Для печати по макету нужен файл. Пришлите макет.")
+    await message.answer(f"Собираю архив заказа №{order_no} ({len(files)} файлов)…")
+    try:
+        path, size = await build_order_zip(order_no, files)
+    except Exception as e:
+        logging.exception("zip for order %s failed", order_no)
+        await message.answer(f"Не удалось собрать архив заказа №{order_no}: {e!r}")
         return
-    await ask_comment(message, state, PrintProducts.comment)
-
-@dp.message(PrintProducts.comment, F.text == "ПРОПУСТИТЬ")
-async def prod_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await prod_confirm(message, state)
-
-@dp.message(PrintProducts.comment)
-async def prod_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await prod_confirm(message, state)
-
-async def prod_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Тип: {data.get('product_type','-')}\n"
-        f"Тираж: {data.get('tirage','-')}\n"
-        f"Формат: {data.get('format','-')}\n"
-        f"Цвет: {data.get('color','-')}\n"
-        f"Макет: {data.get('has_layout','-')}\n"
-        f"Дизайн: {data.get('need_design','-')}\n"
-        f"Файлов: {len(data.get('files', []))}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(PrintProducts.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- 8) Фотошоп (файлы обязательны) -----------------
-
-@dp.message(F.text == "Фотошоп")
-async def ps_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Фотошоп", files=[])
-    await ask_contact(message, state, Photoshop.contact)
-
-@dp.message(Photoshop.contact)
-async def ps_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
+    if size > ZIP_MAX_UPLOAD:
+        await message.answer(f"Архив {size / 1024 ** 2:.0f} МБ — больше лимита отправки, он лежит здесь:\n"
+                             f"{os.path.abspath(path)}")
         return
-    await state.update_data(contact=phone)
-    await state.set_state(Photoshop.task)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Ретушь"), KeyboardButton(text="Замена фона")],
-            [KeyboardButton(text="Удаление объектов"), KeyboardButton(text="Коллаж")],
-            [KeyboardButton(text="Восстановление"), KeyboardButton(text="Подготовка к печати")],
-            [KeyboardButton(text="Другое")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Задача:", reply_markup=kb)
-
-@dp.message(Photoshop.task)
-async def ps_task(message: types.Message, state: FSMContext):
-    txt = (message.text or "").strip()
-    if txt == "Другое":
-        await message.answer("Опишите задачу своими словами:", reply_markup=ReplyKeyboardRemove())
+    try:
+        await send_with_retry(message.chat.id, lambda: bot.send_document(
+            message.chat.id, FSInputFile(path, filename=os.path.basename(path), chunk_size=MEDIA_CHUNK)))
+    finally:
+        os.remove(path)
+
+@dp.message(Command("export"), is_admin)
+async def cmd_export(message: types.Message, command: CommandObject):
+    fmt, since, until, service, error = parse_export_args(command.args or "")
+    if error:
+        await message.answer(error + "\nИспользование: /export [csv|jsonl] [2025 | 2025-06 | 2025-06-15 [по]] [услуга]")
         return
-    await state.update_data(task=txt)
-    await state.set_state(Photoshop.dont_change)
-    await message.answer("Что точно нельзя менять? (или ПРОПУСТИТЬ)", reply_markup=skip_kb)
-
-@dp.message(Photoshop.dont_change, F.text == "ПРОПУСТИТЬ")
-async def ps_dont_change_skip(message: types.Message, state: FSMContext):
-    await state.update_data(dont_change="")
-    await state.set_state(Photoshop.files)
-    await message.answer("Пришлите исходники (файлы обязательны). Когда закончите нажмите ГОТОВО.", reply_markup=done_kb)
-
-@dp.message(Photoshop.dont_change)
-async def ps_dont_change(message: types.Message, state: FSMContext):
-    await state.update_data(dont_change=(message.text or "").strip())
-    await state.set_state(Photoshop.files)
-    await message.answer("Пришлите исходники (файлы обязательны). Когда закончите нажмите ГОТОВО.", reply_markup=done_kb)
-
-@dp.message(Photoshop.files, F.photo | F.document)
-async def ps_files_add(message: types.Message, state: FSMContext):
-    await add_file_to_state(message, state)
-    await message.answer("Принято. Ещё файлы или ГОТОВО.")
-
-@dp.message(Photoshop.files, F.text == "ГОТОВО")
-async def ps_files_done(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    if len(data.get("files", [])) == 0:
-        await message.answer("Для фотошопа нужны исходники. Пришлите хотя бы один файл.")
+    path, count = await asyncio.to_thread(export_file, fmt, since, until, service)
+    if not count:
+        os.remove(path)
+        await message.answer("Заказов под эти условия нет.")
         return
-    await ask_comment(message, state, Photoshop.comment)
-
-@dp.message(Photoshop.comment, F.text == "ПРОПУСТИТЬ")
-async def ps_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await ps_confirm(message, state)
-
-@dp.message(Photoshop.comment)
-async def ps_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await ps_confirm(message, state)
-
-async def ps_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Задача: {data.get('task','-')}\n"
-        f"Нельзя менять: {data.get('dont_change') or '-'}\n"
-        f"Файлов: {len(data.get('files', []))}\n"
-        f"Комментарий: {data.get('comment') or '-'}\n\n"
-        "Примечание: подделку документов не делаем."
-    )
-    await state.set_state(Photoshop.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- 9) Другое (описание + файлы опционально) -----------------
-
-@dp.message(F.text == "Другое")
-async def other_start(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(service="Другое", files=[])
-    await ask_contact(message, state, Other.contact)
-
-@dp.message(Other.contact)
-async def other_contact(message: types.Message, state: FSMContext):
-    phone = normalize_phone(message.text or "")
-    if not phone:
-        await message.answer("Нужен номер на 8… (11 цифр). Пример: 89123456789")
+    size = os.path.getsize(path)
+    if size > ZIP_MAX_UPLOAD:
+        await message.answer(f"Выгрузка {size / 1024 ** 2:.0f} МБ — больше лимита отправки, она лежит здесь:\n"
+                             f"{os.path.abspath(path)}")
         return
-    await state.update_data(contact=phone)
-    await state.set_state(Other.desc)
-    await message.answer("Опишите, что нужно сделать:", reply_markup=ReplyKeyboardRemove())
-
-@dp.message(Other.desc)
-async def other_desc(message: types.Message, state: FSMContext):
-    await state.update_data(desc=(message.text or "").strip())
-    await state.set_state(Other.files)
-    await message.answer("Если нужно, прикрепите файлы. Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.", reply_markup=done_or_skip_files_kb)
-
-@dp.message(Other.files, F.photo | F.document)
-async def other_files_add(message: types.Message, state: FSMContext):
-    await add_file_to_state(message, state)
-    await message.answer("Принято. Ещё файлы или ГОТОВО / ПРОПУСТИТЬ ФАЙЛЫ.")
-
-@dp.message(Other.files, F.text == "ПРОПУСТИТЬ ФАЙЛЫ")
-async def other_files_skip(message: types.Message, state: FSMContext):
-    await ask_comment(message, state, Other.comment)
-
-@dp.message(Other.files, F.text == "ГОТОВО")
-async def other_files_done(message: types.Message, state: FSMContext):
-    await ask_comment(message, state, Other.comment)
-
-@dp.message(Other.comment, F.text == "ПРОПУСТИТЬ")
-async def other_comment_skip(message: types.Message, state: FSMContext):
-    await state.update_data(comment="")
-    await other_confirm(message, state)
-
-@dp.message(Other.comment)
-async def other_comment(message: types.Message, state: FSMContext):
-    await state.update_data(comment=(message.text or "").strip())
-    await other_confirm(message, state)
-
-async def other_confirm(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    summary = (
-        "Проверьте заказ:\n"
-        f"Услуга: {data['service']}\n"
-        f"Контакт: {data['contact']}\n"
-        f"Описание: {data.get('desc','-')}\n"
-        f"Файлов: {len(data.get('files', []))}\n"
-        f"Комментарий: {data.get('comment') or '-'}"
-    )
-    await state.set_state(Other.confirm)
-    await message.answer(summary + "\n\nВсё верно?", reply_markup=confirm_kb)
-
-# ----------------- Finalize common -----------------
-
-async def finalize_order(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    order_no = next_order_number()
-
-    text = (
-        f"Заказ №{order_no}\n"
-        f"Дата: {now_str()}\n"
-        f"Клиент: {user_ref(message.from_user)}\n"
-        f"Контакт: {data.get('contact','-')}\n"
-        f"Услуга: {data.get('service','-')}\n"
-    )
-
-    service = data.get("service")
-
-    if service == "Печать фото":
-        text += (
-            f"Размер: {data.get('size','-')}\n"
-            f"Бумага: {data.get('paper','-')}\n"
-            f"Копий: {data.get('copies','-')}\n"
-        )
-    elif service == "Печать документов":
-        text += (
-            f"Формат: {data.get('format','-')}\n"
-            f"Копий: {data.get('copies','-')}\n"
-            f"Цвет: {data.get('color','-')}\n"
-            f"Печать: {data.get('duplex','-')}\n"
-            f"Страницы: {data.get('pages','-')}\n"
-        )
-    elif service == "Фото на документы":
-        text += (
-            f"Документ: {data.get('doc_type','-')}\n"
-            f"Количество: {data.get('qty','-')}\n"
-            f"Цвет: {data.get('color','-')}\n"
-        )
-    elif service == "Оцифровка":
-        text += (
-            f"Источник: {data.get('source','-')}\n"
-            f"Количество: {data.get('qty','-')}\n"
-            f"Носитель: {data.get('media','-')}\n"
-        )
-    elif service == "Термопечать":
-        text += (
-            f"На чём: {data.get('item','-')}\n"
-            f"Размер принта: {data.get('size','-')}\n"
-            f"Макет: {data.get('has_layout','-')}\n"
-        )
-    elif service == "Реставрация фото":
-        text += f"Задача: {data.get('task','-')}\n"
-    elif service == "Визитки/буклеты/наклейки":
-        text += (
-            f"Тип: {data.get('product_type','-')}\n"
-            f"Тираж: {data.get('tirage','-')}\n"
-            f"Формат: {data.get('format','-')}\n"
-            f"Цвет: {data.get('color','-')}\n"
-            f"Макет: {data.get('has_layout','-')}\n"
-            f"Дизайн: {data.get('need_design','-')}\n"
-        )
-    elif service == "Фотошоп":
-        text += (
-            f"Задача: {data.get('task','-')}\n"
-            f"Нельзя менять: {data.get('dont_change') or '-'}\n"
-        )
-    elif service == "Другое":
-        text += f"Описание: {data.get('desc','-')}\n"
-
-    comment = data.get("comment") or ""
-    text += f"Комментарий: {comment if comment else '-'}\n"
-
-    files: List[FileItem] = data.get("files", [])
-    text += f"Файлов: {len(files)}\n"
-
-    append_order(text)
-
-    await bot.send_message(ADMIN_ID, "📥 НОВАЯ ЗАЯВКА\n\n" + text)
-    if files:
-        await send_files_to_admin(files)
-
-    await message.answer(
-        f"✅ Заявка принята. Номер заказа: {order_no}\nОжидайте, мы свяжемся с вами.",
-        reply_markup=start_kb
-    )
-    await state.clear()
-
-@dp.message(F.text == "✅ Отправить")
-async def confirm_send(message: types.Message, state: FSMContext):
-    cur = await state.get_state()
-    ok_states = {
-        PhotoPrint.confirm.state,
-        DocPrint.confirm.state,
-        IDPhoto.confirm.state,
-        Digitization.confirm.state,
-        ThermoPrint.confirm.state,
-        Restoration.confirm.state,
-        PrintProducts.confirm.state,
-        Photoshop.confirm.state,
-        Other.confirm.state,
-    }
-    if cur in ok_states:
-        await finalize_order(message, state)
-    else:
-        await message.answer("Сначала оформим заказ. Нажмите «Создать заказ».", reply_markup=start_kb)
-
-# ----------------- Missing branch fixups (inputs for 'Свой вариант' / 'Свой размер' / custom formats) -----------------
-# Эти три хендлера ловят свободный ввод там, где мы предложили "Свой ..." и попросили текст.
-
-@dp.message(F.text, ThermoPrint.item)
-async def thermo_item_custom(message: types.Message, state: FSMContext):
-    # сюда попадём, если пользователь после "Свой вариант" написал текст
-    await state.update_data(item=(message.text or "").strip())
-    await state.set_state(ThermoPrint.size)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Маленький"), KeyboardButton(text="Средний")],
-            [KeyboardButton(text="Большой"), KeyboardButton(text="Свой размер")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Размер принта:", reply_markup=kb)
-
-@dp.message(F.text, ThermoPrint.size)
-async def thermo_size_custom(message: types.Message, state: FSMContext):
-    # сюда попадём, если пользователь после "Свой размер" написал текст
-    await state.update_data(size=(message.text or "").strip())
-    await state.set_state(ThermoPrint.has_layout)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Есть макет"), KeyboardButton(text="Нет макета")]],
-        resize_keyboard=True
-    )
-    await message.answer("Макет есть?", reply_markup=kb)
-
-@dp.message(F.text, PrintProducts.format)
-async def prod_format_custom(message: types.Message, state: FSMContext):
-    # сюда попадём после "Свой формат" (ввёл вручную)
-    await state.update_data(format=(message.text or "").strip())
-    await state.set_state(PrintProducts.color)
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Ч/Б"), KeyboardButton(text="Цветная")]],
-        resize_keyboard=True
-    )
-    await message.answer("Цветность:", reply_markup=kb)
-
-@dp.message(F.text, Restoration.task)
-async def rest_task_custom(message: types.Message, state: FSMContext):
-    # после "Свой вариант" описали задачу
-    await state.update_data(task=(message.text or "").strip())
-    await state.set_state(Restoration.files)
-    await message.answer("Прикрепите фото (если есть). Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.", reply_markup=done_or_skip_files_kb)
-
-@dp.message(F.text, Photoshop.task)
-async def ps_task_custom(message: types.Message, state: FSMContext):
-    # после "Другое" описали задачу
-    await state.update_data(task=(message.text or "").strip())
-    await state.set_state(Photoshop.dont_change)
-    await message.answer("Что точно нельзя менять? (или ПРОПУСТИТЬ)", reply_markup=skip_kb)
+    try:
+        await send_with_retry(message.chat.id, lambda: bot.send_document(
+            message.chat.id, FSInputFile(path, filename=os.path.basename(path)), caption=f"Заказов: {count}"))
+    finally:
+        os.remove(path)
+
+def perf_lines(title: str, rows: List[Tuple[str, Histogram]], top: int = 8) -> List[str]:
+    # самые «дорогие» по суммарному времени: так видно и медленные, и просто частые
+    rows = sorted(rows, key=lambda r: -r[1].sum)[:top]
+    lines = [title] if rows else []
+    for name, hist in rows:
+        n = hist.count
+        lines.append(f"  {name}: {n} шт., ср. {hist.sum / n * 1000:.1f} мс, "
+                     f"p50 ≤ {hist.quantile(0.5) * 1000:g} мс, p99 ≤ {hist.quantile(0.99) * 1000:g} мс")
+    return lines
+
+@dp.message(Command("perf"), is_admin)
+async def cmd_perf(message: types.Message):
+    uptime = time.monotonic() - metrics.started
+    updates = sum(h.count for _, h in metrics.rows("bot_update_seconds"))
+    lines = [f"Аптайм {uptime / 3600:.1f} ч, апдейтов {updates} ({updates / max(uptime, 1):.2f}/с), "
+             f"в обработке {metrics.in_flight}"]
+    lines += perf_lines("Хендлеры:", metrics.rows("bot_handler_seconds"))
+    lines += perf_lines("Состояния:", metrics.rows("bot_state_seconds"), top=5)
+    lines += perf_lines("Bot API:", [r for r in metrics.rows("bot_api_seconds") if r[0] != "getUpdates"])
+    lat = outbox.latency()
+    if lat is not None and lat.count:
+        lines.append(f"Уведомления админу: {lat.count} шт., p50 ≤ {lat.quantile(0.5):g} с, "
+                     f"p99 ≤ {lat.quantile(0.99):g} с, в очереди {outbox.queue_depth}, не доставлено {outbox.dead}")
+    fsm_updates = metrics.total("bot_fsm_updates_total")
+    if fsm_updates:
+        lines.append(f"FSM: {metrics.total('bot_fsm_direct_ops_total') / fsm_updates:.1f} обращений -> "
+                     f"{metrics.total('bot_fsm_storage_ops_total') / fsm_updates:.1f} запросов к хранилищу "
+                     f"на апдейт, откатов {metrics.total('bot_fsm_rollbacks_total'):g}")
+    for name in ("bot_update_errors_total", "bot_handler_errors_total", "bot_api_errors_total"):
+        for labels, value in sorted(metrics.counters.get(name, {}).items(), key=lambda x: -x[1])[:5]:
+            lines.append(f"Ошибки {' · '.join(v for _, v in labels)}: {value:g}")
+    await answer_lines(message, lines)
 
 # ----------------- Run -----------------
 
+metrics.gauge("bot_outbox_queue_depth", lambda: outbox.queue_depth, "Заявки в очереди к админу")
+metrics.gauge("bot_outbox_dead", lambda: outbox.dead, "Заявки, которые не удалось доставить")
+metrics.gauge("bot_update_lanes", lambda: dp.lanes, "Чатов с апдейтами в очереди или в работе")
+metrics.gauge("bot_updates_queued", lambda: dp.queued, "Апдейтов в очереди и в работе")
+metrics.gauge("bot_flood_tracked_chats", lambda: len(dp.throttle._buckets), "Чатов с корзиной токенов")
+metrics.gauge("bot_orders_indexed", lambda: len(order_index.locations), "Заказов в индексе")
+metrics_runner: Optional[web.AppRunner] = None
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+async def start_metrics_server():
+    # отдельный порт на localhost: наружу, в отличие от вебхука, его не публикуем
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, host=METRICS_HOST, port=METRICS_PORT).start()
+    logging.info("metrics on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+async def stop_metrics_server():
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+
+async def set_webhook_on_startup(bot: Bot):
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+
+async def run_webhook():
+    app = web.Application()
+    # апдейты без правильного X-Telegram-Bot-Api-Secret-Token получают 401
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    dp.startup.register(set_webhook_on_startup)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT).start()
+        logging.info("webhook server listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
-    await dp.start_polling(bot)
+    check_config()
+    await asyncio.to_thread(order_log.recover)
+    await order_store.import_text_once(order_log)
+    logging.info("order index: %d orders", await asyncio.to_thread(order_index.build))
+    logging.info("finalize dedup: %d keys", await finalize_index.load(order_store))
+    logging.info("stats: %d orders added to snapshot", await asyncio.to_thread(order_stats.load, order_log))
+    dp.startup.register(outbox.start)
+    dp.startup.register(media_cache.start)
+    dp.startup.register(start_metrics_server)
+    dp.shutdown.register(stop_metrics_server)
+    dp.shutdown.register(outbox.close)
+    dp.shutdown.register(media_cache.close)
+    dp.shutdown.register(order_counter.close)
+    dp.shutdown.register(order_journal.close)
+    dp.shutdown.register(order_store.close)
+    dp.shutdown.register(order_stats.close)
+    if RUN_MODE == "webhook":
+        await run_webhook()
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if sys.argv[1:2] == ["export"]:
+        export_cli(sys.argv[2:])
+    else:
+        asyncio.run(main())
\ No newline at end of file
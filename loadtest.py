@@ -0,0 +1,386 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+from aiohttp import ClientSession, web
+
+# Нагрузочный прогон bot.py против локальной заглушки Bot API.
+# Бот запускается отдельным процессом с BOT_API_URL, указывающим на заглушку,
+# апдейты отдаются ему через getUpdates (polling) или POST на вебхук (webhook).
+# Задержка шага — время от выдачи апдейта боту до первого ответа бота в этот чат;
+# следующий шаг пользователя отправляется только после ответа на предыдущий.
+# Альбом из нескольких файлов — один шаг: бот отвечает на него одним сообщением.
+
+BOT_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+TOKEN = "123456:LOADTEST"
+ADMIN_ID = 1606381134
+REPLY_TIMEOUT = 10.0
+SEND_METHODS = {"sendmessage", "sendphoto", "senddocument", "sendmediagroup"}
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+class FakeBotAPI:
+    # Минимальная заглушка Bot API: getUpdates с long polling, send* записывают ответы.
+
+    def __init__(self):
+        self.pending: List[dict] = []
+        self.new_updates = asyncio.Event()
+        self.next_update_id = 1
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.requests: Dict[str, int] = {}
+        self.message_id = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    def push(self, update: dict) -> dict:
+        update = dict(update, update_id=self.next_update_id)
+        self.next_update_id += 1
+        return update
+
+    async def get_updates(self, params: dict) -> List[dict]:
+        offset = int(params.get("offset") or 0)
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), float(params.get("timeout") or 0) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.pending[:100])
+
+    def message(self, chat_id: int, **extra) -> dict:
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.requests[method] = self.requests.get(method, 0) + 1
+
+        if method == "getupdates":
+            result = await self.get_updates(params)
+        elif method == "getme":
+            result = {"id": int(TOKEN.split(":")[0]), "is_bot": True, "first_name": "loadtest",
+                      "username": "loadtest_bot"}
+        elif method in SEND_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            waiter = self.waiters.pop(chat_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+            if method == "sendmediagroup":
+                result = [self.message(chat_id) for _ in json.loads(params.get("media", "[]"))]
+            else:
+                result = self.message(chat_id, text=params.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+def read_rss_mb(pid: int) -> Dict[str, float]:
+    # текущий и пиковый RSS процесса бота по /proc (на других ОС — пусто)
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="ascii") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return {}
+    return {key: round(int(fields[name].split()[0]) / 1024, 1)
+            for key, name in (("rss_mb", "VmRSS"), ("peak_mb", "VmHWM")) if name in fields}
+
+class Runner:
+    def __init__(self, api: FakeBotAPI, mode: str, webhook_url: str, secret: str):
+        self.api = api
+        self.mode = mode
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self.latencies: List[float] = []
+        self.by_kind: Dict[str, List[float]] = {}
+        self.timeouts = 0
+        self.http: Optional[ClientSession] = None
+
+    async def deliver(self, update: dict) -> None:
+        if self.mode == "polling":
+            self.api.pending.append(update)
+            self.api.new_updates.set()
+            return
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        async with self.http.post(self.webhook_url, json=update, headers=headers) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"webhook answered {resp.status}")
+
+    async def run_user(self, chat_id: int, steps: List["Step"]) -> None:
+        loop = asyncio.get_running_loop()
+        for step in steps:
+            updates = [self.api.push(u) for u in (step if isinstance(step, list) else [step])]
+            waiter = loop.create_future()
+            self.api.waiters[chat_id] = waiter
+            sent = time.perf_counter()
+            for update in updates:
+                await self.deliver(update)
+            try:
+                replied = await asyncio.wait_for(waiter, REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.api.waiters.pop(chat_id, None)
+                self.timeouts += 1
+                continue
+            self.latencies.append(replied - sent)
+            self.by_kind.setdefault(step_kind(updates), []).append(replied - sent)
+
+    async def run(self, conversations: Dict[int, List["Step"]]) -> dict:
+        async with ClientSession() as self.http:
+            started = time.perf_counter()
+            await asyncio.gather(*(self.run_user(c, u) for c, u in conversations.items()))
+            elapsed = time.perf_counter() - started
+        total = sum(len(u) for u in conversations.values())
+        return {
+            "mode": self.mode,
+            "users": len(conversations),
+            "steps": total,
+            "updates": sum(len(s) if isinstance(s, list) else 1 for u in conversations.values() for s in u),
+            "seconds": round(elapsed, 3),
+            "throughput": round(total / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(self.latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(self.latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 2),
+            "mean_ms": round(statistics.fmean(self.latencies) * 1000, 2) if self.latencies else 0.0,
+            "by_step": {kind: {"count": len(v), "p50_ms": round(percentile(v, 0.50) * 1000, 2),
+                               "p99_ms": round(percentile(v, 0.99) * 1000, 2)}
+                        for kind, v in sorted(self.by_kind.items())},
+            "timeouts": self.timeouts,
+        }
+
+# шаг сценария — один апдейт или список апдейтов альбома
+Step = Union[dict, List[dict]]
+
+def user_of(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+def message_update(chat_id: int, **content) -> dict:
+    return {"message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                        "from": user_of(chat_id), **content}}
+
+def text_update(chat_id: int, text: str) -> dict:
+    return message_update(chat_id, text=text)
+
+def file_update(chat_id: int, kind: str, n: int, group: Optional[str] = None) -> dict:
+    file_id = f"{kind}-{chat_id}-{n}"
+    extra = {"media_group_id": group} if group else {}
+    if kind == "photo":
+        sizes = [{"file_id": f"{file_id}-{w}", "file_unique_id": f"u{file_id}-{w}", "width": w, "height": w * 3 // 4,
+                  "file_size": w * w // 4} for w in (320, 1280)]
+        return message_update(chat_id, photo=sizes, **extra)
+    return message_update(chat_id, document={"file_id": file_id, "file_unique_id": f"u{file_id}",
+                                             "file_name": f"layout{n}.pdf", "mime_type": "application/pdf",
+                                             "file_size": 300_000}, **extra)
+
+def step_kind(updates: List[dict]) -> str:
+    message = updates[0].get("message") or {}
+    text = message.get("text") or ""
+    if len(updates) > 1:
+        return "album"
+    if "photo" in message or "document" in message:
+        return "file"
+    if text == "✅ Отправить":
+        return "confirm"
+    return "command" if text.startswith("/") else "text"
+
+PHONE = "89123456789"
+# ответы на шаги каждой услуги; ("photo", 3) — альбом из трёх фото, ("document", 1) — один файл
+FLOWS: Dict[str, List[Union[str, Tuple[str, int]]]] = {
+    "Печать фото": [PHONE, "A6 (10×15)", "Глянцевая", "2", ("photo", 3), ("photo", 1), "ГОТОВО", "ПРОПУСТИТЬ"],
+    "Печать документов": [PHONE, "A4", "2", "Цветная", "Двусторонняя", "все", ("document", 2), "ГОТОВО", "срочно"],
+    "Фото на документы": [PHONE, "Паспорт РФ", "2", "Цветная", "ПРОПУСТИТЬ"],
+    "Оцифровка": [PHONE, "Плёнка", "1", "Да, принесу носитель", "ПРОПУСТИТЬ"],
+    "Термопечать": [PHONE, "Футболка", "Средний", "Есть макет", ("document", 1), "ГОТОВО", "ПРОПУСТИТЬ"],
+    "Реставрация фото": [PHONE, "Убрать царапины/трещины", ("photo", 1), "ГОТОВО", "ПРОПУСТИТЬ"],
+    "Визитки/буклеты/наклейки": [PHONE, "Визитки", "100", "Стандартный", "Цветная", "Есть макет",
+                                 ("document", 1), "ГОТОВО", "ПРОПУСТИТЬ"],
+    "Фотошоп": [PHONE, "Ретушь", "ПРОПУСТИТЬ", ("photo", 2), "ГОТОВО", "к пятнице"],
+    "Другое": [PHONE, "Напечатать календарь", "ПРОПУСТИТЬ ФАЙЛЫ", "ПРОПУСТИТЬ"],
+}
+
+def flow_steps(chat_id: int, service: str) -> List[Step]:
+    steps: List[Step] = [text_update(chat_id, t) for t in ("/start", "Создать заказ", service)]
+    files = 0
+    for answer in FLOWS[service]:
+        if isinstance(answer, str):
+            steps.append(text_update(chat_id, answer))
+            continue
+        kind, count = answer
+        group = f"album-{chat_id}-{files}" if count > 1 else None
+        batch = [file_update(chat_id, kind, files + i, group) for i in range(count)]
+        files += count
+        steps.append(batch if count > 1 else batch[0])
+    steps.append(text_update(chat_id, "✅ Отправить"))
+    return steps
+
+def synthetic_conversations(users: int, services: Optional[List[str]] = None) -> Dict[int, List[Step]]:
+    # пользователи по кругу проходят выбранные услуги от /start до отправки заявки
+    services = services or list(FLOWS)
+    return {10_000 + i: flow_steps(10_000 + i, services[i % len(services)]) for i in range(users)}
+
+def load_conversations(path: str) -> Dict[int, List[dict]]:
+    # JSONL с апдейтами в формате Telegram (например, сохранённый ответ getUpdates)
+    conversations: Dict[int, List[dict]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            update.pop("update_id", None)
+            message = update.get("message") or {}
+            chat_id = (message.get("chat") or {}).get("id")
+            if chat_id is None or chat_id == ADMIN_ID:
+                continue
+            conversations.setdefault(chat_id, []).append(update)
+    return conversations
+
+async def wait_ready(api: FakeBotAPI, mode: str, webhook_port: int, proc) -> None:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.returncode is not None:
+            raise RuntimeError(f"bot.py exited with code {proc.returncode}")
+        if mode == "polling" and api.requests.get("getupdates"):
+            return
+        if mode == "webhook":
+            try:
+                with socket.create_connection(("127.0.0.1", webhook_port), timeout=0.2):
+                    return
+            except OSError:
+                pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("bot.py did not start in 30s")
+
+def count_orders(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        return sum(1 for line in f if line.startswith("Заказ №"))
+
+async def run_mode(mode: str, conversations: Dict[int, List[dict]], workdir: str) -> dict:
+    api = FakeBotAPI()
+    api_runner = web.AppRunner(api.make_app())
+    await api_runner.setup()
+    api_port = free_port()
+    await web.TCPSite(api_runner, "127.0.0.1", api_port).start()
+
+    webhook_port = free_port()
+    secret = "loadtest-secret"
+    env = dict(os.environ, BOT_TOKEN=TOKEN, BOT_API_URL=f"http://127.0.0.1:{api_port}", RUN_MODE=mode,
+               WEBHOOK_SECRET=secret, WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(webhook_port),
+               WEBHOOK_BASE_URL="")
+    run_dir = os.path.join(workdir, mode)
+    os.makedirs(run_dir, exist_ok=True)
+    proc = await asyncio.create_subprocess_exec(sys.executable, BOT_PY, cwd=run_dir, env=env)
+    try:
+        await wait_ready(api, mode, webhook_port, proc)
+        rss_before = read_rss_mb(proc.pid)
+        runner = Runner(api, mode, f"http://127.0.0.1:{webhook_port}/webhook", secret)
+        result = await runner.run(conversations)
+        await asyncio.sleep(0.5)  # даём outbox дослать заявки админу
+        rss_after = read_rss_mb(proc.pid)
+        if rss_before and rss_after:
+            result.update(rss_start_mb=rss_before["rss_mb"], rss_end_mb=rss_after["rss_mb"],
+                          rss_growth_mb=round(rss_after["rss_mb"] - rss_before["rss_mb"], 1),
+                          rss_peak_mb=rss_after.get("peak_mb"))
+        result["orders"] = count_orders(os.path.join(run_dir, "orders.txt"))
+        result["api_requests"] = dict(sorted(api.requests.items()))
+        return result
+    finally:
+        proc.terminate()
+        await proc.wait()
+        await api_runner.cleanup()
+
+# метрика -> True, если больше — хуже
+COMPARED = {"throughput": False, "p50_ms": True, "p95_ms": True, "p99_ms": True, "rss_growth_mb": True}
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    # регрессии относительно сохранённого прогона: отклонение хуже чем на tolerance
+    regressions = []
+    base_by_mode = {r["mode"]: r for r in baseline}
+    for r in results:
+        base = base_by_mode.get(r["mode"])
+        if base is None:
+            continue
+        if base.get("scenario") != r.get("scenario"):
+            print(f"{r['mode']}: сценарий другой ({base.get('scenario')!r} vs {r.get('scenario')!r}), "
+                  f"сравнение условное")
+        for key, lower_is_better in COMPARED.items():
+            old, new = base.get(key), r.get(key)
+            if old is None or new is None:
+                continue
+            delta = (new - old) / old if old else 0.0
+            mark = ""
+            if (delta > tolerance) if lower_is_better else (delta < -tolerance):
+                mark = "  <-- регрессия"
+                regressions.append(f"{r['mode']} {key}")
+            print(f"{r['mode']:<8} {key:<14} {old:>10} -> {new:>10} ({delta:+.0%}){mark}")
+    return regressions
+
+async def amain(args) -> int:
+    if args.updates:
+        conversations = load_conversations(args.updates)
+        scenario = os.path.basename(args.updates)
+    else:
+        services = args.service or None
+        unknown = set(services or ()) - set(FLOWS)
+        if unknown:
+            raise SystemExit(f"unknown service: {', '.join(sorted(unknown))}; known: {', '.join(FLOWS)}")
+        conversations = synthetic_conversations(args.users, services)
+        scenario = f"{args.users} users: {', '.join(services or FLOWS)}"
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in modes:
+            results.append(dict(await run_mode(mode, conversations, workdir), scenario=scenario))
+
+    print(f"{'mode':<8} {'steps':>7} {'step/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'timeouts':>8} {'orders':>7} {'RSS +MB':>8}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['steps']:>7} {r['throughput']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['timeouts']:>8} {r['orders']:>7} {r.get('rss_growth_mb', '-'):>8}")
+        for kind, v in r["by_step"].items():
+            print(f"  {kind:<10} {v['count']:>6} p50 {v['p50_ms']:>8} p99 {v['p99_ms']:>8}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("регрессии: " + ", ".join(regressions))
+            return 1
+    return 0
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон bot.py против заглушки Bot API")
+    parser.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    parser.add_argument("--updates", help="JSONL с записанными апдейтами; без него — синтетические диалоги")
+    parser.add_argument("--users", type=int, default=50, help="число одновременных синтетических пользователей")
+    parser.add_argument("--service", action="append", help="гонять только эту услугу (можно несколько раз)")
+    parser.add_argument("--out", help="куда сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона (--out) для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение, доля (0.2 = 20%%)")
+    sys.exit(asyncio.run(amain(parser.parse_args())))
+
+if __name__ == "__main__":
+    main()
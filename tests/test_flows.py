@@ -0,0 +1,304 @@
+# Сценарии всех девяти услуг: апдейты идут через dp.feed_update, запросы к Bot API
+# перехватывает подменённая сессия. Проверяются точные тексты ответов, клавиатуры
+# и строки заявки в orders.txt.
+
+import asyncio
+import os
+import re
+import sys
+from datetime import datetime
+
+import pytest
+
+os.environ.setdefault("FSM_STORAGE", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot as B  # noqa: E402
+from aiogram import methods  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import (  # noqa: E402
+    Chat, Document, Message, PhotoSize, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, User,
+)
+
+REMOVE = "remove"  # ReplyKeyboardRemove
+CONTACT = ("Контакт для связи (номер телефона на 8…). Пример: 89123456789", REMOVE)
+COMMENT = ("Комментарий (или ПРОПУСТИТЬ):", [["ПРОПУСТИТЬ"]])
+ACCEPTED = ("Принято. Ещё файлы или ГОТОВО.", None)
+DONE_KB = [["ГОТОВО"]]
+FILES_KB = [["ГОТОВО", "ПРОПУСТИТЬ ФАЙЛЫ"]]
+CONFIRM_KB = [["✅ Отправить", "↩️ Начать заново"]]
+PHOTO_SIZES = [["A7 (7×10)", "A6 (10×15)"], ["A5 (15×21)", "A4 (21×30)"], ["A3 (30×42)"]]
+LAYOUT_KB = [["Есть макет", "Нет макета"]]
+
+
+def photo(file_id):
+    return ("photo", file_id)
+
+
+def document(file_id):
+    return ("document", file_id)
+
+
+def review(*lines):
+    return ("Проверьте заказ:\n" + "\n".join(lines) + "\n\nВсё верно?", CONFIRM_KB)
+
+
+# услуга -> (шаги: (ввод, (ответ, клавиатура)), строки заявки после «Клиент:»)
+FLOWS = {
+    "Печать фото": ([
+        ("Печать фото", CONTACT),
+        ("123", ("Нужен номер на 8… (11 цифр). Пример: 89123456789", None)),
+        ("89123456789", ("Выберите размер:", PHOTO_SIZES)),
+        ("A6 (10×15)", ("Тип бумаги:", [["Глянцевая", "Матовая"]])),
+        ("мат", ("Выберите: Глянцевая или Матовая.", None)),
+        ("Матовая", ("Количество копий (числом):", REMOVE)),
+        ("0", ("Введите количество копий числом (например 2).", None)),
+        ("3", ("Пришлите фото (можно несколько). Когда закончите нажмите ГОТОВО.", DONE_KB)),
+        ("ГОТОВО", ("Для печати фото нужны файлы. Пришлите хотя бы одно фото.", None)),
+        (photo("p1"), ACCEPTED),
+        (document("d1"), ACCEPTED),
+        ("ГОТОВО", COMMENT),
+        ("срочно", review("Услуга: Печать фото", "Контакт: 89123456789", "Размер: A6 (10×15)",
+                          "Бумага: Матовая", "Копий: 3", "Файлов: 2", "Комментарий: срочно")),
+    ], ["Контакт: 89123456789", "Услуга: Печать фото", "Размер: A6 (10×15)", "Бумага: Матовая",
+        "Копий: 3", "Комментарий: срочно", "Файлов: 2"]),
+
+    "Печать документов": ([
+        ("Печать документов", CONTACT),
+        ("89123456789", ("Формат бумаги:", [["A4", "A3"]])),
+        ("A5", ("Выберите: A4 или A3.", None)),
+        ("A4", ("Количество копий (числом):", REMOVE)),
+        ("5", ("Цветность:", [["Ч/Б", "Цветная"]])),
+        ("Цветная", ("Печать:", [["Односторонняя", "Двусторонняя"]])),
+        ("Двусторонняя", ("Страницы: 'все' или диапазон (например 1-3,7):", REMOVE)),
+        ("1-3,7", ("Пришлите документы. Когда закончите нажмите ГОТОВО.", DONE_KB)),
+        (document("doc1"), ACCEPTED),
+        ("ГОТОВО", COMMENT),
+        ("ПРОПУСТИТЬ", review("Услуга: Печать документов", "Контакт: 89123456789", "Формат: A4", "Копий: 5",
+                              "Цвет: Цветная", "Печать: Двусторонняя", "Страницы: 1-3,7", "Файлов: 1",
+                              "Комментарий: -")),
+    ], ["Контакт: 89123456789", "Услуга: Печать документов", "Формат: A4", "Копий: 5", "Цвет: Цветная",
+        "Печать: Двусторонняя", "Страницы: 1-3,7", "Комментарий: -", "Файлов: 1"]),
+
+    "Фото на документы": ([
+        ("Фото на документы", CONTACT),
+        ("89123456789", ("Тип документа:", [["Паспорт РФ", "Загранпаспорт"], ["Удостоверение"]])),
+        ("Паспорт", ("Выберите тип документа кнопкой.", None)),
+        ("Паспорт РФ", ("Количество (числом):", REMOVE)),
+        ("-1", ("Введите количество числом (например 2).", None)),
+        ("4", ("Цвет:", [["Цветная", "Ч/Б"]])),
+        ("Ч/Б", COMMENT),
+        ("комм", review("Услуга: Фото на документы", "Контакт: 89123456789", "Документ: Паспорт РФ",
+                        "Количество: 4", "Цвет: Ч/Б", "Комментарий: комм")),
+    ], ["Контакт: 89123456789", "Услуга: Фото на документы", "Документ: Паспорт РФ", "Количество: 4",
+        "Цвет: Ч/Б", "Комментарий: комм", "Файлов: 0"]),
+
+    "Оцифровка": ([
+        ("Оцифровка", CONTACT),
+        ("89000000000", ("Откуда оцифровывать?", [["Плёнка", "Видеокассета"], ["Аудиокассета"]])),
+        ("Плёнка", ("Количество (штук) (числом):", REMOVE)),
+        ("2", ("Результат отдаём только на съёмный носитель клиента. Принесёте?",
+               [["Да, принесу носитель", "Нет"]])),
+        ("Может", ("Выберите кнопку: Да или Нет.", None)),
+        ("Нет", COMMENT),
+        ("ПРОПУСТИТЬ", review("Услуга: Оцифровка", "Контакт: 89000000000", "Источник: Плёнка", "Количество: 2",
+                              "Носитель: Нет", "Комментарий: -")),
+    ], ["Контакт: 89000000000", "Услуга: Оцифровка", "Источник: Плёнка", "Количество: 2", "Носитель: Нет",
+        "Комментарий: -", "Файлов: 0"]),
+
+    "Термопечать": ([
+        ("Термопечать", CONTACT),
+        ("89123456789", ("На чём печать?", [["Футболка", "Кофта/Худи"], ["Кружка", "Свой вариант"]])),
+        ("Свой вариант", ("Введите свой вариант (например: кепка):", REMOVE)),
+        ("Кепка", ("Размер принта:", [["Маленький", "Средний"], ["Большой", "Свой размер"]])),
+        ("Свой размер", ("Введите свой размер/описание (например: 20×25 см):", REMOVE)),
+        ("20x25", ("Макет есть?", LAYOUT_KB)),
+        ("Есть макет", ("Пришлите макет(ы). Когда закончите нажмите ГОТОВО.", DONE_KB)),
+        (photo("t1"), ACCEPTED),
+        ("ГОТОВО", COMMENT),
+        ("ПРОПУСТИТЬ", review("Услуга: Термопечать", "Контакт: 89123456789", "На чём: Кепка", "Размер: 20x25",
+                              "Макет: Есть макет", "Файлов: 1", "Комментарий: -")),
+    ], ["Контакт: 89123456789", "Услуга: Термопечать", "На чём: Кепка", "Размер принта: 20x25",
+        "Макет: Есть макет", "Комментарий: -", "Файлов: 1"]),
+
+    "Реставрация фото": ([
+        ("Реставрация фото", CONTACT),
+        ("89123456789", ("Что нужно сделать?", [["Убрать царапины/трещины", "Восстановить порванное"],
+                                                ["Улучшить качество/резкость", "Раскрасить Ч/Б"],
+                                                ["Убрать лишние объекты", "Свой вариант"]])),
+        ("Раскрасить Ч/Б", ("Прикрепите фото (если есть). Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.", FILES_KB)),
+        ("ПРОПУСТИТЬ ФАЙЛЫ", COMMENT),
+        ("кк", review("Услуга: Реставрация фото", "Контакт: 89123456789", "Задача: Раскрасить Ч/Б", "Файлов: 0",
+                      "Комментарий: кк")),
+    ], ["Контакт: 89123456789", "Услуга: Реставрация фото", "Задача: Раскрасить Ч/Б", "Комментарий: кк",
+        "Файлов: 0"]),
+
+    "Визитки/буклеты/наклейки": ([
+        ("Визитки/буклеты/наклейки", CONTACT),
+        ("89123456789", ("Что печатаем?", [["Визитки", "Буклеты", "Наклейки"]])),
+        ("Визитки", ("Тираж (количество) (числом):", REMOVE)),
+        ("abc", ("Введите тираж числом (например 100).", None)),
+        ("100", ("Размер/формат:", [["Стандартный", "Свой формат"]])),
+        ("Свой формат", ("Введите свой формат (например 90×50 мм):", REMOVE)),
+        ("90x50", ("Цветность:", [["Ч/Б", "Цветная"]])),
+        ("Цветная", ("Макет есть?", LAYOUT_KB)),
+        ("Есть макет", ("Пришлите макет(ы). Когда закончите нажмите ГОТОВО.", DONE_KB)),
+        (document("lay"), ("Принято. Ещё файлы или ГОТОВО / ПРОПУСТИТЬ ФАЙЛЫ.", None)),
+        ("ГОТОВО", COMMENT),
+        ("ПРОПУСТИТЬ", review("Услуга: Визитки/буклеты/наклейки", "Контакт: 89123456789", "Тип: Визитки",
+                              "Тираж: 100", "Формат: 90x50", "Цвет: Цветная", "Макет: Есть макет", "Дизайн: -",
+                              "Файлов: 1", "Комментарий: -")),
+    ], ["Контакт: 89123456789", "Услуга: Визитки/буклеты/наклейки", "Тип: Визитки", "Тираж: 100",
+        "Формат: 90x50", "Цвет: Цветная", "Макет: Есть макет", "Дизайн: -", "Комментарий: -", "Файлов: 1"]),
+
+    "Фотошоп": ([
+        ("Фотошоп", CONTACT),
+        ("89123456789", ("Задача:", [["Ретушь", "Замена фона"], ["Удаление объектов", "Коллаж"],
+                                     ["Восстановление", "Подготовка к печати"], ["Другое"]])),
+        ("Ретушь", ("Что точно нельзя менять? (или ПРОПУСТИТЬ)", [["ПРОПУСТИТЬ"]])),
+        ("лицо", ("Пришлите исходники (файлы обязательны). Когда закончите нажмите ГОТОВО.", DONE_KB)),
+        ("ГОТОВО", ("Для фотошопа нужны исходники. Пришлите хотя бы один файл.", None)),
+        (photo("s3"), ACCEPTED),
+        ("ГОТОВО", COMMENT),
+        ("комм", ("Проверьте заказ:\nУслуга: Фотошоп\nКонтакт: 89123456789\nЗадача: Ретушь\nНельзя менять: лицо\n"
+                  "Файлов: 1\nКомментарий: комм\n\nПримечание: подделку документов не делаем.\n\nВсё верно?",
+                  CONFIRM_KB)),
+    ], ["Контакт: 89123456789", "Услуга: Фотошоп", "Задача: Ретушь", "Нельзя менять: лицо", "Комментарий: комм",
+        "Файлов: 1"]),
+
+    "Другое": ([
+        ("Другое", CONTACT),
+        ("89123456789", ("Опишите, что нужно сделать:", REMOVE)),
+        ("сделать что-то", ("Если нужно, прикрепите файлы. Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.", FILES_KB)),
+        ("ПРОПУСТИТЬ ФАЙЛЫ", COMMENT),
+        ("ПРОПУСТИТЬ", review("Услуга: Другое", "Контакт: 89123456789", "Описание: сделать что-то", "Файлов: 0",
+                              "Комментарий: -")),
+    ], ["Контакт: 89123456789", "Услуга: Другое", "Описание: сделать что-то", "Комментарий: -", "Файлов: 0"]),
+}
+
+
+class RecordingSession(BaseSession):
+    # вместо Bot API: запоминает методы и отвечает правдоподобными объектами
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.sent.append(method)
+        if isinstance(method, methods.SendMediaGroup):
+            return []
+        if isinstance(method, methods.SendMessage):
+            return Message(message_id=len(self.sent), date=datetime.now(),
+                           chat=Chat(id=method.chat_id, type="private"), text=method.text)
+        return True
+
+
+def keyboard(markup):
+    if isinstance(markup, ReplyKeyboardMarkup):
+        return [[button.text for button in row] for row in markup.keyboard]
+    if isinstance(markup, ReplyKeyboardRemove):
+        return REMOVE
+    return markup
+
+
+class Client:
+    def __init__(self, loop, session):
+        self.loop = loop
+        self.session = session
+        self.update_id = 0
+
+    def send(self, user_id, value):
+        # ответы бота этому пользователю: [(текст, клавиатура)]
+        self.update_id += 1
+        fields = dict(message_id=self.update_id, date=datetime(2026, 1, 1),
+                      chat=Chat(id=user_id, type="private"),
+                      from_user=User(id=user_id, is_bot=False, first_name="Анна", username="anna"))
+        if isinstance(value, str):
+            fields["text"] = value
+        elif value[0] == "photo":
+            fields["photo"] = [PhotoSize(file_id=value[1], file_unique_id=value[1], width=1, height=1)]
+        else:
+            fields["document"] = Document(file_id=value[1], file_unique_id=value[1])
+        start = len(self.session.sent)
+        update = Update(update_id=self.update_id, message=Message(**fields))
+        self.loop.run_until_complete(B.dp.feed_update(B.bot, update))
+        return [(m.text, keyboard(m.reply_markup)) for m in self.session.sent[start:]
+                if getattr(m, "chat_id", None) == user_id]
+
+    def state(self, user_id):
+        return self.loop.run_until_complete(B.dp.fsm.get_context(B.bot, user_id, user_id).get_state())
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # все пути бота относительные: журнал, счётчик и базы окажутся во временном каталоге
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    session = RecordingSession()
+    B.bot.session = session
+    loop = asyncio.new_event_loop()
+    try:
+        yield Client(loop, session)
+        for close in (B.outbox.close, B.order_journal.close, B.order_counter.close, B.order_store.close):
+            loop.run_until_complete(close())
+    finally:
+        loop.close()
+        os.chdir(cwd)
+
+
+def place_order(client, user_id, steps):
+    for value, reply in steps:
+        assert client.send(user_id, value) == [reply], value
+    replies = client.send(user_id, "✅ Отправить")
+    assert len(replies) == 1
+    order_no = int(re.search(r"Номер заказа: (\d+)", replies[0][0]).group(1))
+    assert replies == [(f"✅ Заявка принята. Номер заказа: {order_no}\nОжидайте, мы свяжемся с вами.",
+                        [["Создать заказ"]])]
+    return order_no
+
+
+def order_lines(order_no):
+    with open(B.ORDERS_FILE, encoding="utf-8") as f:
+        blocks = f.read().split(B.ORDER_SEPARATOR + "\n")
+    found = [b for b in blocks if b.startswith(f"Заказ №{order_no}\n")]
+    assert len(found) == 1
+    return [line for line in found[0].splitlines() if line]
+
+
+@pytest.mark.parametrize("service", list(FLOWS))
+def test_service_flow(client, service):
+    user_id = 1000 + list(FLOWS).index(service)
+    steps, lines = FLOWS[service]
+    order_no = place_order(client, user_id, steps)
+
+    written = order_lines(order_no)
+    assert written[0] == f"Заказ №{order_no}"
+    assert written[1].startswith("Дата: " + datetime.now().strftime("%Y-%m-%d "))
+    assert written[2] == f"Клиент: @anna (id={user_id})"
+    assert written[3:] == lines
+    assert client.state(user_id) is None
+
+
+def test_all_services_covered():
+    assert sorted(FLOWS) == sorted(s.name for s in B.SERVICE_LIST)
+
+
+def test_service_button_mid_wizard_restarts_that_service(client):
+    # кнопка услуги посреди анкеты начинает эту услугу заново, а не считается ответом на шаг
+    user_id = 2000
+    assert client.send(user_id, "Реставрация фото") == [CONTACT]
+    client.send(user_id, "89123456789")
+    assert client.send(user_id, "Восстановить порванное") == [
+        ("Прикрепите фото (если есть). Или нажмите ПРОПУСТИТЬ ФАЙЛЫ.", FILES_KB)]
+    assert client.state(user_id) == "Restoration:files"
+
+    steps, lines = FLOWS["Печать фото"]
+    order_no = place_order(client, user_id, steps)
+    # в заявке нет ничего от брошенной реставрации
+    assert order_lines(order_no)[3:] == lines